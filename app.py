@@ -1,10 +1,12 @@
 import streamlit as st
 from modules.quickwrite import QuickWriteModule
-from utils import load_css
-from theme_utils import inject_theme_responsive_css, load_theme_aware_css
+from modules.prescription_audit import PrescriptionAuditModule
+from theme_utils import apply_theme_bundles
+from draft_utils import DraftStore
 
-# Import the reset button utility
+# Import the reset button utility and render profiler
 from reset_state_utility import add_reset_button
+from profiling_utils import add_profiler_panel
 
 # Page configuration
 st.set_page_config(
@@ -14,23 +16,26 @@ st.set_page_config(
     initial_sidebar_state="collapsed"  # Changed to collapsed by default
 )
 
-# Inject theme-responsive CSS (this should be first before any UI is shown)
-inject_theme_responsive_css()
-
-# Load main CSS (it will now use the theme variables)
-load_theme_aware_css("assets/css/main.css")
-
-# Add reset button in sidebar for debugging
-add_reset_button(location="sidebar")
-
 # Initialize session state variables
 if 'show_landing_page' not in st.session_state:
-    st.session_state.show_landing_page = True
+    # A reconnecting browser with a saved draft goes straight back to QuickWrite
+    resume_draft = DraftStore().has_draft()
+    st.session_state.show_landing_page = not resume_draft
+    st.session_state.active_module = "Quick Write" if resume_draft else None
+    st.session_state.use_unified_workflow = resume_draft
 if 'active_module' not in st.session_state:
     st.session_state.active_module = None
 if 'use_unified_workflow' not in st.session_state:
     st.session_state.use_unified_workflow = False
 
+# Apply the theme and page stylesheets (this should be first before any UI is shown).
+# They are injected once per session, so reruns don't resend the CSS.
+apply_theme_bundles(["base", "landing"] if st.session_state.show_landing_page else ["base"])
+
+# Add reset button and render profiler in sidebar for debugging
+add_reset_button(location="sidebar")
+add_profiler_panel(location="sidebar")
+
 # Navigation functions
 def go_to_module(module_name, use_unified=False):
     st.session_state.show_landing_page = False
@@ -151,6 +156,20 @@ if not st.session_state.show_landing_page:
             else:
                 st.info(f"The {write_up_type} write-up type is under development.")
 
+    elif active_module == "Prescription Audit":
+        # Add navigation header
+        col1, col2 = st.columns([1, 5])
+        
+        with col1:
+            if st.button("← Home", key="home_btn", use_container_width=True):
+                go_to_landing_page()
+                st.rerun()
+        
+        with col2:
+            st.title("Prescription Audit")
+        
+        PrescriptionAuditModule().render_audit_module()
+
     elif active_module in ["Competency Tracker", "Part 3 Bank"]:
         # Add navigation header
         col1, col2 = st.columns([1, 5])
@@ -166,9 +185,6 @@ if not st.session_state.show_landing_page:
         st.info(f"The {active_module} module is under development.")
 
 else:  # This is the landing page
-    # Load landing-specific CSS with theme awareness
-    load_theme_aware_css("assets/css/landing.css")
-    
     # Clean header with title
     col1, col2 = st.columns([1, 5])
     with col2:
@@ -198,6 +214,20 @@ else:  # This is the landing page
 
         st.markdown("<hr style='margin: 1.5rem 0; border: none; height: 1px; background-color: var(--card-border);'>", unsafe_allow_html=True)
         
+        # Prescription audit tool card
+        st.markdown("""
+        <div class='tool-card'>
+            <h2>Prescription Audit</h2>
+            <p>Validate a CSV export of historical prescriptions against the dose/fractionation and site rules, with a summary by site and physician.</p>
+        </div>
+        """, unsafe_allow_html=True)
+        
+        if st.button("Launch Prescription Audit", key="audit_btn"):
+            go_to_module("Prescription Audit")
+            st.rerun()
+        
+        st.markdown("<hr style='margin: 1.5rem 0; border: none; height: 1px; background-color: var(--card-border);'>", unsafe_allow_html=True)
+        
         # Future tools section
         st.markdown("""
         <div class='tool-card'>
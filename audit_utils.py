@@ -0,0 +1,169 @@
+import numpy as np
+import pandas as pd
+
+from validation_utils import FormValidator, get_prescription_rules, validate_prescriptions
+
+# Columns of a prescription export; technique and physician are optional
+AUDIT_REQUIRED_COLUMNS = ("site", "dose", "fractions")
+AUDIT_OPTIONAL_COLUMNS = ("technique", "physician")
+
+# Rows read from the CSV at a time
+DEFAULT_CHUNK_SIZE = 10000
+
+# Individual findings kept for the report; counts always cover every row
+MAX_FINDINGS = 5000
+
+# Field name, column, expected range and warning range for FormValidator.validate_clinical_values
+CLINICAL_RANGES = (
+    ("Dose", "dose", (0.1, 100.0), (1.0, 85.0)),
+    ("Fractions", "fractions", (1, 50), (1, 45)),
+)
+
+
+def _audit_chunk(chunk, first_row):
+    """Validate one chunk of prescriptions.
+
+    Returns:
+        tuple: (per-row DataFrame with error/warning flags, findings DataFrame)
+    """
+    dose = pd.to_numeric(chunk["dose"], errors="coerce")
+    fractions = pd.to_numeric(chunk["fractions"], errors="coerce")
+    sites = chunk["site"].fillna("").astype(str).str.strip()
+    rows = pd.DataFrame({
+        "Row": np.arange(first_row, first_row + len(chunk)),
+        "Site": sites.str.lower(),
+        "Physician": chunk["physician"].fillna("Unknown").astype(str).str.strip() if "physician" in chunk else "Unknown",
+        "Technique": chunk["technique"].fillna("").astype(str).str.strip() if "technique" in chunk else "",
+        "Dose": dose.to_numpy(),
+        "Fractions": fractions.to_numpy(),
+    })
+
+    # (row positions, severity, check, message) from every check
+    found = []
+    missing = (dose.isna() | fractions.isna()).to_numpy()
+    if missing.any():
+        found.append((np.flatnonzero(missing), "Error", "Missing data", "Missing or non-numeric dose/fractions"))
+
+    complete = np.flatnonzero(~missing)
+    if complete.size:
+        results = validate_prescriptions(dose.iloc[complete].tolist(), fractions.iloc[complete].tolist(),
+                                         sites.iloc[complete].tolist())
+        schema_messages = get_prescription_rules("dose_fractionation").default_messages
+        messages = results["Message"].to_numpy(dtype=object)
+        site_messages = results["Site Message"].to_numpy(dtype=object)
+        valid = results["Valid"].to_numpy()
+        consistent = results["Site Consistent"].to_numpy()
+        flagged = ~np.isin(messages, schema_messages)
+
+        found.append((complete[~valid], "Error", "Dose/fractionation", messages[~valid]))
+        found.append((complete[valid & flagged], "Warning", "Dose/fractionation", messages[valid & flagged]))
+        found.append((complete[~consistent], "Error", "Site consistency", site_messages[~consistent]))
+        has_note = consistent & (site_messages != "")
+        found.append((complete[has_note], "Warning", "Site consistency", site_messages[has_note]))
+
+        # Range checks are vectorized; FormValidator words the few rows they flag
+        numeric = {"dose": dose, "fractions": fractions}
+        for field_name, column, (low, high), (warn_low, warn_high) in CLINICAL_RANGES:
+            values = numeric[column].to_numpy()[complete]
+            outside = (values < low) | (values > high)
+            unusual = ~outside & ((values < warn_low) | (values > warn_high))
+            for severity, mask in (("Error", outside), ("Warning", unusual)):
+                positions = complete[mask]
+                if not positions.size:
+                    continue
+                texts = []
+                for value in numeric[column].iloc[positions].tolist():
+                    validator = FormValidator()
+                    validator.validate_clinical_values(value, field_name, (low, high), (warn_low, warn_high))
+                    texts.append((validator.errors or validator.warnings)[0])
+                found.append((positions, severity, f"{field_name} range", np.array(texts, dtype=object)))
+
+    findings = [
+        pd.DataFrame({"Position": positions, "Severity": severity, "Check": check, "Issue": messages})
+        for positions, severity, check, messages in found if len(positions)
+    ]
+    findings = pd.concat(findings, ignore_index=True) if findings else pd.DataFrame(
+        columns=["Position", "Severity", "Check", "Issue"]
+    )
+    positions = np.arange(len(rows))
+    rows["Error"] = np.isin(positions, findings.loc[findings["Severity"] == "Error", "Position"].to_numpy())
+    rows["Warning"] = np.isin(positions, findings.loc[findings["Severity"] == "Warning", "Position"].to_numpy())
+
+    findings = rows.iloc[findings["Position"].to_numpy(dtype=int)].drop(columns=["Error", "Warning"]).reset_index(
+        drop=True
+    ).join(findings.drop(columns="Position")).sort_values("Row", kind="stable", ignore_index=True)
+    return rows, findings
+
+
+def _group_summary(counts, key):
+    summary = counts.groupby(key)[["Prescriptions", "With Errors", "With Warnings"]].sum()
+    summary["Error Rate (%)"] = (100.0 * summary["With Errors"] / summary["Prescriptions"]).round(1)
+    return summary.sort_values(["With Errors", "With Warnings"], ascending=False).reset_index()
+
+
+def audit_prescription_csv(source, chunk_size=DEFAULT_CHUNK_SIZE, max_findings=MAX_FINDINGS):
+    """Validate every prescription in a CSV export and summarize the findings.
+
+    The CSV is read in chunks, so memory stays bounded by the chunk size,
+    the number of distinct sites and physicians, and max_findings. Each row
+    goes through validate_dose_fractionation, validate_treatment_site_consistency
+    (both in bulk via validate_prescriptions) and the dose and fraction range
+    checks of FormValidator.validate_clinical_values.
+
+    Args:
+        source: Path or file-like object of a CSV with site, dose and fractions
+            columns, and optionally technique and physician (header case is ignored)
+        chunk_size: Rows read at a time
+        max_findings: Maximum number of individual findings kept
+
+    Returns:
+        dict: "rows", "errors" and "warnings" (rows with at least one), "by_site",
+            "by_physician" and "by_check" summary DataFrames, "findings" (up to
+            max_findings rows, 1-based data row numbers) and "findings_truncated"
+    """
+    counts, checks, findings = [], [], []
+    kept = total_findings = 0
+    first_row = 1
+
+    for chunk in pd.read_csv(source, chunksize=chunk_size, skipinitialspace=True):
+        chunk.columns = [str(column).strip().lower() for column in chunk.columns]
+        missing = [column for column in AUDIT_REQUIRED_COLUMNS if column not in chunk.columns]
+        if missing:
+            raise ValueError(f"Prescription export is missing column(s): {', '.join(missing)}")
+        chunk = chunk[[c for c in AUDIT_REQUIRED_COLUMNS + AUDIT_OPTIONAL_COLUMNS if c in chunk.columns]]
+        chunk = chunk.reset_index(drop=True)
+
+        rows, chunk_findings = _audit_chunk(chunk, first_row)
+        first_row += len(chunk)
+
+        counts.append(rows.groupby(["Site", "Physician"]).agg(
+            Prescriptions=("Row", "size"), **{"With Errors": ("Error", "sum"), "With Warnings": ("Warning", "sum")}
+        ))
+        if len(chunk_findings):
+            checks.append(chunk_findings.groupby(["Check", "Severity"]).size())
+            total_findings += len(chunk_findings)
+            if kept < max_findings:
+                findings.append(chunk_findings.iloc[:max_findings - kept])
+                kept += len(findings[-1])
+
+    if not counts:
+        raise ValueError("Prescription export has no rows")
+
+    counts = pd.concat(counts).groupby(level=[0, 1]).sum().reset_index()
+    if checks:
+        by_check = pd.concat(checks).groupby(level=[0, 1]).sum().unstack(fill_value=0)
+        by_check = by_check.reindex(columns=["Error", "Warning"], fill_value=0).reset_index()
+        by_check.columns = ["Check", "Errors", "Warnings"]
+    else:
+        by_check = pd.DataFrame(columns=["Check", "Errors", "Warnings"])
+
+    return {
+        "rows": int(counts["Prescriptions"].sum()),
+        "errors": int(counts["With Errors"].sum()),
+        "warnings": int(counts["With Warnings"].sum()),
+        "by_site": _group_summary(counts, "Site"),
+        "by_physician": _group_summary(counts, "Physician"),
+        "by_check": by_check,
+        "findings": pd.concat(findings, ignore_index=True) if findings else pd.DataFrame(),
+        "findings_truncated": total_findings > kept,
+    }
@@ -0,0 +1,247 @@
+import json
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+PERIPHERAL_DOSE_FILE = "data/peripheral_dose.json"
+
+# TG-203 dose categories for the maximum dose to a CIED
+DOSE_CATEGORIES = ("< 2 Gy", "2-5 Gy", "> 5 Gy")
+DOSE_CATEGORY_EDGES = (2.0, 5.0)
+
+RISK_LEVELS = ("Low", "Medium", "High")
+
+# Estimated maximum device dose (Gy) by field distance, used when no TPS dose
+# is available; matched by substring in this order
+FIELD_DISTANCE_DOSES = (
+    ("More than 10 cm", 0.5),
+    ("Less than 10 cm", 1.5),
+    ("Within 3 cm", 3.0),
+    ("direct beam", 7.0),
+)
+
+
+def calculate_risk_level(is_pacing_dependent, dose_category, neutron_producing):
+    """Calculate the risk level based on the TG-203 algorithm.
+
+    Args:
+        is_pacing_dependent: Whether the patient is pacing dependent
+        dose_category: One of DOSE_CATEGORIES
+        neutron_producing: Whether the treatment produces neutrons
+
+    Returns:
+        str: "Low", "Medium" or "High"
+    """
+    # Neutron-producing treatment with more than 5 Gy is always high risk
+    if neutron_producing and dose_category == "> 5 Gy":
+        return "High"
+
+    # Neutrons or more than 5 Gy: pacing dependency decides
+    if neutron_producing or dose_category == "> 5 Gy":
+        return "High" if is_pacing_dependent else "Medium"
+
+    # 2-5 Gy: pacing dependency decides
+    if dose_category == "2-5 Gy":
+        return "Medium" if is_pacing_dependent else "Low"
+
+    return "Low"
+
+
+# Risk level index for every [neutron_producing, pacing_dependent, dose category]
+# combination, built once from the per-patient algorithm
+RISK_TABLE = np.array([
+    [
+        [RISK_LEVELS.index(calculate_risk_level(bool(pacing), category, bool(neutron)))
+         for category in DOSE_CATEGORIES]
+        for pacing in (0, 1)
+    ]
+    for neutron in (0, 1)
+])
+
+
+def _as_flags(values):
+    """Convert "Yes"/"No"/"Unknown" answers or booleans to a boolean array ("Yes" is True)."""
+    values = np.asarray(values)
+    if values.dtype.kind in "OUS":
+        return values == "Yes"
+    return values.astype(bool)
+
+
+def estimate_max_dose(tps_max_dose, field_distance):
+    """Maximum device dose, falling back to a field-distance estimate when the TPS dose is 0.
+
+    Args:
+        tps_max_dose: TPS maximum dose to the device in Gy (scalar or array)
+        field_distance: Field distance description(s), e.g. "Within 3 cm of field edge"
+
+    Returns:
+        numpy.ndarray: Maximum dose in Gy
+    """
+    tps_max_dose = np.asarray(tps_max_dose, dtype=float)
+    codes, distances = pd.factorize(np.atleast_1d(np.asarray(field_distance, dtype=object)))
+
+    # Each distinct description is matched once
+    estimates = np.full(len(distances) + 1, np.nan)
+    for i, distance in enumerate(distances):
+        for text, dose in FIELD_DISTANCE_DOSES:
+            if text in distance:
+                estimates[i] = dose
+                break
+    estimated = estimates[codes].reshape(np.shape(field_distance))
+
+    fallback = (tps_max_dose == 0.0) & ~np.isnan(estimated)
+    return np.where(fallback, estimated, tps_max_dose)
+
+
+def dose_category_index(max_dose, edges=DOSE_CATEGORY_EDGES):
+    """Index into DOSE_CATEGORIES for each maximum dose.
+
+    Below edges[0] is the lowest category, up to and including edges[1] the
+    middle one, anything else the highest.
+    """
+    max_dose = np.asarray(max_dose, dtype=float)
+    return np.where(max_dose < edges[0], 0, np.where(max_dose <= edges[1], 1, 2))
+
+
+def stratify_devices(pacing_dependent, neutron_producing, tps_max_dose, field_distance,
+                     edges=DOSE_CATEGORY_EDGES):
+    """TG-203 dose category and risk level for many patients at once.
+
+    Gives the same result as the per-patient assessment in the Pacemaker
+    module for every patient; the dose category edges can be changed to
+    re-stratify a device clinic under a new protocol threshold.
+
+    Args:
+        pacing_dependent: "Yes"/"No"/"Unknown" answers or booleans
+        neutron_producing: "Yes"/"No" answers or booleans
+        tps_max_dose: TPS maximum device doses in Gy (0 when not available)
+        field_distance: Field distance descriptions
+        edges: Dose category edges in Gy
+
+    Returns:
+        pandas.DataFrame: "Estimated Max Dose (Gy)", "Dose Category" and "Risk Level"
+    """
+    max_dose = estimate_max_dose(tps_max_dose, field_distance)
+    categories = dose_category_index(max_dose, edges)
+    risk = RISK_TABLE[_as_flags(neutron_producing).astype(int), _as_flags(pacing_dependent).astype(int), categories]
+    return pd.DataFrame({
+        "Estimated Max Dose (Gy)": max_dose,
+        "Dose Category": np.asarray(DOSE_CATEGORIES, dtype=object)[categories],
+        "Risk Level": np.asarray(RISK_LEVELS, dtype=object)[risk],
+    })
+
+
+def dose_category_margin(max_dose, edges=DOSE_CATEGORY_EDGES):
+    """Dose (Gy) left before each maximum dose reaches the next category.
+
+    Zero for a dose exactly on the upper edge of the middle category (still
+    in it) and NaN for doses already in the highest category.
+    """
+    max_dose = np.asarray(max_dose, dtype=float)
+    upper = np.append(np.asarray(edges, dtype=float), np.nan)
+    return upper[dose_category_index(max_dose, edges)] - max_dose
+
+
+class PeripheralDoseTable:
+    """Out-of-field dose lookup by energy, distance from the field edge and field size.
+
+    Interpolation is log-linear in distance (peripheral dose falls off
+    roughly exponentially) and linear in field size, and works on arrays of
+    any shape, so a whole grid of device positions is evaluated at once.
+    Values outside the table are clamped to its edges.
+    """
+
+    def __init__(self, distances, field_sizes, percent_of_dmax, output_cgy_per_mu=1.0):
+        """Compile the tables.
+
+        Args:
+            distances: Distances from the field edge (cm), ascending
+            field_sizes: Equivalent square field sizes (cm), ascending
+            percent_of_dmax: Dict mapping energy to a [field size][distance] table
+                of peripheral dose in percent of the central-axis dose at dmax
+            output_cgy_per_mu: Central-axis dose at dmax per monitor unit (cGy/MU)
+        """
+        self.distances = np.asarray(distances, dtype=float)
+        self.field_sizes = np.asarray(field_sizes, dtype=float)
+        self.output_cgy_per_mu = output_cgy_per_mu
+        self._log_tables = {}
+        for energy, table in percent_of_dmax.items():
+            table = np.asarray(table, dtype=float)
+            if table.shape != (self.field_sizes.size, self.distances.size):
+                raise ValueError(f"Peripheral dose table for {energy} does not match the distance and field size axes")
+            self._log_tables[energy] = np.log(table)
+
+    @classmethod
+    def from_file(cls, path=PERIPHERAL_DOSE_FILE):
+        """Load the tables from a peripheral dose JSON file."""
+        with open(path, "r") as file:
+            data = json.load(file)
+        return cls(data["distances_cm"], data["field_sizes_cm"], data["percent_of_dmax"],
+                   data.get("output_cgy_per_mu", 1.0))
+
+    @property
+    def energies(self):
+        """Energies with a table, in file order."""
+        return list(self._log_tables)
+
+    @staticmethod
+    def _bracket(axis, values):
+        """Lower table index and interpolation weight for each value, clamped to the axis."""
+        values = np.clip(values, axis[0], axis[-1])
+        index = np.clip(np.searchsorted(axis, values, side="right") - 1, 0, axis.size - 2)
+        weight = (values - axis[index]) / (axis[index + 1] - axis[index])
+        return index, weight
+
+    def percent_of_dmax(self, energy, distance, field_size):
+        """Peripheral dose in percent of the central-axis dose at dmax.
+
+        Args:
+            energy: Beam energy, one of energies
+            distance: Distance(s) from the field edge in cm
+            field_size: Equivalent square field size(s) in cm; broadcast with distance
+
+        Returns:
+            numpy.ndarray: Percent of dmax dose, shaped like the broadcast inputs
+        """
+        if energy not in self._log_tables:
+            raise ValueError(f"No peripheral dose table for {energy}")
+        table = self._log_tables[energy]
+        distance, field_size = np.broadcast_arrays(np.asarray(distance, dtype=float),
+                                                   np.asarray(field_size, dtype=float))
+        d, wd = self._bracket(self.distances, distance)
+        f, wf = self._bracket(self.field_sizes, field_size)
+
+        near = table[f, d] * (1 - wd) + table[f, d + 1] * wd
+        far = table[f + 1, d] * (1 - wd) + table[f + 1, d + 1] * wd
+        return np.exp(near * (1 - wf) + far * wf)
+
+    def device_dose(self, energy, distance, field_size, monitor_units):
+        """Peripheral dose in Gy delivered by a number of monitor units (any broadcastable shapes)."""
+        percent = self.percent_of_dmax(energy, distance, field_size)
+        return percent / 100.0 * np.asarray(monitor_units, dtype=float) * self.output_cgy_per_mu / 100.0
+
+
+@lru_cache(maxsize=None)
+def get_peripheral_dose_table(path=PERIPHERAL_DOSE_FILE):
+    """Return the shared peripheral dose table, loading it on first use."""
+    return PeripheralDoseTable.from_file(path)
+
+
+def device_position_grid(field_size, distance, uncertainty, steps=41):
+    """Candidate device positions around a nominal position beside a square field.
+
+    The field is centred on the origin in the plane of the device; the nominal
+    device position lies distance cm beyond the middle of one field edge and
+    the grid spans +/- uncertainty cm in both directions.
+
+    Returns:
+        tuple: (x offsets, y offsets, distance from the field edge for every
+            grid point, shaped (steps, steps)) in cm
+    """
+    half = field_size / 2.0
+    x = np.linspace(half + distance - uncertainty, half + distance + uncertainty, steps)
+    y = np.linspace(-uncertainty, uncertainty, steps)
+    outside_x = np.maximum(np.abs(x)[np.newaxis, :] - half, 0.0)
+    outside_y = np.maximum(np.abs(y)[:, np.newaxis] - half, 0.0)
+    return x - half - distance, y, np.hypot(outside_x, outside_y)
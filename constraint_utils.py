@@ -0,0 +1,210 @@
+import json
+from collections import defaultdict
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+CONSTRAINTS_FILE = "data/dose_constraints.json"
+
+# Rule metrics in the constraint file
+METRICS = ("max", "mean", "dcc", "dpct", "v", "cv")
+
+# Metrics whose limit is a minimum rather than a maximum (critical volumes)
+MINIMUM_METRICS = ("cv",)
+
+
+def rule_label(rule):
+    """Short label for a rule's metric, e.g. "Dmax", "D0.03cc", "D95%", "V20Gy" or "CV15Gy"."""
+    metric, param = rule["metric"], rule["param"]
+    if metric == "max":
+        return "Dmax"
+    if metric == "mean":
+        return "Dmean"
+    if metric == "dcc":
+        return f"D{param:g}cc"
+    if metric == "dpct":
+        return f"D{param:g}%"
+    if metric == "cv":
+        return f"CV{param:g}Gy"
+    return f"V{param:g}Gy"
+
+
+def describe_rules(rules):
+    """Readable text for a list of rules, e.g. "Dmax < 21.3 Gy, V12Gy < 25%, CV15Gy ≥ 700 cc"."""
+    parts = []
+    for rule in rules:
+        unit = rule["unit"] if rule["unit"] == "%" else f" {rule['unit']}"
+        comparison = "≥" if rule["metric"] in MINIMUM_METRICS else "<"
+        parts.append(f"{rule_label(rule)} {comparison} {rule['limit']:g}{unit}")
+    return ", ".join(parts)
+
+
+class ConstraintLibrary:
+    """Dose constraints indexed by (site, organ, fractionation regime).
+
+    Every constraint keeps its reference text (as shown in the constraint
+    tabs) and a list of machine-evaluable rules. All rules are compiled into
+    flat NumPy arrays when the library is built, so evaluating DVHs against
+    them is a handful of array operations regardless of how many apply.
+    Site-independent organ limits are stored with site None.
+    """
+
+    def __init__(self, records, reference_fractions=None):
+        """Build the indexes and compile the rules.
+
+        Args:
+            records: Constraint records as stored in data/dose_constraints.json
+            reference_fractions: Dict mapping regime to the number of fractions
+                its dose limits refer to (None for 2 Gy fractions)
+        """
+        self.records = records
+        self.regime_fractions = reference_fractions or {}
+        self._by_key = {}
+        self._by_site = defaultdict(list)
+
+        rule_records, metrics, params, limits, units = [], [], [], [], []
+        for index, record in enumerate(records):
+            site = record["site"].lower() if record["site"] else None
+            key = (site, record["organ"].lower(), record["regime"])
+            self._by_key[key] = record
+            self._by_site[(site, record["regime"])].append(record)
+
+            for rule in record["rules"]:
+                if rule["metric"] not in METRICS:
+                    raise ValueError(f"Unknown constraint metric: {rule['metric']}")
+                rule_records.append(index)
+                metrics.append(rule["metric"])
+                params.append(np.nan if rule["param"] is None else rule["param"])
+                limits.append(rule["limit"])
+                units.append(rule["unit"])
+
+        self.rule_record = np.array(rule_records, dtype=int)
+        self.rule_metric = np.array(metrics, dtype=object)
+        self.rule_param = np.array(params, dtype=float)
+        self.rule_limit = np.array(limits, dtype=float)
+        self.rule_unit = np.array(units, dtype=object)
+        self._record_index = {id(record): index for index, record in enumerate(records)}
+
+    @classmethod
+    def from_file(cls, path=CONSTRAINTS_FILE):
+        """Load the library from a constraint JSON file."""
+        with open(path, "r") as file:
+            data = json.load(file)
+        return cls(data["constraints"], data.get("reference_fractions"))
+
+    def sites(self, regime):
+        """Return the sites that have constraints for a regime."""
+        return [site for site, site_regime in self._by_site if site and site_regime == regime]
+
+    def get_constraints(self, site, regime):
+        """Return the constraint records for a site and regime, in file order."""
+        return list(self._by_site.get((site.lower() if site else None, regime), []))
+
+    def get_constraint(self, site, organ, regime):
+        """Return one constraint record, or None."""
+        return self._by_key.get((site.lower() if site else None, organ.lower(), regime))
+
+    def reference_fractions(self, record):
+        """Number of fractions a record's dose limits refer to, or None for 2 Gy fractions."""
+        return record.get("fractions", self.regime_fractions.get(record["regime"]))
+
+    def get_display_constraints(self, site, regime):
+        """Return {organ: reference text} for a site and regime."""
+        return {record["organ"]: record["display"] for record in self.get_constraints(site, regime)}
+
+    def get_organ_limits(self, organ, regime):
+        """Return the site-independent limits for an organ as {metric: limit, "unit": unit}.
+
+        V metrics are keyed like "v20"; returns None if the organ has no limits
+        for the regime.
+        """
+        record = self.get_constraint(None, organ, regime)
+        if record is None:
+            return None
+
+        limits = {}
+        for rule in record["rules"]:
+            key = rule["metric"] if rule["metric"] in ("max", "mean") else f"v{rule['param']:g}"
+            limits[key] = int(rule["limit"]) if float(rule["limit"]).is_integer() else rule["limit"]
+        limits["unit"] = record["rules"][0]["unit"]
+        return limits
+
+    def evaluate(self, dvhs, site=None, regime="conventional"):
+        """Evaluate DVHs against every applicable constraint in one pass.
+
+        Args:
+            dvhs: Dict mapping structure name to a dvh_utils.DVH; names are
+                matched to constraint organs case-insensitively
+            site: Treatment site, or None for the site-independent organ limits
+            regime: "conventional", "sbrt" or "srs"
+
+        Returns:
+            pandas.DataFrame: One row per evaluated rule with the limit, value,
+                margin (how far the value is inside the limit, negative when it
+                fails) and whether it passed
+        """
+        columns = ["Organ", "Constraint", "Metric", "Limit", "Value", "Unit", "Margin", "Passed"]
+        dvh_by_organ = {name.lower(): dvh for name, dvh in dvhs.items()}
+
+        # Select the compiled rules that apply to this site, regime and the given structures
+        record_ids = {
+            self._record_index[id(record)]: dvh_by_organ[record["organ"].lower()]
+            for record in self.get_constraints(site, regime)
+            if record["organ"].lower() in dvh_by_organ
+        }
+        selected = np.flatnonzero(np.isin(self.rule_record, list(record_ids)))
+        if not selected.size:
+            return pd.DataFrame(columns=columns)
+
+        values = np.empty(selected.size)
+        metrics = self.rule_metric[selected]
+        params = self.rule_param[selected]
+        units = self.rule_unit[selected]
+        records = self.rule_record[selected]
+
+        # One vectorized DVH lookup per structure and metric type
+        for record_id, dvh in record_ids.items():
+            rows = records == record_id
+            for metric in METRICS:
+                mask = rows & (metrics == metric)
+                if not mask.any():
+                    continue
+                if metric == "max":
+                    values[mask] = dvh.max_dose
+                elif metric == "mean":
+                    values[mask] = dvh.mean_dose
+                elif metric == "dcc":
+                    values[mask] = dvh.dose_at_volume(params[mask])
+                elif metric == "dpct":
+                    values[mask] = dvh.dose_at_percent(params[mask])
+                elif metric == "cv":
+                    # Critical volume: the part of the organ below the dose level
+                    values[mask] = dvh.volume_cc - dvh.volume_at_dose(params[mask], relative=False)
+                else:
+                    relative = mask & (units == "%")
+                    absolute = mask & (units != "%")
+                    values[relative] = dvh.volume_at_dose(params[relative], relative=True)
+                    values[absolute] = dvh.volume_at_dose(params[absolute], relative=False)
+
+        limits = self.rule_limit[selected]
+        minimum = np.isin(metrics, MINIMUM_METRICS)
+        margins = np.where(minimum, values - limits, limits - values)
+        passed = np.where(minimum, values >= limits, values < limits)
+
+        return pd.DataFrame({
+            "Organ": [self.records[i]["organ"] for i in records],
+            "Constraint": [self.records[i]["display"] if "display" in self.records[i] else "" for i in records],
+            "Metric": [rule_label({"metric": m, "param": p}) for m, p in zip(metrics, params)],
+            "Limit": limits,
+            "Value": values.round(2),
+            "Unit": units,
+            "Margin": margins.round(2),
+            "Passed": passed,
+        }, columns=columns)
+
+
+@lru_cache(maxsize=None)
+def get_constraint_library(path=CONSTRAINTS_FILE):
+    """Return the shared constraint library, loading it on first use."""
+    return ConstraintLibrary.from_file(path)
@@ -0,0 +1,339 @@
+import hashlib
+import json
+import os
+import tempfile
+from collections.abc import Sequence
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pydicom
+    from pydicom.errors import InvalidDicomError
+except ImportError:  # DICOM ingestion is optional
+    pydicom = None
+
+# Index caches hold patient names and IDs, so they are kept here rather than
+# in the export folder, one file per indexed directory
+INDEX_CACHE_DIR = os.path.join(tempfile.gettempdir(), "quickwrite_dicom_index")
+INDEX_VERSION = 1
+
+# Header attributes kept in the index and how each is stored. Everything
+# else (pixel data, contours, beam sequences) is skipped while reading.
+INDEX_TAGS = {
+    "PatientID": str,
+    "PatientName": str,
+    "StudyInstanceUID": str,
+    "StudyDate": str,
+    "StudyDescription": str,
+    "SeriesInstanceUID": str,
+    "SeriesNumber": int,
+    "SeriesDescription": str,
+    "Modality": str,
+    "SOPClassUID": str,
+    "SOPInstanceUID": str,
+    "FrameOfReferenceUID": str,
+    "InstanceNumber": int,
+    "ImagePositionPatient": list,
+    "ImageOrientationPatient": list,
+    "PixelSpacing": list,
+    "SliceThickness": float,
+    "GridFrameOffsetVector": list,
+    "Rows": int,
+    "Columns": int,
+    "NumberOfFrames": int,
+    "SamplesPerPixel": int,
+    "BitsAllocated": int,
+    "PixelRepresentation": int,
+    "RescaleSlope": float,
+    "RescaleIntercept": float,
+    "DoseGridScaling": float,
+}
+
+INDEX_COLUMNS = ["Path"] + list(INDEX_TAGS) + ["TransferSyntaxUID", "PixelOffset"]
+
+SERIES_COLUMNS = [
+    "PatientID", "PatientName", "StudyInstanceUID", "StudyDate", "StudyDescription",
+    "SeriesInstanceUID", "SeriesNumber", "Modality", "SeriesDescription", "Files"
+]
+
+# Little-endian transfer syntaxes with uncompressed pixel data, which can be memory-mapped
+UNCOMPRESSED_SYNTAXES = ("1.2.840.10008.1.2", "1.2.840.10008.1.2.1")
+
+PIXEL_DATA_TAG = b"\xe0\x7f\x10\x00"
+
+
+def _require_pydicom():
+    if pydicom is None:
+        raise ImportError("pydicom is required to read DICOM files")
+
+
+def _header_value(value, kind):
+    """JSON-friendly copy of a header value, or None when it is empty."""
+    if value is None or value == "":
+        return None
+    if kind is list:
+        # A one-element multi-valued attribute is read as a bare number
+        values = value if isinstance(value, Sequence) and not isinstance(value, str) else [value]
+        return [float(item) for item in values]
+    return kind(value)
+
+
+def _pixel_offset(file, transfer_syntax):
+    """Byte offset of the uncompressed pixel data the file is positioned at, or None.
+
+    pydicom leaves the file at the start of the Pixel Data element when it
+    stops before the pixels; the element header is read here directly.
+    """
+    if transfer_syntax not in UNCOMPRESSED_SYNTAXES:
+        return None
+    start = file.tell()
+    header = file.read(12)
+    if len(header) < 8 or header[:4] != PIXEL_DATA_TAG:
+        return None
+    if header[4:6] in (b"OB", b"OW"):
+        length, value_start = int.from_bytes(header[8:12], "little"), start + 12
+    else:
+        length, value_start = int.from_bytes(header[4:8], "little"), start + 8
+    # Undefined length means encapsulated (compressed) frames
+    return None if length == 0xFFFFFFFF else value_start
+
+
+def read_header(path):
+    """Read the index attributes of one file without its pixel data.
+
+    Args:
+        path: Path to a file that may or may not be DICOM
+
+    Returns:
+        dict: Index record (INDEX_COLUMNS without "Path"), or None if the
+            file is not DICOM
+    """
+    _require_pydicom()
+    with open(path, "rb") as file:
+        try:
+            dataset = pydicom.dcmread(file, stop_before_pixels=True, specific_tags=list(INDEX_TAGS))
+        except (InvalidDicomError, EOFError, ValueError, TypeError):
+            return None
+        if "SOPInstanceUID" not in dataset:
+            return None
+
+        record = {name: _header_value(dataset.get(name), kind) for name, kind in INDEX_TAGS.items()}
+        file_meta = getattr(dataset, "file_meta", None)
+        transfer_syntax = str(file_meta.TransferSyntaxUID) if file_meta and "TransferSyntaxUID" in file_meta else None
+        record["TransferSyntaxUID"] = transfer_syntax
+        record["PixelOffset"] = _pixel_offset(file, transfer_syntax) if record["Rows"] else None
+    return record
+
+
+def _list_files(directory):
+    """(relative path, mtime in ns, size) of every file under directory, skipping hidden entries."""
+    files = []
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = sorted(name for name in dirs if not name.startswith("."))
+        for name in sorted(names):
+            if name.startswith("."):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((os.path.relpath(path, directory), stat.st_mtime_ns, stat.st_size))
+    return tuple(files)
+
+
+def _load_index_cache(index_path):
+    try:
+        with open(index_path, "r") as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return cache.get("files", {}) if cache.get("version") == INDEX_VERSION else {}
+
+
+@lru_cache(maxsize=8)
+def _build_index(directory, files, index_path):
+    """Index records for a directory listing, re-reading only new or changed files."""
+    cached = _load_index_cache(index_path)
+    entries, changed = {}, len(cached) != len(files)
+    for relative_path, mtime, size in files:
+        entry = cached.get(relative_path)
+        if entry is None or entry["mtime"] != mtime or entry["size"] != size:
+            entry = {"mtime": mtime, "size": size, "record": read_header(os.path.join(directory, relative_path))}
+            changed = True
+        entries[relative_path] = entry
+
+    if changed:
+        try:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            with open(index_path, "w") as file:
+                json.dump({"version": INDEX_VERSION, "files": entries}, file)
+        except OSError:
+            pass  # Unwritable cache: the index stays in memory only
+
+    rows = [dict(entry["record"], Path=os.path.join(directory, relative_path))
+            for relative_path, entry in entries.items() if entry["record"] is not None]
+    return pd.DataFrame(rows, columns=INDEX_COLUMNS, dtype=object)
+
+
+def index_directory(directory, index_path=None):
+    """Index every DICOM file under a directory, reading headers only.
+
+    The index is cached twice: in memory for the current directory listing,
+    and on disk (by default in INDEX_CACHE_DIR, never in the export itself)
+    with each file's modification time and size, so a rescan only reads
+    files that are new or have changed and non-DICOM files are not opened
+    again.
+
+    Args:
+        directory: Root of the DICOM export
+        index_path: Where to keep the index cache; defaults to a file in
+            INDEX_CACHE_DIR named after the directory
+
+    Returns:
+        pandas.DataFrame: One row per DICOM file (INDEX_COLUMNS)
+    """
+    _require_pydicom()
+    directory = os.path.abspath(directory)
+    if not os.path.isdir(directory):
+        raise ValueError(f"{directory} is not a directory")
+    if index_path is None:
+        digest = hashlib.sha1(directory.encode("utf-8")).hexdigest()
+        index_path = os.path.join(INDEX_CACHE_DIR, f"{digest}.json")
+    index_path = os.path.abspath(index_path)
+    return _build_index(directory, _list_files(directory), index_path).copy()
+
+
+def summarize_series(index):
+    """One row per series (SERIES_COLUMNS), ordered by patient, study date and series number."""
+    if index.empty:
+        return pd.DataFrame(columns=SERIES_COLUMNS)
+    keys = ["PatientID", "StudyInstanceUID", "SeriesInstanceUID"]
+    series = index.groupby(keys, sort=False, dropna=False).agg(
+        PatientName=("PatientName", "first"),
+        StudyDate=("StudyDate", "first"),
+        StudyDescription=("StudyDescription", "first"),
+        SeriesNumber=("SeriesNumber", "first"),
+        Modality=("Modality", "first"),
+        SeriesDescription=("SeriesDescription", "first"),
+        Files=("Path", "size"),
+    ).reset_index()
+    return series.sort_values(["PatientID", "StudyDate", "SeriesNumber"], na_position="last")[SERIES_COLUMNS]
+
+
+def _pixel_dtype(record):
+    if record["SamplesPerPixel"] not in (None, 1):
+        raise ValueError("Only single-channel (grayscale) pixel data is supported")
+    kind = "i" if record["PixelRepresentation"] else "u"
+    return np.dtype(f"<{kind}{record['BitsAllocated'] // 8}")
+
+
+class DicomVolume:
+    """The pixel data of an image series or RT Dose as a (frame, row, column) volume.
+
+    Only the geometry comes from the index; pixels are read when a frame is
+    requested. Uncompressed frames are memory-mapped straight from their
+    files, so a frame costs one small read and an untouched series costs no
+    memory; compressed files are decoded with pydicom on access.
+    """
+
+    def __init__(self, records):
+        """Order the files of one series into a volume.
+
+        Args:
+            records: Index rows (dicts) of a single series; either one
+                multi-frame file (e.g. RT Dose) or one file per slice
+        """
+        if not records or not records[0]["Rows"]:
+            raise ValueError("The series has no pixel data")
+        first = records[0]
+        orientation = np.asarray(first["ImageOrientationPatient"] or [1, 0, 0, 0, 1, 0], dtype=float)
+        normal = np.cross(orientation[:3], orientation[3:])
+        row_spacing, column_spacing = first["PixelSpacing"] or (1.0, 1.0)
+
+        if len(records) == 1:
+            frames = first["NumberOfFrames"] or 1
+            offsets = np.asarray(first["GridFrameOffsetVector"] or np.arange(frames) * (first["SliceThickness"] or 1.0))
+            self._frames = [(first, index) for index in range(frames)]
+            positions = offsets
+        else:
+            positions = np.array([np.dot(record["ImagePositionPatient"] or (0, 0, index), normal)
+                                  for index, record in enumerate(records)])
+            order = np.argsort(positions, kind="stable")
+            self._frames = [(records[index], 0) for index in order]
+            positions = positions[order]
+
+        slice_spacing = float(np.median(np.diff(positions))) if positions.size > 1 else (first["SliceThickness"] or 1.0)
+        self.shape = (len(self._frames), first["Rows"], first["Columns"])
+        self.spacing_mm = (abs(slice_spacing), float(row_spacing), float(column_spacing))
+        # Signed step between frames along the slice normal (negative for a
+        # descending GridFrameOffsetVector) and the row and column directions
+        self.slice_step_mm = slice_spacing
+        self.orientation = tuple(float(value) for value in orientation)
+        self.origin_mm = tuple(self._frames[0][0]["ImagePositionPatient"] or (0.0, 0.0, 0.0))
+        self.modality = first["Modality"]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        return self.frame(index)
+
+    def _raw_frame(self, index):
+        record, frame = self._frames[index]
+        rows, columns = self.shape[1:]
+        if record["PixelOffset"] is not None:
+            dtype = _pixel_dtype(record)
+            offset = record["PixelOffset"] + frame * rows * columns * dtype.itemsize
+            return np.memmap(record["Path"], dtype=dtype, mode="r", offset=offset, shape=(rows, columns))
+        _require_pydicom()
+        pixels = pydicom.dcmread(record["Path"]).pixel_array
+        return pixels.reshape((-1, rows, columns))[frame]
+
+    def frame(self, index):
+        """One frame in physical units (HU for CT, Gy for RT Dose) as float32."""
+        record = self._frames[index][0]
+        slope = (record["RescaleSlope"] or 1.0) * (record["DoseGridScaling"] or 1.0)
+        intercept = record["RescaleIntercept"] or 0.0
+        pixels = self._raw_frame(index).astype(np.float32)
+        if slope != 1.0:
+            pixels *= np.float32(slope)
+        if intercept:
+            pixels += np.float32(intercept)
+        return pixels
+
+    def to_array(self, out=None):
+        """Read the whole volume frame by frame.
+
+        Args:
+            out: Optional float32 array (e.g. from np.lib.format.open_memmap)
+                of the volume's shape to fill instead of a new in-memory array
+
+        Returns:
+            numpy.ndarray: The volume in physical units
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=np.float32)
+        elif out.shape != self.shape:
+            raise ValueError(f"Output has shape {out.shape}, expected {self.shape}")
+        for index in range(len(self)):
+            out[index] = self.frame(index)
+        return out
+
+
+def open_series(index, series_uid):
+    """Lazy volume for a series in an index from index_directory."""
+    rows = index[index["SeriesInstanceUID"] == series_uid]
+    if rows.empty:
+        raise ValueError(f"Series {series_uid} is not in the index")
+    return DicomVolume(rows.to_dict("records"))
+
+
+def open_dicom_file(path):
+    """Lazy volume for a single DICOM file, e.g. an RT Dose, without indexing its directory."""
+    record = read_header(path)
+    if record is None:
+        raise ValueError(f"{os.path.basename(path)} is not a DICOM file")
+    return DicomVolume([dict(record, Path=os.path.abspath(path))])
@@ -0,0 +1,214 @@
+import streamlit as st
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+# Session state keys that hold in-progress module lists, mapped to the
+# module data field they are restored from when a draft is resumed
+MODULE_STATE_KEYS = {
+    "prior_dose": ("prior_treatments", "prior_treatments"),
+    "fusion": ("registrations", "registrations"),
+    "srs": ("srs_lesions", "lesions"),
+}
+
+
+def _json_default(value):
+    """Convert values json can't serialize (e.g. numpy scalars) to plain Python."""
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return str(value)
+
+
+class DraftStore:
+    """Local checkpoint store for in-progress QuickWrite workflows.
+
+    Each draft lives in its own directory, keyed by a draft ID that is kept in
+    the page URL (``?draft=<id>``) so a reconnecting browser finds it again.
+    Every section of the workflow (common info, each module's data, results)
+    is a separate JSON file, and a section is only rewritten when its content
+    hash changes, so a checkpoint costs the same no matter how many modules
+    have already been saved.
+    """
+
+    QUERY_PARAM = "draft"
+
+    def __init__(self, base_dir=None, max_age_days=7):
+        """Initialize the store.
+
+        Args:
+            base_dir: Directory holding the drafts; defaults to the
+                QUICKWRITE_DRAFT_DIR environment variable or data/drafts
+            max_age_days: Drafts untouched for longer than this are pruned
+        """
+        self.base_dir = base_dir or os.environ.get("QUICKWRITE_DRAFT_DIR", "data/drafts")
+        self.max_age_days = max_age_days
+
+    def get_draft_id(self, create=False):
+        """Return the draft ID for this browser session.
+
+        Args:
+            create: Whether to create (and put in the URL) a new ID if none exists
+
+        Returns:
+            str: The draft ID, or None if there is none and create is False
+        """
+        draft_id = st.query_params.get(self.QUERY_PARAM)
+        if draft_id and self._is_valid_id(draft_id):
+            return draft_id
+
+        if not create:
+            return None
+
+        self._prune_old_drafts()
+        draft_id = uuid.uuid4().hex
+        st.query_params[self.QUERY_PARAM] = draft_id
+        return draft_id
+
+    def has_draft(self):
+        """Return True if a saved draft exists for this browser session."""
+        draft_id = self.get_draft_id()
+        return bool(draft_id) and os.path.exists(self._section_path(draft_id, "workflow"))
+
+    def restore(self):
+        """Load the saved draft into session state, once per session.
+
+        Returns:
+            bool: True if a draft was restored
+        """
+        if st.session_state.get("_draft_restored"):
+            return False
+        st.session_state._draft_restored = True
+
+        if not self.has_draft():
+            return False
+
+        draft_id = self.get_draft_id()
+        hashes = {}
+
+        workflow = self._read_section(draft_id, "workflow", hashes)
+        common_info = self._read_section(draft_id, "common_info", hashes)
+        results = self._read_section(draft_id, "results", hashes)
+
+        module_data = {}
+        for filename in sorted(os.listdir(self._draft_dir(draft_id))):
+            if filename.startswith("module_") and filename.endswith(".json"):
+                module_id = filename[len("module_"):-len(".json")]
+                module_data[module_id] = self._read_section(draft_id, f"module_{module_id}", hashes)
+
+        if workflow:
+            st.session_state.workflow_step = workflow.get("workflow_step", "basic_info")
+            st.session_state.selected_modules = workflow.get("selected_modules", {})
+        if common_info:
+            st.session_state.common_info = common_info
+        if module_data:
+            st.session_state.module_data = module_data
+        if results:
+            st.session_state.results = results
+
+        # Put module working lists back so editing a saved module shows its entries
+        for module_id, (state_key, data_key) in MODULE_STATE_KEYS.items():
+            if module_id in module_data and data_key in module_data[module_id]:
+                st.session_state[state_key] = module_data[module_id][data_key]
+
+        st.session_state._draft_hashes = hashes
+        return True
+
+    def checkpoint(self, *module_ids, common_info=False, results=False):
+        """Write changed workflow sections to the draft.
+
+        The workflow position is always checked; other sections are only
+        considered when requested, and any section whose content is unchanged
+        since the last checkpoint is skipped.
+
+        Args:
+            *module_ids: IDs of modules whose data should be checkpointed
+            common_info: Whether to checkpoint the common information
+            results: Whether to checkpoint the generated write-ups
+        """
+        draft_id = self.get_draft_id(create=True)
+
+        sections = {
+            "workflow": {
+                "workflow_step": st.session_state.get("workflow_step", "basic_info"),
+                "selected_modules": st.session_state.get("selected_modules", {}),
+            }
+        }
+        if common_info:
+            sections["common_info"] = st.session_state.get("common_info")
+        if results:
+            sections["results"] = st.session_state.get("results")
+
+        module_data = st.session_state.get("module_data", {})
+        for module_id in module_ids:
+            sections[f"module_{module_id}"] = module_data.get(module_id)
+
+        for name, value in sections.items():
+            self._write_section(draft_id, name, value)
+
+    def clear(self):
+        """Delete the draft for this browser session."""
+        draft_id = self.get_draft_id()
+        if draft_id:
+            shutil.rmtree(self._draft_dir(draft_id), ignore_errors=True)
+        st.session_state._draft_hashes = {}
+
+    def _write_section(self, draft_id, name, value):
+        """Write one section if its content changed; remove it if it is now empty."""
+        hashes = st.session_state.setdefault("_draft_hashes", {})
+        path = self._section_path(draft_id, name)
+
+        if value is None:
+            if name in hashes or os.path.exists(path):
+                hashes.pop(name, None)
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+
+        content = json.dumps(value, sort_keys=True, default=_json_default)
+        digest = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        if hashes.get(name) == digest:
+            return
+
+        os.makedirs(self._draft_dir(draft_id), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+        hashes[name] = digest
+
+    def _read_section(self, draft_id, name, hashes):
+        """Read one section, recording its hash; returns None if missing or unreadable."""
+        path = self._section_path(draft_id, name)
+        try:
+            with open(path, "r") as file:
+                content = file.read()
+            value = json.loads(content)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        hashes[name] = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        return value
+
+    def _prune_old_drafts(self):
+        """Remove drafts that haven't been written to within max_age_days."""
+        if not os.path.isdir(self.base_dir):
+            return
+        cutoff = time.time() - self.max_age_days * 86400
+        for entry in os.listdir(self.base_dir):
+            path = os.path.join(self.base_dir, entry)
+            if os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _draft_dir(self, draft_id):
+        return os.path.join(self.base_dir, draft_id)
+
+    def _section_path(self, draft_id, name):
+        return os.path.join(self._draft_dir(draft_id), f"{name}.json")
+
+    @staticmethod
+    def _is_valid_id(draft_id):
+        """Only accept IDs we generate, so the URL can't point outside the store."""
+        return len(draft_id) == 32 and all(c in "0123456789abcdef" for c in draft_id)
@@ -0,0 +1,201 @@
+import numpy as np
+import pandas as pd
+
+# Default dose bin width in Gy
+DEFAULT_BIN_WIDTH = 0.01
+
+
+class DVH:
+    """Dose-volume histogram for one structure.
+
+    Built from a differential histogram with fixed-width dose bins starting at
+    0 Gy. Maximum and mean dose are exact (taken from the voxels, not the
+    bins); dose and volume look-ups interpolate linearly on the cumulative
+    curve.
+    """
+
+    def __init__(self, name, bin_width, differential, volume_cc, max_dose, mean_dose, min_dose):
+        """Initialize the DVH.
+
+        Args:
+            name: Structure name
+            bin_width: Width of each dose bin in Gy
+            differential: Volume (cc) in each dose bin
+            volume_cc: Total structure volume in cc
+            max_dose: Maximum voxel dose in Gy
+            mean_dose: Volume-weighted mean dose in Gy
+            min_dose: Minimum voxel dose in Gy
+        """
+        self.name = name
+        self.bin_width = bin_width
+        self.differential = np.asarray(differential, dtype=float)
+        self.volume_cc = volume_cc
+        self.max_dose = max_dose
+        self.mean_dose = mean_dose
+        self.min_dose = min_dose
+
+    @property
+    def dose_edges(self):
+        """Lower edge of every bin plus the upper edge of the last one, in Gy."""
+        return np.arange(self.differential.size + 1) * self.bin_width
+
+    @property
+    def cumulative(self):
+        """Volume (cc) receiving at least the dose at each edge in dose_edges."""
+        return np.concatenate([np.cumsum(self.differential[::-1])[::-1], [0.0]])
+
+    def volume_at_dose(self, dose, relative=True):
+        """Vx: volume receiving at least the given dose.
+
+        Args:
+            dose: Dose in Gy (scalar or array)
+            relative: Return percent of the structure volume instead of cc
+
+        Returns:
+            float or numpy.ndarray: Volume in percent or cc
+        """
+        volume = np.interp(dose, self.dose_edges, self.cumulative)
+        if relative:
+            return volume / self.volume_cc * 100.0 if self.volume_cc else volume * 0.0
+        return volume
+
+    def dose_at_volume(self, volume_cc):
+        """D(volume): the minimum dose received by the hottest volume_cc of the structure.
+
+        Args:
+            volume_cc: Volume in cc (scalar or array), e.g. 0.03 for D0.03cc
+
+        Returns:
+            float or numpy.ndarray: Dose in Gy
+        """
+        # The cumulative curve decreases with dose, so interpolate on it reversed
+        dose = np.interp(volume_cc, self.cumulative[::-1], self.dose_edges[::-1])
+        return np.clip(dose, self.min_dose, self.max_dose)
+
+    def dose_at_percent(self, percent):
+        """Dx: the minimum dose received by the hottest percent of the structure.
+
+        Args:
+            percent: Percent of the structure volume (scalar or array), e.g. 95 for D95
+
+        Returns:
+            float or numpy.ndarray: Dose in Gy
+        """
+        return self.dose_at_volume(np.asarray(percent, dtype=float) / 100.0 * self.volume_cc)
+
+    def to_dataframe(self, relative=True):
+        """Return the cumulative DVH as a DataFrame of dose (Gy) and volume."""
+        volume = self.cumulative
+        if relative and self.volume_cc:
+            volume = volume / self.volume_cc * 100.0
+        return pd.DataFrame({
+            "Dose (Gy)": self.dose_edges,
+            "Volume (%)" if relative else "Volume (cc)": volume
+        })
+
+
+def compute_dvhs(dose, masks, voxel_volume_cc, bin_width=DEFAULT_BIN_WIDTH, chunk_slices=None):
+    """Compute DVHs for many structures in one pass over the dose grid.
+
+    Every voxel's dose bin is computed once per chunk and shared by all
+    structures; each structure then only costs a weighted bincount over its
+    own voxels. Masks may be boolean or fractional (partial-volume weights
+    between 0 and 1). Chunking along the first axis keeps memory-mapped grids
+    out of RAM.
+
+    Args:
+        dose: 3D dose array in Gy
+        masks: Dict mapping structure name to a boolean or fractional mask
+            with the same shape as dose
+        voxel_volume_cc: Volume of one voxel in cc
+        bin_width: Dose bin width in Gy
+        chunk_slices: Number of slices processed at a time (all at once if None)
+
+    Returns:
+        dict: Structure name mapped to its DVH
+    """
+    for name, mask in masks.items():
+        if mask.shape != dose.shape:
+            raise ValueError(f"Mask for {name} has shape {mask.shape}, dose grid has {dose.shape}")
+
+    chunk_slices = chunk_slices or dose.shape[0]
+    names = list(masks)
+    histograms = {name: np.zeros(0) for name in names}
+    weights_total = dict.fromkeys(names, 0.0)
+    dose_sums = dict.fromkeys(names, 0.0)
+    maxima = dict.fromkeys(names, -np.inf)
+    minima = dict.fromkeys(names, np.inf)
+
+    for start in range(0, dose.shape[0], chunk_slices):
+        chunk = slice(start, start + chunk_slices)
+        dose_chunk = np.asarray(dose[chunk], dtype=np.float64)
+        bins = np.floor(np.maximum(dose_chunk, 0.0) / bin_width).astype(np.int64)
+
+        for name in names:
+            mask = np.asarray(masks[name][chunk])
+            selected = mask > 0
+            if not selected.any():
+                continue
+            weights = mask[selected].astype(np.float64) if mask.dtype != bool else np.ones(np.count_nonzero(selected))
+            values = dose_chunk[selected]
+
+            counts = np.bincount(bins[selected], weights=weights)
+            if counts.size > histograms[name].size:
+                counts[:histograms[name].size] += histograms[name]
+                histograms[name] = counts
+            else:
+                histograms[name][:counts.size] += counts
+
+            weights_total[name] += weights.sum()
+            dose_sums[name] += (values * weights).sum()
+            maxima[name] = max(maxima[name], values.max())
+            minima[name] = min(minima[name], values.min())
+
+    dvhs = {}
+    for name in names:
+        total = weights_total[name]
+        dvhs[name] = DVH(
+            name,
+            bin_width,
+            histograms[name] * voxel_volume_cc,
+            total * voxel_volume_cc,
+            float(maxima[name]) if total else 0.0,
+            float(dose_sums[name] / total) if total else 0.0,
+            float(minima[name]) if total else 0.0
+        )
+    return dvhs
+
+
+def voxel_volume_cc(spacing_mm):
+    """Volume in cc of one voxel with the given (slice, row, column) spacing in mm."""
+    return float(np.prod(spacing_mm)) / 1000.0
+
+
+def dvh_summary(dvhs, d_cc=(0.03,), d_percent=(95,), v_gy=()):
+    """Tabulate common DVH metrics for a batch of structures.
+
+    Args:
+        dvhs: Dict mapping structure name to DVH
+        d_cc: Absolute volumes (cc) for Dcc metrics
+        d_percent: Relative volumes (%) for Dx metrics
+        v_gy: Doses (Gy) for relative Vx metrics
+
+    Returns:
+        pandas.DataFrame: One row per structure
+    """
+    rows = []
+    for name, dvh in dvhs.items():
+        row = {
+            "Structure": name,
+            "Volume (cc)": round(dvh.volume_cc, 2),
+            "Dmax (Gy)": round(dvh.max_dose, 2),
+            "Dmean (Gy)": round(dvh.mean_dose, 2),
+        }
+        for cc in d_cc:
+            row[f"D{cc:g}cc (Gy)"] = round(float(dvh.dose_at_volume(cc)), 2)
+        for percent in d_percent:
+            row[f"D{percent:g}% (Gy)"] = round(float(dvh.dose_at_percent(percent)), 2)
+        for dose in v_gy:
+            row[f"V{dose:g}Gy (%)"] = round(float(dvh.volume_at_dose(dose)), 1)
+        rows.append(row)
+    return pd.DataFrame(rows)
@@ -0,0 +1,206 @@
+import json
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from cied_utils import DOSE_CATEGORY_EDGES, dose_category_index
+
+DETECTORS_FILE = "data/invivo_detectors.json"
+
+
+@lru_cache(maxsize=None)
+def load_detector_models(path=DETECTORS_FILE):
+    """Return the in-vivo detector models, loading them on first use."""
+    with open(path, "r") as file:
+        return json.load(file)["detectors"]
+
+
+def fading_factor(hours, amplitude, time_constant_h):
+    """Fraction of the detector signal left when read the given hours after irradiation."""
+    hours = np.maximum(np.asarray(hours, dtype=float), 0.0)
+    return 1.0 - amplitude * (1.0 - np.exp(-hours / time_constant_h))
+
+
+def corrected_dose(readings, hours, detector, calibration=None, background=0.0, element_factors=1.0):
+    """Convert raw detector readings to dose with calibration and fading corrections.
+
+    Args:
+        readings: Raw readings (scalar or array)
+        hours: Hours between irradiation and readout, broadcast with readings
+        detector: Name of a detector in data/invivo_detectors.json
+        calibration: Dose per unit reading; defaults to the detector's value
+        background: Unirradiated (control) reading subtracted from each reading
+        element_factors: Individual detector sensitivity corrections
+
+    Returns:
+        numpy.ndarray: Dose in Gy
+    """
+    models = load_detector_models()
+    if detector not in models:
+        raise ValueError(f"Unknown detector: {detector}")
+    model = models[detector]
+    if calibration is None:
+        calibration = model["default_calibration"]
+
+    net = np.asarray(readings, dtype=float) - background
+    fading = fading_factor(hours, model["fading"]["amplitude"], model["fading"]["time_constant_h"])
+    return net * np.asarray(element_factors, dtype=float) * calibration / fading
+
+
+class MeasurementLog:
+    """Per-fraction in-vivo dose to a device with running totals.
+
+    Readings are corrected in one vectorized pass per batch, averaged per
+    fraction over the detectors placed on the device, and folded into
+    running aggregates, so each new reading updates the cumulative dose,
+    the end-of-course projection and the threshold alerts without
+    revisiting earlier fractions.
+    """
+
+    def __init__(self, planned_fractions, detector, calibration=None, background=0.0, thresholds=DOSE_CATEGORY_EDGES):
+        """Start an empty log.
+
+        Args:
+            planned_fractions: Number of fractions in the course
+            detector: Name of a detector in data/invivo_detectors.json
+            calibration: Dose per unit reading; defaults to the detector's value
+            background: Unirradiated (control) reading
+            thresholds: Cumulative dose thresholds in Gy (the TG-203 category edges by default)
+        """
+        if planned_fractions < 1:
+            raise ValueError("The course needs at least one fraction")
+        if detector not in load_detector_models():
+            raise ValueError(f"Unknown detector: {detector}")
+        self.planned_fractions = int(planned_fractions)
+        self.detector = detector
+        self.calibration = load_detector_models()[detector]["default_calibration"] if calibration is None else calibration
+        self.background = background
+        self.thresholds = tuple(sorted(thresholds))
+
+        self.cumulative_dose = 0.0
+        self.alerts = []
+        self._sum_squares = 0.0
+        self._rows = []
+        self._logged = set()
+        self._measured_category = 0
+        self._projected_category = 0
+
+    @property
+    def fractions_measured(self):
+        return len(self._rows)
+
+    @property
+    def mean_fraction_dose(self):
+        """Mean measured dose per fraction in Gy (0 before the first reading)."""
+        return self.cumulative_dose / self.fractions_measured if self._rows else 0.0
+
+    @property
+    def fraction_dose_sd(self):
+        """Sample standard deviation of the per-fraction doses in Gy."""
+        n = self.fractions_measured
+        if n < 2:
+            return 0.0
+        return float(np.sqrt(max(self._sum_squares - n * self.mean_fraction_dose ** 2, 0.0) / (n - 1)))
+
+    @property
+    def projected_dose(self):
+        """Cumulative dose plus the mean fraction dose for every remaining fraction."""
+        remaining = max(self.planned_fractions - self.fractions_measured, 0)
+        return self.cumulative_dose + self.mean_fraction_dose * remaining
+
+    def add_fraction(self, fraction, readings, hours, element_factors=1.0):
+        """Log the readings of the detectors on the device for one fraction.
+
+        Returns:
+            list: Alerts raised by this fraction
+        """
+        readings = np.atleast_1d(np.asarray(readings, dtype=float))
+        return self.add_readings(np.full(readings.size, fraction), readings, hours, element_factors)
+
+    def add_readings(self, fractions, readings, hours, element_factors=1.0):
+        """Log readings for one or more new fractions, e.g. from an imported reader export.
+
+        Args:
+            fractions: Fraction number of each reading
+            readings: Raw detector readings
+            hours: Hours between irradiation and readout for each reading
+            element_factors: Individual detector sensitivity corrections
+
+        Returns:
+            list: Alert dicts ("fraction", "threshold", "kind", "dose", "message")
+                raised by these readings, in fraction order
+        """
+        fractions = np.atleast_1d(np.asarray(fractions, dtype=int))
+        doses = np.broadcast_to(
+            corrected_dose(readings, hours, self.detector, self.calibration, self.background, element_factors),
+            fractions.shape
+        )
+
+        new_fractions, inverse, counts = np.unique(fractions, return_inverse=True, return_counts=True)
+        if new_fractions.size == 0:
+            return []
+        if new_fractions[0] < 1 or new_fractions[-1] > self.planned_fractions:
+            raise ValueError(f"Fraction numbers must be between 1 and {self.planned_fractions}")
+        repeated = sorted(self._logged.intersection(new_fractions.tolist()))
+        if repeated:
+            raise ValueError(f"Fraction(s) already logged: {', '.join(map(str, repeated))}")
+
+        # Mean dose over the detectors of each fraction, then running totals after each one
+        fraction_doses = np.bincount(inverse.ravel(), weights=doses.ravel()) / counts
+        measured = self.fractions_measured + np.arange(1, new_fractions.size + 1)
+        cumulative = self.cumulative_dose + np.cumsum(fraction_doses)
+        projected = cumulative + cumulative / measured * np.maximum(self.planned_fractions - measured, 0)
+
+        alerts = (
+            self._crossings(new_fractions, cumulative, "measured")
+            + self._crossings(new_fractions, projected, "projected")
+        )
+        alerts.sort(key=lambda alert: (alert["fraction"], alert["kind"] == "measured"))
+
+        self.cumulative_dose = float(cumulative[-1])
+        self._sum_squares += float(np.sum(fraction_doses ** 2))
+        self._logged.update(new_fractions.tolist())
+        self._rows.extend(zip(new_fractions.tolist(), counts.tolist(), fraction_doses.tolist(),
+                              cumulative.tolist(), projected.tolist()))
+        self.alerts.extend(alerts)
+        return alerts
+
+    def _crossings(self, fractions, doses, kind):
+        """Alerts for thresholds first reached by a running dose series."""
+        attribute = "_measured_category" if kind == "measured" else "_projected_category"
+        previous = getattr(self, attribute)
+        categories = np.maximum.accumulate(dose_category_index(doses, self.thresholds))
+
+        alerts = []
+        for level in range(previous, int(categories[-1])):
+            index = int(np.argmax(categories > level))
+            threshold = self.thresholds[level]
+            if kind == "measured":
+                message = (f"Fraction {fractions[index]}: cumulative device dose of {doses[index]:.2f} Gy "
+                           f"has passed the {threshold:g} Gy threshold")
+            else:
+                message = (f"Fraction {fractions[index]}: projected end-of-course device dose of "
+                           f"{doses[index]:.2f} Gy exceeds the {threshold:g} Gy threshold")
+            alerts.append({"fraction": int(fractions[index]), "threshold": threshold, "kind": kind,
+                           "dose": float(doses[index]), "message": message})
+        setattr(self, attribute, max(previous, int(categories[-1])))
+        return alerts
+
+    def to_frame(self):
+        """Logged fractions in the order they were added."""
+        return pd.DataFrame(self._rows, columns=[
+            "Fraction", "Detectors", "Fraction Dose (Gy)", "Cumulative Dose (Gy)", "Projected Dose (Gy)"
+        ])
+
+    def summary(self):
+        """Plain dict of the running totals and alert messages for the write-up."""
+        return {
+            "detector": self.detector,
+            "fractions_measured": self.fractions_measured,
+            "planned_fractions": self.planned_fractions,
+            "mean_fraction_dose": round(self.mean_fraction_dose, 3),
+            "cumulative_dose": round(self.cumulative_dose, 2),
+            "projected_dose": round(self.projected_dose, 2),
+            "alerts": [alert["message"] for alert in self.alerts],
+        }
@@ -56,6 +56,17 @@ class BaseWriteUpModule(ABC):
         """Return a list of required field names for this module."""
         pass
     
+    def apply_prefill(self, data):
+        """Seed the module's form inputs with prefilled module data.
+        
+        Called before the form is drawn, e.g. with values taken from a
+        treatment plan. Modules that cannot be prefilled ignore it.
+        
+        Args:
+            data: Partial module data (the fields render_specialized_fields returns)
+        """
+        pass
+    
     def display_write_up(self, write_up):
         """Display the generated write-up with a copy button."""
         if write_up:
@@ -1,5 +1,7 @@
 import streamlit as st
+import pandas as pd
 from datetime import datetime
+from respiratory_utils import detect_breath_holds, summarize_breath_holds
 from .base_module import BaseWriteUpModule
 
 class DIBHModule(BaseWriteUpModule):
@@ -62,6 +64,10 @@ class DIBHModule(BaseWriteUpModule):
                 elif dose_per_fraction < 1.5:
                     st.info(f"Dose per fraction ({dose_per_fraction:.2f} Gy) indicates hypofractionation")
         
+        # Breath-hold reproducibility from the respiratory trace
+        with st.expander("Breath-Hold Analysis"):
+            breath_hold_stats = self._render_breath_hold_analysis()
+        
         # Check if we have all required information
         all_fields_filled = all([
             treatment_site != "", 
@@ -92,7 +98,8 @@ class DIBHModule(BaseWriteUpModule):
                 "dose": dose,
                 "fractions": fractions,
                 "immobilization_device": immobilization_device,
-                "dose_per_fraction": dose / fractions if fractions > 0 else 0
+                "dose_per_fraction": dose / fractions if fractions > 0 else 0,
+                "breath_hold_stats": breath_hold_stats
             }
         
         return None
@@ -142,6 +149,10 @@ class DIBHModule(BaseWriteUpModule):
         write_up += f"DIBH CT simulation scan was then acquired. The DIBH CT simulation scan was approved "
         write_up += f"by the Radiation Oncologist, Dr. {physician}.\n\n"
         
+        breath_hold_stats = module_data.get("breath_hold_stats")
+        if breath_hold_stats:
+            write_up += self._generate_breath_hold_text(breath_hold_stats)
+        
         write_up += f"A radiation treatment plan was developed on the DIBH CT simulation to deliver a "
         write_up += f"prescribed dose of {dose} Gy in {fractions} fractions ({dose_per_fraction:.2f} Gy per fraction) "
         write_up += f"to the {treatment_site} using {fractionation_description}. "
@@ -154,6 +165,67 @@ class DIBHModule(BaseWriteUpModule):
         
         return write_up
     
+    def _render_breath_hold_analysis(self):
+        """Analyze an exported respiratory trace and return its breath-hold statistics (or None)."""
+        st.markdown("Upload an exported breathing trace (CSV with time in s and amplitude in mm, "
+                    "optionally a session or fraction column) to quantify breath-hold stability.")
+        trace_file = st.file_uploader("Respiratory Trace (CSV)", type=["csv"], key="dibh_trace_file")
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            min_duration = st.number_input("Minimum Breath Hold (s)", min_value=1.0, value=5.0, step=0.5,
+                                           key="dibh_min_hold")
+        with col2:
+            max_velocity = st.number_input("Plateau Velocity Limit (mm/s)", min_value=0.1, value=1.0, step=0.1,
+                                           key="dibh_max_velocity")
+        with col3:
+            tolerance = st.number_input("Stability Tolerance (mm)", min_value=0.1, value=2.0, step=0.1,
+                                        key="dibh_tolerance")
+        
+        if trace_file and st.button("Analyze Trace", key="dibh_analyze_trace"):
+            with st.spinner("Detecting breath holds..."):
+                try:
+                    holds = detect_breath_holds(trace_file, min_duration_s=min_duration, max_velocity=max_velocity)
+                    sessions, summary = summarize_breath_holds(holds, tolerance)
+                    st.session_state.dibh_breath_holds = {"holds": holds, "sessions": sessions, "summary": summary}
+                except (ValueError, pd.errors.ParserError) as e:
+                    st.error(f"Could not analyze the trace: {e}")
+        
+        analysis = st.session_state.get("dibh_breath_holds")
+        if not analysis:
+            return None
+        summary = analysis["summary"]
+        if not summary:
+            st.warning("No breath holds were found in the trace.")
+            return None
+        
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Breath Holds", summary["breath_holds"])
+        col2.metric("Intra-Hold SD", f"{summary['intra_hold_sd']:.2f} mm")
+        col3.metric("Inter-Hold SD", "—" if summary["inter_hold_sd"] is None else f"{summary['inter_hold_sd']:.2f} mm")
+        col4.metric("Within Tolerance", f"{summary['within_tolerance']:.0f}%")
+        st.dataframe(analysis["sessions"], hide_index=True)
+        with st.expander("Individual Breath Holds"):
+            st.dataframe(analysis["holds"].round(2), hide_index=True)
+        
+        use_stats = st.checkbox("Include in write-up", value=True, key="dibh_use_breath_holds")
+        return summary if use_stats else None
+    
+    def _generate_breath_hold_text(self, stats):
+        """Write-up paragraph for the breath-hold statistics."""
+        session_text = f" over {stats['sessions']} sessions" if stats["sessions"] > 1 else ""
+        text = f"Analysis of the exported breathing trace identified {stats['breath_holds']} breath holds{session_text} "
+        text += f"with a mean duration of {stats['mean_duration']} s. Within a breath hold the amplitude varied by "
+        text += f"{stats['intra_hold_sd']} mm (mean SD) with a mean drift of {stats['mean_drift']} mm "
+        text += f"(maximum {stats['max_drift']} mm)"
+        if stats["inter_hold_sd"] is not None:
+            text += f", and the breath-hold level was reproducible to {stats['inter_hold_sd']} mm (SD) between breath holds"
+        if stats["inter_session_sd"] is not None:
+            text += f" and {stats['inter_session_sd']} mm between sessions"
+        text += f". {stats['within_tolerance']}% of breath holds stayed within the {stats['tolerance_mm']} mm "
+        text += "stability tolerance.\n\n"
+        return text
+    
     def render_dibh_form(self):
         """Legacy compatibility method for standalone operation."""
         # Staff information
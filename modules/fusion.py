@@ -1,5 +1,12 @@
 import streamlit as st
+import numpy as np
+import pandas as pd
 from .base_module import BaseWriteUpModule
+from registration_utils import (
+    rigid_transform, registration_metrics, landmark_errors, summarize_registration, load_dvf, analyze_dvf,
+    summarize_dvf
+)
+from utils import file_source_input, file_source_path
 
 class FusionModule(BaseWriteUpModule):
     """Fusion module for clinical documentation generation."""
@@ -109,6 +116,9 @@ class FusionModule(BaseWriteUpModule):
                             if st.button("🗑️", key=f"delete_reg_{i}_{reg['secondary']}"):
                                 st.session_state.registrations.pop(i)
                                 st.rerun()
+                        
+                        with st.expander(f"Registration QA: CT / {reg['secondary']}"):
+                            self._render_registration_qa(i, reg)
             
             # Add new registration
             st.markdown("#### Add New Registration")
@@ -160,6 +170,127 @@ class FusionModule(BaseWriteUpModule):
         
         return None
     
+    def _render_registration_qa(self, index, reg):
+        """Score a registration from the image volumes and its rigid transform."""
+        st.caption("Upload both image volumes (.npy) and enter the rigid transform from CT to "
+                   f"{reg['secondary']} coordinates. Landmarks are an optional CSV with primary_z, primary_y, "
+                   "primary_x, secondary_z, secondary_y, secondary_x in mm.")
+        col1, col2 = st.columns(2)
+        with col1:
+            primary_file = file_source_input("CT Volume", ["npy"], f"qa_primary_{index}")
+            primary_spacing = self._spacing_inputs("CT", (2.5, 1.0, 1.0), f"qa_primary_spacing_{index}")
+        with col2:
+            secondary_file = file_source_input(f"{reg['secondary']} Volume", ["npy"], f"qa_secondary_{index}")
+            secondary_spacing = self._spacing_inputs(reg["secondary"], (2.5, 1.0, 1.0), f"qa_secondary_spacing_{index}")
+        
+        st.markdown("**Rigid Transform** (slice, row, column axes)")
+        cols = st.columns(6)
+        translation = [cols[i].number_input(f"Shift {axis} (mm)", value=0.0, step=0.5, key=f"qa_shift_{index}_{i}")
+                       for i, axis in enumerate(["S", "R", "C"])]
+        rotation = [cols[3 + i].number_input(f"Rotate {axis} (°)", value=0.0, step=0.5, key=f"qa_rotate_{index}_{i}")
+                    for i, axis in enumerate(["S", "R", "C"])]
+        landmark_file = st.file_uploader("Landmarks (CSV)", type=["csv"], key=f"qa_landmarks_{index}")
+        
+        if primary_file and secondary_file and st.button("Compute QA Metrics", key=f"qa_compute_{index}"):
+            with st.spinner("Scoring registration..."):
+                try:
+                    primary = np.load(file_source_path(primary_file, ["npy"]), mmap_mode="r")
+                    secondary = np.load(file_source_path(secondary_file, ["npy"]), mmap_mode="r")
+                    if primary.ndim != 3 or secondary.ndim != 3:
+                        raise ValueError("Both image volumes must be 3D")
+                    
+                    # Rotations are about the centre of the CT volume
+                    center = (np.array(primary.shape) - 1) / 2 * np.array(primary_spacing)
+                    matrix = rigid_transform(rotation, translation, center)
+                    metrics = registration_metrics(primary, secondary, matrix, primary_spacing, secondary_spacing)
+                    
+                    errors = None
+                    if landmark_file:
+                        landmarks = pd.read_csv(landmark_file, skipinitialspace=True)
+                        landmarks.columns = [str(column).strip().lower() for column in landmarks.columns]
+                        errors = landmark_errors(
+                            landmarks[[f"primary_{axis}" for axis in "zyx"]].to_numpy(),
+                            landmarks[[f"secondary_{axis}" for axis in "zyx"]].to_numpy(),
+                            matrix
+                        )
+                    reg["qa"] = summarize_registration(metrics, errors)
+                except KeyError as e:
+                    st.error(f"Landmark file is missing column {e}")
+                except (ValueError, OSError, pd.errors.ParserError) as e:
+                    st.error(f"Could not score the registration: {e}")
+        
+        if reg["method"] == "Deformable":
+            self._render_dvf_qa(index, reg)
+        
+        qa = reg.get("qa")
+        if qa:
+            cols = st.columns(3)
+            cols[0].metric("Mutual Information", f"{qa['mutual_information']:.3f} bits")
+            cols[1].metric("NCC", f"{qa['ncc']:.3f}")
+            cols[2].metric("Mean TRE", f"{qa['tre_mean']:.2f} mm" if "tre_mean" in qa else "—")
+            st.caption(f"Evaluated on every {qa['factor']}th CT voxel ({qa['samples']:,} samples).")
+    
+    def _render_dvf_qa(self, index, reg):
+        """Jacobian and displacement statistics of a deformable registration's vector field."""
+        st.markdown("**Deformation Vector Field**")
+        st.caption("A .npy of displacements in mm on the CT grid, with the (slice, row, column) components "
+                   "on the last or first axis. It is read in slabs, so give large fields as a local path "
+                   "rather than uploading them.")
+        dvf_file = file_source_input("DVF", ["npy"], f"qa_dvf_{index}")
+        dvf_spacing = self._spacing_inputs("DVF", (2.5, 1.0, 1.0), f"qa_dvf_spacing_{index}")
+        
+        if dvf_file and st.button("Analyze DVF", key=f"qa_analyze_dvf_{index}"):
+            with st.spinner("Computing Jacobian determinants..."):
+                try:
+                    reg["dvf_qa"] = summarize_dvf(analyze_dvf(load_dvf(file_source_path(dvf_file, ["npy"])), dvf_spacing))
+                except (ValueError, OSError) as e:
+                    st.error(f"Could not analyze the deformation field: {e}")
+        
+        dvf_qa = reg.get("dvf_qa")
+        if dvf_qa:
+            cols = st.columns(4)
+            cols[0].metric("Jacobian Range", f"{dvf_qa['jacobian_min']:.2f} – {dvf_qa['jacobian_max']:.2f}")
+            cols[1].metric("Folding", f"{dvf_qa['folding_percent']:.3f}%")
+            cols[2].metric("Displacement P95", f"{dvf_qa['magnitude_p95']:.1f} mm")
+            cols[3].metric("Displacement Max", f"{dvf_qa['magnitude_max']:.1f} mm")
+            if dvf_qa["folding_percent"] > 0:
+                st.warning("The deformation folds (Jacobian ≤ 0) in part of the volume; review the registration there.")
+            if dvf_qa.get("nonfinite_voxels"):
+                st.warning(f"{dvf_qa['nonfinite_voxels']:,} voxels have non-finite displacements or Jacobians "
+                           "and were left out of these statistics.")
+    
+    def _spacing_inputs(self, label, defaults, key):
+        """Three voxel spacing inputs (slice, row, column) in one row."""
+        cols = st.columns(3)
+        return [
+            cols[i].number_input(f"{label} {axis} (mm)", min_value=0.1, value=default, step=0.5, key=f"{key}_{i}")
+            for i, (axis, default) in enumerate(zip(["Slice", "Row", "Column"], defaults))
+        ]
+    
+    def _dvf_qa_text(self, dvf_qa):
+        """Sentence with the deformation vector field QA of a deformable registration."""
+        if dvf_qa["folding_percent"] > 0:
+            folding = f"{dvf_qa['folding_percent']:.3f}% of voxels folded (Jacobian ≤ 0)"
+        else:
+            folding = "no folding"
+        text = (f"The deformation vector field had a Jacobian determinant between {dvf_qa['jacobian_min']:.2f} "
+                f"and {dvf_qa['jacobian_max']:.2f} (mean {dvf_qa['jacobian_mean']:.2f}) with {folding}, and "
+                f"displacements of {dvf_qa['magnitude_p50']:.1f} mm (median), {dvf_qa['magnitude_p95']:.1f} mm "
+                f"(95th percentile) and {dvf_qa['magnitude_max']:.1f} mm (maximum).")
+        if dvf_qa.get("nonfinite_voxels"):
+            text += (f" {dvf_qa['nonfinite_voxels']:,} voxels with non-finite values were excluded "
+                     "from the analysis.")
+        return text
+    
+    def _registration_qa_text(self, qa):
+        """Sentence with the quantitative QA of one registration."""
+        text = (f"Registration quality was quantified over the overlapping volume with a mutual information of "
+                f"{qa['mutual_information']:.3f} bits and a normalized cross-correlation of {qa['ncc']:.3f}")
+        if "tre_mean" in qa:
+            text += (f"; the mean target registration error over {qa['landmarks']} landmarks was "
+                     f"{qa['tre_mean']:.2f} mm (maximum {qa['tre_max']:.2f} mm)")
+        return text + "."
+    
     def generate_write_up(self, common_info, module_data):
         """Generate the Fusion write-up based on common and module-specific data."""
         # Implementation remains the same
@@ -235,6 +366,10 @@ class FusionModule(BaseWriteUpModule):
                 reg_text += f"The CT and {secondary} image sets were initially aligned using a rigid registration algorithm based on the {anatomical_region} anatomy. A deformable image registration was then performed to improve registration results. "
                 
             reg_text += f"The resulting registration of the fused images was verified for accuracy using anatomical landmarks such as the {lesion}."
+            if reg.get("qa"):
+                reg_text += " " + self._registration_qa_text(reg["qa"])
+            if method == "Deformable" and reg.get("dvf_qa"):
+                reg_text += " " + self._dvf_qa_text(reg["dvf_qa"])
         
         # Conclusion text
         conclusion_text = " The fused images were used to improve the identification of critical structures and targets and to accurately contour them for treatment planning."
@@ -1,5 +1,23 @@
 import streamlit as st
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
 from .base_module import BaseWriteUpModule
+from cied_utils import (
+    calculate_risk_level, stratify_devices, dose_category_index, dose_category_margin, device_position_grid,
+    get_peripheral_dose_table, DOSE_CATEGORIES, DOSE_CATEGORY_EDGES
+)
+from invivo_utils import MeasurementLog, load_detector_models
+
+# Starting distance from the field edge (cm) for the peripheral dose estimate
+FIELD_DISTANCE_DEFAULT_CM = {
+    "More than 10 cm from treatment field edge": 12.0,
+    "Less than 10 cm from field edge but not in direct field": 6.0,
+    "Within 3 cm of field edge": 2.0,
+}
+
+# Columns of a batch device review CSV
+BATCH_COLUMNS = ("pacing_dependent", "neutron_producing", "tps_max_dose", "field_distance")
 
 class PacemakerModule(BaseWriteUpModule):
     """Pacemaker module for clinical documentation generation.
@@ -151,6 +169,12 @@ class PacemakerModule(BaseWriteUpModule):
                                               step=0.01,
                                               key="tps_mean_dose")
             
+            # Without a TPS dose, estimate the peripheral dose at the device
+            peripheral_max_dose = None
+            if tps_max_dose == 0.0:
+                with st.expander("Peripheral Dose Estimate", expanded=True):
+                    peripheral_max_dose = self._render_peripheral_dose_estimate(field_distance, fractions)
+            
             # OSLD measurement
             st.markdown("#### Dosimetry Measurements")
             osld_mean_dose = st.number_input("OSLD Measured Mean Dose (Gy)", 
@@ -159,41 +183,33 @@ class PacemakerModule(BaseWriteUpModule):
                                            value=0.0,
                                            step=0.01,
                                            key="osld_mean_dose")
+            
+            with st.expander("Per-Fraction Measurement Log"):
+                measurement_summary = self._render_measurement_log(fractions)
         
         with risk_tab:
+            estimated_max_dose, dose_source = None, None
             # Auto-calculate risk level based on inputs
             if 'field_distance' in st.session_state and 'pacing_dependent' in st.session_state and 'tps_max_dose' in st.session_state and 'neutron_producing' in st.session_state:
                 st.markdown("#### Risk Assessment Results")
                 
-                # Calculate max dose based on field distance if TPS dose not available
-                estimated_max_dose = tps_max_dose
-                if tps_max_dose == 0.0:
-                    if "More than 10 cm" in field_distance:
-                        estimated_max_dose = 0.5  # Estimated < 2 Gy
-                    elif "Less than 10 cm" in field_distance:
-                        estimated_max_dose = 1.5  # Estimated < 2 Gy
-                    elif "Within 3 cm" in field_distance:
-                        estimated_max_dose = 3.0  # Estimated 2-5 Gy
-                    elif "direct beam" in field_distance:
-                        estimated_max_dose = 7.0  # Estimated > 5 Gy
-                
-                # Determine dose category
-                if estimated_max_dose < 2.0:
-                    dose_category = "< 2 Gy"
-                elif 2.0 <= estimated_max_dose <= 5.0:
-                    dose_category = "2-5 Gy"
+                # Estimate the max dose from the peripheral dose model, or the field distance,
+                # if no TPS dose is available
+                assessment = stratify_devices(
+                    [pacing_dependent], [neutron_producing],
+                    [tps_max_dose if peripheral_max_dose is None else peripheral_max_dose], [field_distance]
+                ).iloc[0]
+                estimated_max_dose = round(float(assessment["Estimated Max Dose (Gy)"]), 2)
+                if tps_max_dose > 0:
+                    dose_source = "tps"
+                elif peripheral_max_dose:
+                    dose_source = "peripheral_model"
+                elif estimated_max_dose > 0:
+                    dose_source = "field_distance"
                 else:
-                    dose_category = "> 5 Gy"
-                
-                # Determine if patient is pacing dependent
-                is_pacing_dependent = pacing_dependent == "Yes"
-                
-                # Calculate risk level based on TG212 diagram
-                risk_level = self._calculate_risk_level(
-                    is_pacing_dependent=is_pacing_dependent,
-                    dose_category=dose_category,
-                    neutron_producing=neutron_producing == "Yes"
-                )
+                    dose_source = "tps"
+                dose_category = assessment["Dose Category"]
+                risk_level = assessment["Risk Level"]
                 
                 # Display calculated parameters
                 col1, col2 = st.columns(2)
@@ -233,6 +249,9 @@ class PacemakerModule(BaseWriteUpModule):
                 st.session_state.risk_level = risk_level
             else:
                 st.info("Please fill in the Treatment & Device Details tabs first to see the risk assessment.")
+            
+            with st.expander("Batch Device Review"):
+                self._render_batch_review()
         
         # Validation: Check if required fields are filled
         required_fields = {
@@ -266,7 +285,10 @@ class PacemakerModule(BaseWriteUpModule):
                 "neutron_producing": neutron_producing,
                 "tps_max_dose": tps_max_dose,
                 "tps_mean_dose": tps_mean_dose,
+                "estimated_max_dose": estimated_max_dose,
+                "estimated_dose_source": dose_source,
                 "osld_mean_dose": osld_mean_dose,
+                "measurement_log": measurement_summary,
                 "risk_level": risk_level
             }
             
@@ -290,6 +312,10 @@ class PacemakerModule(BaseWriteUpModule):
         risk_level = module_data.get("risk_level", "")
         tps_max_dose = module_data.get("tps_max_dose", 0)
         tps_mean_dose = module_data.get("tps_mean_dose", 0)
+        estimated_max_dose = module_data.get("estimated_max_dose")
+        dose_source = module_data.get("estimated_dose_source") or "tps"
+        if estimated_max_dose is None:
+            estimated_max_dose = tps_max_dose
         osld_mean_dose = module_data.get("osld_mean_dose", 0)
         
         # Format model and serial info
@@ -317,9 +343,24 @@ class PacemakerModule(BaseWriteUpModule):
         write_up += f"The patient has a {device_info} from {device_vendor}. {pacing_text}\n\n"
         
         write_up += "Our treatment plan follows the guidelines of the manufacturer for radiation therapy. "
-        write_up += "No primary radiation fields intercept the pacemaker. The device was contoured in the treatment planning system. "
-        write_up += f"The maximum dose to the device was {tps_max_dose} Gy, with a mean dose of {tps_mean_dose} Gy, "
-        write_up += "which is well below the AAPM recommended total dose of 2 Gy.\n\n"
+        write_up += "No primary radiation fields intercept the pacemaker. "
+        if dose_source == "peripheral_model":
+            write_up += "No planned dose to the device was available, so the maximum dose to the device was estimated "
+            write_up += f"at {estimated_max_dose:g} Gy from out-of-field peripheral dose data for the worst-case device position"
+        elif dose_source == "field_distance":
+            write_up += "No planned dose to the device was available, so the maximum dose to the device was estimated "
+            write_up += f"at {estimated_max_dose:g} Gy from its distance to the treatment field edge"
+        else:
+            write_up += "The device was contoured in the treatment planning system. "
+            write_up += f"The maximum dose to the device was {tps_max_dose} Gy, with a mean dose of {tps_mean_dose} Gy"
+        
+        # AAPM TG-203 recommends keeping the cumulative device dose under 2 Gy
+        if estimated_max_dose <= 1.0:
+            write_up += ", which is well below the AAPM recommended total dose of 2 Gy.\n\n"
+        elif estimated_max_dose < 2.0:
+            write_up += ", which is below the AAPM recommended total dose of 2 Gy.\n\n"
+        else:
+            write_up += ", which exceeds the AAPM recommended total dose of 2 Gy.\n\n"
         
         write_up += "One potential complication with any pacemaker is that radiation could induce an increased sensor rate. "
         
@@ -336,8 +377,21 @@ class PacemakerModule(BaseWriteUpModule):
             write_up += "The patient had their device interrogated before the start of treatment and will have it "
             write_up += "interrogated again in the middle of treatment and after the end of treatment."
         
-        # OSLD measurements
-        if osld_mean_dose > 0:
+        # In-vivo measurements: the per-fraction log takes precedence over a single mean reading
+        measurement_log = module_data.get("measurement_log")
+        if measurement_log:
+            write_up += f"\n\n{measurement_log['detector']} detectors were placed on the patient's skin over the device and read "
+            write_up += f"after each fraction. Over the first {measurement_log['fractions_measured']} of "
+            write_up += f"{measurement_log['planned_fractions']} fractions the device received a mean dose of "
+            write_up += f"{measurement_log['mean_fraction_dose']} Gy per fraction, for a cumulative dose of "
+            write_up += f"{measurement_log['cumulative_dose']:.2f} Gy"
+            if measurement_log["fractions_measured"] < measurement_log["planned_fractions"]:
+                write_up += f" and a projected end-of-course dose of {measurement_log['projected_dose']:.2f} Gy"
+            write_up += "."
+            if measurement_log["alerts"]:
+                write_up += " The following dose thresholds were flagged during treatment: "
+                write_up += "; ".join(measurement_log["alerts"]) + "."
+        elif osld_mean_dose > 0:
             write_up += "\n\nOptically stimulated luminescence dosimeters (OSLDs) were placed on the patient's skin to record "
             write_up += f"the radiation dose to the device. The average dose received by these OSLDs was {osld_mean_dose} Gy, "
             total_osld = osld_mean_dose * fractions
@@ -350,33 +404,199 @@ class PacemakerModule(BaseWriteUpModule):
     
     def _calculate_risk_level(self, is_pacing_dependent, dose_category, neutron_producing):
         """Calculate the risk level based on the TG-203 algorithm."""
-        # Start with default setting
-        risk_level = "Low"
+        return calculate_risk_level(is_pacing_dependent, dose_category, neutron_producing)
+    
+    def _render_peripheral_dose_estimate(self, field_distance, fractions):
+        """Estimate the device dose over a grid of candidate positions from the peripheral dose tables.
+        
+        Returns:
+            float or None: Worst-case device dose in Gy to use for the risk assessment,
+                or None to keep the field distance estimate
+        """
+        if "direct beam" in field_distance:
+            st.info("The peripheral dose model does not apply to a CIED in the direct beam.")
+            return None
+        
+        table = get_peripheral_dose_table()
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            energy = st.selectbox("Beam Energy", table.energies, key="peripheral_energy")
+            field_size = st.number_input("Equivalent Square Field Size (cm)", min_value=1.0, max_value=40.0,
+                                         value=10.0, step=0.5, key="peripheral_field_size")
+        with col2:
+            distance = st.number_input("Distance from Field Edge (cm)", min_value=0.5, max_value=50.0,
+                                       value=FIELD_DISTANCE_DEFAULT_CM.get(field_distance, 10.0),
+                                       step=0.5, key="peripheral_distance")
+            uncertainty = st.number_input("Position Uncertainty (± cm)", min_value=0.0, max_value=10.0,
+                                          value=1.0, step=0.5, key="peripheral_uncertainty")
+        with col3:
+            monitor_units = st.number_input("Monitor Units per Fraction", min_value=0.0, value=250.0,
+                                            step=10.0, key="peripheral_mu")
+            use_estimate = st.checkbox("Use for risk assessment", value=True, key="use_peripheral_dose")
+        
+        if uncertainty >= distance:
+            st.error("The position uncertainty must be smaller than the distance from the field edge.")
+            return None
         
-        # Step 1: If neutron producing and dose > 5 Gy, it's High risk
-        if neutron_producing and dose_category == "> 5 Gy":
-            return "High"
+        # Every candidate position is evaluated in one vectorized lookup
+        x, y, distances = device_position_grid(field_size, distance, uncertainty)
+        doses = table.device_dose(energy, distances, field_size, monitor_units * fractions)
+        nominal_dose = float(table.device_dose(energy, distance, field_size, monitor_units * fractions))
+        worst_dose = float(doses.max())
+        category = DOSE_CATEGORIES[int(dose_category_index(worst_dose))]
+        margin = float(dose_category_margin(worst_dose))
+        
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Nominal Position", f"{nominal_dose:.2f} Gy")
+        col2.metric("Worst Case", f"{worst_dose:.2f} Gy")
+        col3.metric("Margin to Next Category", "—" if np.isnan(margin) else f"{margin:.2f} Gy",
+                    help=f"Worst-case dose is in the {category} category")
+        
+        fig = go.Figure(go.Heatmap(x=x, y=y, z=doses, colorscale="YlOrRd", colorbar={"title": "Gy"}))
+        fig.update_layout(
+            xaxis_title="Offset away from field edge (cm)", yaxis_title="Offset along field edge (cm)",
+            height=350, margin={"t": 20, "b": 20}
+        )
+        st.plotly_chart(fig, use_container_width=True)
+        st.caption(f"{energy}, {field_size:g} cm field, {monitor_units * fractions:,.0f} MU in total. "
+                   "Photon peripheral dose only; neutrons are accounted for in the risk assessment.")
         
-        # Step 2: If neutron producing OR dose > 5 Gy, check pacing dependency
-        if neutron_producing or dose_category == "> 5 Gy":
-            if is_pacing_dependent:
-                return "High"
-            else:
-                return "Medium"
+        return worst_dose if use_estimate else None
+    
+    def _render_measurement_log(self, planned_fractions):
+        """Log per-fraction OSLD/TLD readings and track the cumulative device dose.
         
-        # Step 3: If dose is 2-5 Gy, check pacing dependency
-        if dose_category == "2-5 Gy":
-            if is_pacing_dependent:
-                return "Medium"
-            else:
-                return "Low"
+        Returns:
+            dict or None: Summary of the log for the write-up, or None if nothing is logged
+        """
+        log = st.session_state.get("cied_measurement_log")
         
-        # Step 4: If dose < 2 Gy and not neutron producing, it's Low risk
-        if dose_category == "< 2 Gy" and not neutron_producing:
-            return "Low"
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            detector = st.selectbox("Detector", list(load_detector_models()), key="invivo_detector")
+        model = load_detector_models()[detector]
+        with col2:
+            calibration = st.number_input(f"Calibration ({model['calibration_unit']})", min_value=0.0,
+                                          value=float(model["default_calibration"]), format="%.3e",
+                                          key="invivo_calibration")
+        with col3:
+            background = st.number_input(f"Background ({model['reading_unit']})", min_value=0.0, value=0.0,
+                                         key="invivo_background")
+        
+        new_log = st.button("Start New Log", key="invivo_new_log")
+        settings = (planned_fractions, detector, calibration, background)
+        # An empty log simply follows the current settings
+        if log is None or new_log or (
+            not log.fractions_measured
+            and settings != (log.planned_fractions, log.detector, log.calibration, log.background)
+        ):
+            log = MeasurementLog(planned_fractions, detector, calibration, background)
+            st.session_state.cied_measurement_log = log
+        st.caption(f"Logging {log.detector} readings for a {log.planned_fractions}-fraction course; "
+                   "start a new log to apply changed settings.")
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            fraction = st.number_input("Fraction", min_value=1, max_value=log.planned_fractions,
+                                       value=min(log.fractions_measured + 1, log.planned_fractions),
+                                       key="invivo_fraction")
+        with col2:
+            readings = st.text_input(f"Readings ({model['reading_unit']}, comma-separated)", key="invivo_readings")
+        with col3:
+            hours = st.number_input("Hours Until Readout", min_value=0.0, value=0.5, step=0.25, key="invivo_hours")
+        
+        reader_file = st.file_uploader("Reader Export (CSV with fraction, reading, hours)", type=["csv"],
+                                       key="invivo_file")
+        
+        try:
+            if st.button("Add Readings", key="invivo_add"):
+                values = [float(value) for value in readings.replace(";", ",").split(",") if value.strip()]
+                if not values:
+                    raise ValueError("Enter at least one reading")
+                log.add_fraction(fraction, values, hours)
+            if reader_file and st.button("Import Reader Export", key="invivo_import"):
+                export = pd.read_csv(reader_file, skipinitialspace=True)
+                export.columns = [str(column).strip().lower() for column in export.columns]
+                log.add_readings(
+                    export["fraction"], export["reading"], export["hours"],
+                    export["element_factor"] if "element_factor" in export else 1.0
+                )
+        except KeyError as e:
+            st.error(f"Reader export is missing column {e}")
+        except (ValueError, pd.errors.ParserError) as e:
+            st.error(f"Could not log the readings: {e}")
         
-        # Default fallback
-        return risk_level
+        if not log.fractions_measured:
+            return None
+        
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Fractions Measured", f"{log.fractions_measured} / {log.planned_fractions}")
+        col2.metric("Cumulative Dose", f"{log.cumulative_dose:.2f} Gy")
+        col3.metric("Projected Dose", f"{log.projected_dose:.2f} Gy")
+        for alert in log.alerts:
+            if alert["kind"] == "measured":
+                st.error(alert["message"])
+            else:
+                st.warning(alert["message"])
+        st.dataframe(log.to_frame().round(3), hide_index=True)
+        
+        return log.summary()
+    
+    def _render_batch_review(self):
+        """Re-stratify a CIED clinic list, optionally with different dose category thresholds."""
+        st.markdown("Upload a CSV with one row per patient to assign TG-203 dose categories and risk levels in bulk.")
+        st.caption(f"Required columns: {', '.join(BATCH_COLUMNS)}. Pacing dependency and neutron "
+                   "production are Yes/No; a TPS max dose of 0 uses the field distance estimate.")
+
+        col1, col2 = st.columns(2)
+        with col1:
+            lower_edge = st.number_input("Lower Dose Threshold (Gy)", min_value=0.0, value=DOSE_CATEGORY_EDGES[0],
+                                         step=0.1, key="cied_batch_lower")
+        with col2:
+            upper_edge = st.number_input("Upper Dose Threshold (Gy)", min_value=0.0, value=DOSE_CATEGORY_EDGES[1],
+                                         step=0.1, key="cied_batch_upper")
+
+        batch_file = st.file_uploader("Device List (CSV)", type=["csv"], key="cied_batch_file")
+        if not batch_file:
+            return
+        if upper_edge < lower_edge:
+            st.error("The upper dose threshold must not be below the lower threshold.")
+            return
+
+        try:
+            devices = pd.read_csv(batch_file, skipinitialspace=True)
+        except (ValueError, pd.errors.ParserError) as e:
+            st.error(f"Could not read the device list: {e}")
+            return
+        devices.columns = [str(column).strip().lower() for column in devices.columns]
+        missing = [column for column in BATCH_COLUMNS if column not in devices.columns]
+        if missing:
+            st.error(f"Device list is missing column(s): {', '.join(missing)}")
+            return
+
+        results = stratify_devices(
+            devices["pacing_dependent"].astype(str).str.strip().to_numpy(),
+            devices["neutron_producing"].astype(str).str.strip().to_numpy(),
+            pd.to_numeric(devices["tps_max_dose"], errors="coerce").fillna(0.0).to_numpy(),
+            devices["field_distance"].fillna("").astype(str).to_numpy(),
+            edges=(lower_edge, upper_edge),
+        )
+        results = pd.concat([devices.reset_index(drop=True), results], axis=1)
+
+        counts = results["Risk Level"].value_counts()
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Low Risk", int(counts.get("Low", 0)))
+        col2.metric("Medium Risk", int(counts.get("Medium", 0)))
+        col3.metric("High Risk", int(counts.get("High", 0)))
+
+        st.dataframe(results, hide_index=True)
+        st.download_button(
+            "Download Risk Review (CSV)",
+            results.to_csv(index=False),
+            file_name="cied_risk_review.csv",
+            mime="text/csv",
+            key="download_cied_review"
+        )
     
     # Backward compatibility method
     def render_pacemaker_form(self):
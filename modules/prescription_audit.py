@@ -0,0 +1,64 @@
+import streamlit as st
+import pandas as pd
+from audit_utils import audit_prescription_csv, AUDIT_REQUIRED_COLUMNS, AUDIT_OPTIONAL_COLUMNS
+
+class PrescriptionAuditModule:
+    """Batch audit of a department's historical prescription export."""
+
+    def render_audit_module(self):
+        """Render the Prescription Audit module UI."""
+        st.markdown("Upload a CSV export of past prescriptions to check every row against the "
+                    "dose/fractionation, site consistency and clinical range rules used in the write-up forms.")
+        st.caption(f"Required columns: {', '.join(AUDIT_REQUIRED_COLUMNS)}. "
+                   f"Optional: {', '.join(AUDIT_OPTIONAL_COLUMNS)}.")
+
+        export_file = st.file_uploader("Prescription Export (CSV)", type=["csv"], key="audit_file")
+
+        if export_file and st.button("Run Audit", type="primary", key="run_audit"):
+            with st.spinner("Validating prescriptions..."):
+                try:
+                    st.session_state.prescription_audit = audit_prescription_csv(export_file)
+                except (ValueError, pd.errors.ParserError) as e:
+                    st.error(f"Could not audit the export: {e}")
+
+        report = st.session_state.get("prescription_audit")
+        if report:
+            self._render_report(report)
+
+    def _render_report(self, report):
+        """Render the summary of an audit."""
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Prescriptions", f"{report['rows']:,}")
+        col2.metric("With Errors", f"{report['errors']:,}")
+        col3.metric("With Warnings", f"{report['warnings']:,}")
+
+        site_tab, physician_tab, check_tab, findings_tab = st.tabs([
+            "By Site", "By Physician", "By Check", "Findings"
+        ])
+
+        with site_tab:
+            st.dataframe(report["by_site"], hide_index=True)
+
+        with physician_tab:
+            st.dataframe(report["by_physician"], hide_index=True)
+
+        with check_tab:
+            st.dataframe(report["by_check"], hide_index=True)
+
+        with findings_tab:
+            if report["findings"].empty:
+                st.success("No issues found.")
+            else:
+                if report["findings_truncated"]:
+                    st.info(f"Showing the first {len(report['findings']):,} findings; the summaries cover every row.")
+                severity = st.multiselect("Severity", ["Error", "Warning"], default=["Error", "Warning"],
+                                          key="audit_severity")
+                findings = report["findings"][report["findings"]["Severity"].isin(severity)]
+                st.dataframe(findings, hide_index=True)
+                st.download_button(
+                    "Download Findings (CSV)",
+                    findings.to_csv(index=False),
+                    file_name="prescription_audit_findings.csv",
+                    mime="text/csv",
+                    key="download_audit_findings"
+                )
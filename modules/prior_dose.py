@@ -1,6 +1,19 @@
 import streamlit as st
+import os
+import numpy as np
+import pandas as pd
 from datetime import datetime
 from .base_module import BaseWriteUpModule
+from dvh_utils import voxel_volume_cc
+from constraint_utils import get_constraint_library, describe_rules
+from utils import get_session_upload_dir, save_uploaded_file, file_source_input, file_source_path
+from dicom_utils import open_dicom_file
+from structure_utils import rasterize_structure_set
+from radiobiology_utils import (
+    get_alpha_beta, course_sensitivity_table, get_method_abbreviation,
+    load_recovery_models, get_recovery_model, months_between, recovery_fractions, discounted_cumulative_dose,
+    load_dose_grid, build_alpha_beta_labels, composite_eqd2, summarize_composite, translate_constraints
+)
 
 class PriorDoseModule(BaseWriteUpModule):
     """Prior Dose module for clinical documentation generation.
@@ -24,6 +37,9 @@ class PriorDoseModule(BaseWriteUpModule):
         # Current year for default year selection
         self.current_year = datetime.now().year
         self.current_month = datetime.now().strftime("%B")  # Get current month name
+        
+        # Per-organ recovery models used to discount prior courses
+        self.recovery_models = load_recovery_models()
     
     def get_module_name(self):
         """Return the display name of this module."""
@@ -37,6 +53,13 @@ class PriorDoseModule(BaseWriteUpModule):
         """Return a list of required field names for this module."""
         return ["current_site", "current_dose", "current_fractions", "prior_treatments"]
     
+    def apply_prefill(self, data):
+        """Set the current course's dose and fractions inputs from plan values."""
+        if data.get("current_dose") is not None:
+            st.session_state.current_dose = float(data["current_dose"])
+        if data.get("current_fractions"):
+            st.session_state.current_fractions = int(data["current_fractions"])
+    
     def render_specialized_fields(self, physician, physicist, patient_age, patient_sex, patient_details):
         """Render Prior Dose-specific input fields and return the generated data."""
         # Create tabs for Treatment Details and Dose Constraints
@@ -195,6 +218,20 @@ class PriorDoseModule(BaseWriteUpModule):
                 else:
                     dose_calc_method = "Not Applicable"
                     critical_structures = ""
+            
+            # Cumulative dose estimates for the listed structures
+            structure_alpha_beta = {}
+            if has_overlap == "Yes" and critical_structures.strip() and st.session_state.prior_treatments:
+                structure_alpha_beta = self._render_cumulative_dose(
+                    critical_structures, dose_calc_method, current_dose, current_fractions
+                )
+            
+            # Voxel-wise composite from exported dose grids
+            composite_summary = None
+            if has_overlap == "Yes" and st.session_state.prior_treatments:
+                composite_summary = self._render_composite_grid(
+                    current_fractions, structure_alpha_beta, current_site, patient_details
+                )
         
         with constraints_tab:
             # Dynamic dose constraint information based on selected treatments
@@ -219,13 +256,22 @@ class PriorDoseModule(BaseWriteUpModule):
                     constraints = self._get_dose_constraints(site)
                     
                     if constraints:
+                        # The current site also gets its limits converted to the current schedule
+                        translated = {}
+                        if site == current_site:
+                            translated = translate_constraints(site, "conventional", current_fractions,
+                                                               structure_alpha_beta)
                         for organ, limit in constraints.items():
+                            if translated:
+                                limit += f" ({current_fractions} fx: {describe_rules(translated[organ])})"
                             st.write(f"**{organ}**: {limit}")
                     else:
                         st.write("No specific constraints available for this site.")
                 
                 # Add a note about QUANTEC
                 st.info("These constraints are based on QUANTEC recommendations. Actual clinical constraints may vary based on individual patient factors, treatment history, and institutional protocols.")
+                st.caption("Limits for the current schedule are LQ-equivalent doses using each organ's α/β; "
+                           "mean-dose limits are converted as if the organ received its mean dose uniformly.")
         
         # Check if we have all required information
         required_fields_filled = (
@@ -253,7 +299,9 @@ class PriorDoseModule(BaseWriteUpModule):
                 "has_overlap": has_overlap,
                 "dose_calc_method": dose_calc_method,
                 "planning_system": "Velocity",  # Fixed to always be Velocity
-                "critical_structures": critical_structures_list
+                "critical_structures": critical_structures_list,
+                "structure_alpha_beta": structure_alpha_beta,
+                "composite_summary": composite_summary
             }
         
         return None
@@ -273,6 +321,8 @@ class PriorDoseModule(BaseWriteUpModule):
         dose_calc_method = module_data.get("dose_calc_method", "")
         planning_system = module_data.get("planning_system", "Velocity")
         critical_structures = module_data.get("critical_structures", [])
+        structure_alpha_beta = module_data.get("structure_alpha_beta", {})
+        composite_summary = module_data.get("composite_summary")
         
         # Clean up integers by removing .0
         current_dose_display = int(current_dose) if current_dose == int(current_dose) else current_dose
@@ -329,26 +379,66 @@ class PriorDoseModule(BaseWriteUpModule):
         
         if has_overlap == "Yes":
             # Get the appropriate dose method terminology
-            if dose_calc_method.startswith("BED"):
-                method_abbreviation = "BED"
-            elif dose_calc_method.startswith("EQD2"):
-                method_abbreviation = "EQD2"
-            else:
-                method_abbreviation = "Raw Dose"
-                
+            method_abbreviation = get_method_abbreviation(dose_calc_method)
+            
             write_up += f"There is overlap between the current and prior treatment fields. "
             write_up += f"The {method_abbreviation} method was used to estimate the cumulative dose to overlapping critical structures. "
-            write_up += f"A composite plan was created in Velocity to assess the total dose distribution.\n \n"
+            if composite_summary:
+                write_up += (f"A voxel-wise composite EQD2 was computed from the exported dose grids of "
+                             f"{composite_summary['courses']} treatment courses, using structure-specific α/β values "
+                             f"(α/β = {composite_summary['default_alpha_beta']:g} Gy elsewhere). "
+                             f"The maximum composite EQD2 was {composite_summary['max']:.1f} Gy.\n \n")
+            else:
+                write_up += f"A composite plan was created in Velocity to assess the total dose distribution.\n \n"
             
             if critical_structures:
+                reference_date = (module_data.get("current_month", self.current_month),
+                                  module_data.get("current_year", self.current_year))
+                cumulative = self._calculate_cumulative_doses(
+                    prior_treatments, (current_dose, current_fractions), critical_structures,
+                    structure_alpha_beta, method_abbreviation, reference_date
+                )
+                grid_structures = composite_summary["structures"] if composite_summary else {}
+                
                 write_up += "The following critical structures in the overlapping region were evaluated for cumulative dose:\n"
+                recovery_credited = False
                 for structure in critical_structures:
-                    write_up += f"- {structure} which received XXXX\n \n"
+                    total, discounted, alpha_beta = cumulative[structure]
+                    if structure in grid_structures:
+                        stats = grid_structures[structure]
+                        write_up += (f"- {structure} which received a composite EQD2 D0.03cc of {stats['d0.03cc']:.1f} Gy "
+                                     f"(max {stats['max']:.1f} Gy, mean {stats['mean']:.1f} Gy)\n \n")
+                    elif method_abbreviation == "Raw Dose":
+                        write_up += f"- {structure} which received a cumulative physical dose of up to {total:.1f} Gy\n \n"
+                    else:
+                        write_up += (f"- {structure} which received a cumulative {method_abbreviation} of up to "
+                                     f"{total:.1f} Gy (α/β = {alpha_beta:g} Gy)")
+                        if discounted < total - 0.05:
+                            write_up += f", or {discounted:.1f} Gy after discounting prior courses for tissue recovery"
+                            recovery_credited = True
+                        write_up += "\n \n"
+                if any(structure not in grid_structures for structure in critical_structures):
+                    write_up += ("Cumulative values assume each course delivered its full prescription dose to the structure "
+                                 "and are therefore an upper bound on the composite dose.\n \n")
+                if recovery_credited:
+                    write_up += ("Recovery-discounted values credit partial recovery of each prior course's dose "
+                                 "according to the organ-specific recovery model and the time elapsed since that course.\n \n")
             else:
                 write_up += "Critical structures in the overlapping region were evaluated for cumulative dose.\n \n"
             
-            write_up += f"Based on this analysis, the current treatment plan was deemed acceptable with respect to cumulative dose constraints. "
-            write_up += f"This evaluation was reviewed and approved by the radiation oncologist, Dr. {physician}, and the medical physicist, Dr. {physicist}."
+            constraints = composite_summary.get("constraints") if composite_summary else None
+            failed = [row for row in constraints or [] if not row["Passed"]]
+            if failed:
+                write_up += "The composite EQD2 did not meet the following cumulative dose constraints:\n"
+                for row in failed:
+                    write_up += (f"- {row['Organ']} {row['Metric']} of {row['Value']:g} {row['Unit']} "
+                                 f"(limit {row['Limit']:g} {row['Unit']})\n \n")
+                write_up += f"These exceedances were reviewed by the radiation oncologist, Dr. {physician}, and the medical physicist, Dr. {physicist}."
+            else:
+                if constraints:
+                    write_up += f"The composite EQD2 met all {len(constraints)} evaluated cumulative dose constraints. "
+                write_up += f"Based on this analysis, the current treatment plan was deemed acceptable with respect to cumulative dose constraints. "
+                write_up += f"This evaluation was reviewed and approved by the radiation oncologist, Dr. {physician}, and the medical physicist, Dr. {physicist}."
         else:
             write_up += "Review of the prior treatment fields and current treatment plan indicates minimal to no overlap "
             write_up += "between treatment volumes. The distance between field edges is sufficient to ensure that "
@@ -358,105 +448,220 @@ class PriorDoseModule(BaseWriteUpModule):
         
         return write_up
     
+    def _calculate_cumulative_doses(self, prior_treatments, current_course, structures,
+                                    structure_alpha_beta, method, reference_date):
+        """Estimate the cumulative dose to each structure from the prescribed courses.
+        
+        Args:
+            prior_treatments: Prior treatment dicts with dose, fractions, month and year
+            current_course: (total_dose, fractions) of the current course
+            structures: Critical structure names
+            structure_alpha_beta: Dict of α/β overrides by structure name
+            method: "BED", "EQD2" or "Raw Dose"
+            reference_date: (month, year) the elapsed time is measured to
+            
+        Returns:
+            dict: Structure name mapped to (cumulative dose, recovery-discounted dose, α/β)
+        """
+        alpha_betas = [structure_alpha_beta.get(s, get_alpha_beta(s)) for s in structures]
+        prior_courses = [(t.get("dose", 0), t.get("fractions", 1)) for t in prior_treatments]
+        
+        # Physical dose sums are reported as-is, without recovery credit
+        if method == "Raw Dose":
+            recovery = np.zeros((len(structures), len(prior_courses)))
+        else:
+            elapsed = [months_between(t.get("month", ""), t.get("year", reference_date[1]), *reference_date)
+                       for t in prior_treatments]
+            recovery = recovery_fractions(structures, elapsed, self.recovery_models)
+        
+        totals, discounted = discounted_cumulative_dose(prior_courses, current_course, alpha_betas, recovery, method)
+        return {
+            s: (float(total), float(disc), ab)
+            for s, total, disc, ab in zip(structures, totals, discounted, alpha_betas)
+        }
+    
+    def _render_cumulative_dose(self, critical_structures, dose_calc_method, current_dose, current_fractions):
+        """Show cumulative dose estimates per structure and an α/β sensitivity table.
+        
+        Returns:
+            dict: α/β used for each structure, including any edits made in the table
+        """
+        structures = [s.strip() for s in critical_structures.split("\n") if s.strip()]
+        method = get_method_abbreviation(dose_calc_method)
+        
+        st.markdown("#### Cumulative Dose Estimate")
+        st.caption("Assumes each course delivered its full prescription dose to the structure (upper bound).")
+        
+        alpha_beta_table = st.data_editor(
+            pd.DataFrame({
+                "Structure": structures,
+                "α/β (Gy)": [get_alpha_beta(s) for s in structures]
+            }),
+            disabled=["Structure"],
+            hide_index=True,
+            key="structure_alpha_beta_editor"
+        )
+        structure_alpha_beta = {
+            row["Structure"]: float(row["α/β (Gy)"])
+            for _, row in alpha_beta_table.iterrows()
+            if pd.notna(row["α/β (Gy)"]) and row["α/β (Gy)"] > 0
+        }
+        
+        courses = [(t["dose"], t["fractions"]) for t in st.session_state.prior_treatments]
+        courses.append((current_dose, current_fractions))
+        cumulative = self._calculate_cumulative_doses(
+            st.session_state.prior_treatments, (current_dose, current_fractions), structures,
+            structure_alpha_beta, method, (self.current_month, self.current_year)
+        )
+        
+        unit = "Gy" if method == "Raw Dose" else f"Gy {method}"
+        table = {
+            "Structure": structures,
+            f"Cumulative ({unit})": [round(cumulative[s][0], 1) for s in structures]
+        }
+        if method != "Raw Dose":
+            table[f"Recovery-discounted ({unit})"] = [round(cumulative[s][1], 1) for s in structures]
+            table["Recovery model"] = [
+                self.recovery_models["models"][get_recovery_model(s, self.recovery_models)]["label"]
+                for s in structures
+            ]
+        st.dataframe(pd.DataFrame(table), hide_index=True)
+        
+        if method != "Raw Dose":
+            with st.expander("α/β Sensitivity"):
+                labels = [f"Treatment {i+1} ({t['month']} {t['year']})"
+                          for i, t in enumerate(st.session_state.prior_treatments)]
+                labels.append("Current")
+                st.dataframe(course_sensitivity_table(
+                    [(label, dose, fx) for label, (dose, fx) in zip(labels, courses)],
+                    method=method
+                ))
+        
+        return structure_alpha_beta
+    
+    def _render_composite_grid(self, current_fractions, structure_alpha_beta, current_site=None,
+                               patient_details=None):
+        """Build a voxel-wise composite EQD2 from uploaded dose grids and structure masks.
+        
+        Uploaded files are written to the session upload directory so they
+        can be memory-mapped, grids too large to upload are read in place from
+        local paths, and the composite itself is written to a memory-mapped
+        file in the session directory, so large grids never have to fit in RAM. Masks named
+        after an organ in the current site's constraints are checked against them.
+        A composite computed for another patient is never returned.
+        
+        Returns:
+            dict: Summary of the last computed composite, or None
+        """
+        with st.expander("Composite from Dose Grids"):
+            st.caption("Upload one 3D dose grid per course (.npy in Gy, or DICOM RT Dose) and optional "
+                       "boolean structure masks (.npy, named after the structure) on the same grid, "
+                       "or an RT Structure Set to rasterize onto a DICOM grid. Grids too large to upload "
+                       "can be given as paths on the machine running QuickWrite.")
+            
+            dose_files = st.file_uploader("Dose Grids", type=["npy", "dcm"],
+                                          accept_multiple_files=True, key="composite_dose_files")
+            local_doses = st.text_area("Local Dose Grid Paths", key="composite_dose_paths",
+                                       help="One .npy or DICOM RT Dose path per line, read in place")
+            dose_files = list(dose_files or []) + [line.strip() for line in local_doses.splitlines() if line.strip()]
+            mask_files = st.file_uploader("Structure Masks", type=["npy"],
+                                          accept_multiple_files=True, key="composite_mask_files")
+            structure_file = file_source_input("RT Structure Set (optional, with a DICOM RT Dose grid)",
+                                               ["dcm"], "composite_structure_file")
+            
+            spacing_cols = st.columns(3)
+            spacing = [
+                spacing_cols[i].number_input(f"{axis} Spacing (mm)", min_value=0.1, value=2.5, step=0.5,
+                                             key=f"composite_spacing_{i}")
+                for i, axis in enumerate(["Slice", "Row", "Column"])
+            ]
+            
+            course_labels = [f"Treatment {i+1} ({t['month']} {t['year']})"
+                             for i, t in enumerate(st.session_state.prior_treatments)]
+            course_labels.append("Current")
+            course_fractions = [t["fractions"] for t in st.session_state.prior_treatments]
+            course_fractions.append(current_fractions)
+            
+            assignments = []
+            for i, dose_file in enumerate(dose_files):
+                name = os.path.basename(dose_file) if isinstance(dose_file, str) else dose_file.name
+                assignments.append(st.selectbox(f"Course for {name}", course_labels,
+                                                index=min(i, len(course_labels) - 1),
+                                                key=f"composite_course_{i}"))
+            
+            if dose_files and st.button("Compute Composite EQD2", key="compute_composite"):
+                work_dir = get_session_upload_dir()
+                
+                try:
+                    dose_paths = [file_source_path(f, ["npy", "dcm"]) for f in dose_files]
+                    grids = [load_dose_grid(path) for path in dose_paths]
+                    masks = {
+                        os.path.splitext(f.name)[0].replace("_", " "):
+                            np.load(save_uploaded_file(f), mmap_mode="r")
+                        for f in mask_files or []
+                    }
+                    if structure_file:
+                        # Contours are rasterized onto the first dose grid's geometry
+                        if not dose_paths[0].lower().endswith(".dcm"):
+                            raise ValueError("An RT Structure Set needs a DICOM RT Dose as the first dose grid")
+                        grid = open_dicom_file(dose_paths[0])
+                        masks.update(rasterize_structure_set(
+                            file_source_path(structure_file, ["dcm"]), grid.origin_mm,
+                            (grid.slice_step_mm,) + grid.spacing_mm[1:], grid.shape, orientation=grid.orientation
+                        ))
+                        spacing = grid.spacing_mm
+                    labels, lookup = build_alpha_beta_labels(masks, structure_alpha_beta)
+                    
+                    composite = np.lib.format.open_memmap(
+                        os.path.join(work_dir, "composite_eqd2.npy"), mode="w+",
+                        dtype=np.float32, shape=grids[0].shape
+                    )
+                    fractions = [course_fractions[course_labels.index(label)] for label in assignments]
+                    composite_eqd2(grids, fractions, lookup, labels, out=composite)
+                    
+                    summary = summarize_composite(composite, masks, voxel_volume_cc(spacing),
+                                                  constraint_site=current_site)
+                    summary["courses"] = len(grids)
+                    summary["default_alpha_beta"] = float(lookup[0])
+                    summary["patient_details"] = patient_details
+                    st.session_state.prior_dose_composite = summary
+                    composite.flush()
+                    del composite
+                except (ValueError, ImportError, OSError) as e:
+                    st.error(f"Could not compute the composite: {e}")
+            
+            summary = st.session_state.get("prior_dose_composite")
+            if summary and summary.get("patient_details") != patient_details:
+                # Computed for a different patient
+                del st.session_state.prior_dose_composite
+                summary = None
+            if summary:
+                st.metric("Maximum Composite EQD2", f"{summary['max']:.1f} Gy")
+                if summary["structures"]:
+                    st.dataframe(pd.DataFrame([
+                        {"Structure": name, "Max EQD2 (Gy)": round(stats["max"], 1),
+                         "D0.03cc EQD2 (Gy)": round(stats["d0.03cc"], 1),
+                         "Mean EQD2 (Gy)": round(stats["mean"], 1)}
+                        for name, stats in summary["structures"].items()
+                    ]), hide_index=True)
+                if summary.get("constraints"):
+                    results = pd.DataFrame(summary["constraints"])
+                    failed = int((~results["Passed"]).sum())
+                    if failed:
+                        st.error(f"{failed} of {len(results)} constraint checks failed")
+                    else:
+                        st.success(f"All {len(results)} constraint checks passed")
+                    st.dataframe(results, hide_index=True)
+                if st.button("Clear Composite", key="clear_composite"):
+                    del st.session_state.prior_dose_composite
+                    st.rerun()
+        
+        return st.session_state.get("prior_dose_composite")
+    
     def _get_dose_constraints(self, site):
         """Get dose constraints for a specific treatment site."""
         # QUANTEC dose constraints based on treatment site
-        constraints = {
-            "brain": {
-                "Brain Stem": "D0.03cc < 54 Gy",
-                "Optic Chiasm": "D0.03cc < 54 Gy",
-                "Optic Nerve": "D0.03cc < 54 Gy",
-                "Retina": "D0.03cc < 45 Gy",
-                "Cochlea": "Mean < 45 Gy",
-                "Lens": "D0.03cc < 10 Gy"
-            },
-            "head and neck": {
-                "Spinal Cord": "D0.03cc < 50 Gy",
-                "Brain Stem": "D0.03cc < 54 Gy",
-                "Parotid": "Mean < 26 Gy (at least one)",
-                "Larynx": "Mean < 45 Gy",
-                "Mandible": "D0.03cc < 70 Gy"
-            },
-            "thorax": {
-                "Spinal Cord": "D0.03cc < 50 Gy",
-                "Heart": "Mean < 26 Gy",
-                "Lungs": "V20 < 30-35%, Mean < 20 Gy",
-                "Esophagus": "Mean < 34 Gy, V60 < 17%",
-                "Brachial Plexus": "D0.03cc < 66 Gy"
-            },
-            "breast": {
-                "Heart": "V25 < 10%, Mean < 4 Gy (left-sided)",
-                "Lungs": "V20 < 30-35%, Mean < 15 Gy",
-                "Contralateral Breast": "Mean < 3 Gy"
-            },
-            "lung": {
-                "Spinal Cord": "D0.03cc < 50 Gy",
-                "Heart": "V25 < 10%, Mean < 20 Gy",
-                "Normal Lung (both lungs - GTV)": "V20 < 30-35%, Mean < 20 Gy",
-                "Esophagus": "Mean < 34 Gy, V60 < 17%",
-                "Brachial Plexus": "D0.03cc < 66 Gy"
-            },
-            "liver": {
-                "Normal Liver": "Mean < 30 Gy, V30 < 40%",
-                "Spinal Cord": "D0.03cc < 45 Gy",
-                "Kidney": "Mean < 18 Gy",
-                "Bowel": "D0.03cc < 55 Gy"
-            },
-            "pancreas": {
-                "Spinal Cord": "D0.03cc < 45 Gy",
-                "Kidney": "Mean < 18 Gy",
-                "Liver": "Mean < 30 Gy",
-                "Bowel": "D0.03cc < 55 Gy",
-                "Stomach": "D0.03cc < 55 Gy"
-            },
-            "abdomen": {
-                "Spinal Cord": "D0.03cc < 45 Gy",
-                "Kidney": "Mean < 18 Gy",
-                "Liver": "Mean < 30 Gy",
-                "Bowel": "D0.03cc < 55 Gy",
-                "Stomach": "D0.03cc < 55 Gy"
-            },
-            "pelvis": {
-                "Bladder": "V80 < 15%, V75 < 25%, V70 < 35%, V65 < 50%",
-                "Rectum": "V75 < 15%, V70 < 25%, V65 < 35%, V60 < 50%",
-                "Bowel": "V52 < 5%, V45 < 195cc",
-                "Femoral Heads": "V52 < 5%",
-                "Spinal Cord": "D0.03cc < 50 Gy"
-            },
-            "prostate": {
-                "Bladder": "V80 < 15%, V75 < 25%, V70 < 35%, V65 < 50%",
-                "Rectum": "V75 < 15%, V70 < 25%, V65 < 35%, V60 < 50%",
-                "Femoral Heads": "V52 < 5%",
-                "Penile Bulb": "Mean < 50 Gy"
-            },
-            "endometrium": {
-                "Bladder": "V80 < 15%, V75 < 25%, V70 < 35%, V65 < 50%",
-                "Rectum": "V75 < 15%, V70 < 25%, V65 < 35%, V60 < 50%",
-                "Bowel": "V52 < 5%, V45 < 195cc",
-                "Femoral Heads": "V52 < 5%"
-            },
-            "cervix": {
-                "Bladder": "V80 < 15%, V75 < 25%, V70 < 35%, V65 < 50%",
-                "Rectum": "V75 < 15%, V70 < 25%, V65 < 35%, V60 < 50%",
-                "Bowel": "V52 < 5%, V45 < 195cc",
-                "Femoral Heads": "V52 < 5%"
-            },
-            "rectum": {
-                "Bladder": "V65 < 50%",
-                "Bowel": "V52 < 5%, V45 < 195cc",
-                "Femoral Heads": "V52 < 5%"
-            },
-            "spine": {
-                "Spinal Cord": "D0.03cc < 50 Gy (cumulative), < 10 Gy (single fraction)",
-                "Cauda Equina": "D0.03cc < 60 Gy (cumulative), < 14 Gy (single fraction)"
-            },
-            "extremity": {
-                "Skin": "D0.03cc < 70 Gy",
-                "Joint": "Mean < 36 Gy"
-            }
-        }
-        
-        return constraints.get(site.lower(), {})
+        return get_constraint_library().get_display_constraints(site.lower(), "conventional")
     
     # Legacy method for backward compatibility
     def render_prior_dose_form(self):
@@ -1,9 +1,14 @@
+import os
 import streamlit as st
 from .templates import ConfigManager
 from .common_info_collector import collect_common_info
 from .module_selector import select_modules
 from validation_utils import FormValidator
 from download_utils import WriteUpDisplay
+from draft_utils import DraftStore
+from profiling_utils import profile_step
+from dicom_utils import index_directory
+from prefill_utils import PREFILL_MODULES, extract_plan, find_plan_files, prefill_module_data
 
 class QuickWriteOrchestrator:
     """Main controller for the QuickWrite workflow."""
@@ -16,6 +21,7 @@ class QuickWriteOrchestrator:
         """
         self.config_manager = ConfigManager()
         self.modules = modules
+        self.draft_store = DraftStore()
     
     def render_workflow(self):
         """Render the entire QuickWrite workflow based on current state.
@@ -23,6 +29,9 @@ class QuickWriteOrchestrator:
         Returns:
             dict: The generated write-ups, or None if not complete
         """
+        # Resume a saved draft if the browser reconnected to a new session
+        self.draft_store.restore()
+        
         # Initialize session state for workflow if needed
         if "workflow_step" not in st.session_state:
             st.session_state.workflow_step = "basic_info"
@@ -30,14 +39,15 @@ class QuickWriteOrchestrator:
         # Determine the current workflow step
         current_step = st.session_state.workflow_step
         
-        if current_step == "basic_info":
-            return self._render_basic_info_step()
-        elif current_step == "module_selection":
-            return self._render_module_selection_step()
-        elif current_step == "module_details":
-            return self._render_module_details_step()
-        elif current_step == "results":
-            return self._render_results_step()
+        with profile_step(f"step.{current_step}"):
+            if current_step == "basic_info":
+                return self._render_basic_info_step()
+            elif current_step == "module_selection":
+                return self._render_module_selection_step()
+            elif current_step == "module_details":
+                return self._render_module_details_step()
+            elif current_step == "results":
+                return self._render_results_step()
     
     def _render_basic_info_step(self):
         """Render the basic information collection step."""
@@ -48,7 +58,8 @@ class QuickWriteOrchestrator:
         existing_data = st.session_state.get("common_info", None)
         
         # Use the common info collector
-        common_info = collect_common_info(self.config_manager, existing_data)
+        with profile_step("collect_common_info"):
+            common_info = collect_common_info(self.config_manager, existing_data)
         
         # Navigation buttons
         col1, col2 = st.columns([4, 1])
@@ -60,6 +71,7 @@ class QuickWriteOrchestrator:
                 st.session_state.common_info = common_info
                 # Advance to next step
                 st.session_state.workflow_step = "module_selection"
+                self.draft_store.checkpoint(common_info=True)
                 # Force rerun to update the UI
                 st.rerun()
     
@@ -79,7 +91,10 @@ class QuickWriteOrchestrator:
                     st.rerun()
         
         # IMPORTANT: We're ignoring existing selections to avoid issues
-        selected_modules = select_modules(self.modules, existing_selections=None)
+        with profile_step("select_modules"):
+            selected_modules = select_modules(self.modules, existing_selections=None)
+        
+        self._render_plan_prefill(selected_modules)
         
         # Navigation buttons
         col1, col2, col3 = st.columns([1, 3, 1])
@@ -98,6 +113,68 @@ class QuickWriteOrchestrator:
                 st.session_state.module_data = {}
                 # Advance to next step
                 st.session_state.workflow_step = "module_details"
+                self.draft_store.checkpoint(*self.modules.keys())
+                st.rerun()
+    
+    def _render_plan_prefill(self, selected_modules):
+        """Prefill the selected modules from a treatment plan in a local DICOM export.
+        
+        The plan's prescription and target volumes are extracted once per
+        plan (and cached), mapped onto each module's data, and the workflow
+        skips to the module details so the prefilled forms only need review.
+        
+        Args:
+            selected_modules: Dict mapping module_id to whether it is selected
+        """
+        with st.expander("Prefill from Treatment Plan", expanded=False):
+            directory = st.text_input("DICOM Export Folder", key="prefill_dicom_dir",
+                                      help="Folder with the patient's RT Plan, RT Structure Set and RT Dose files")
+            if not directory:
+                return
+            
+            try:
+                with profile_step("prefill.index_directory"):
+                    index = index_directory(directory)
+            except (ValueError, ImportError, OSError) as e:
+                st.error(f"Could not read the folder: {e}")
+                return
+            
+            plans = index[index["Modality"] == "RTPLAN"].sort_values(["PatientID", "StudyDate", "Path"])
+            if plans.empty:
+                st.warning("No RT Plans were found in this folder.")
+                return
+            
+            labels = [f"{row['PatientID']} - {row['StudyDate'] or 'no date'} - {os.path.basename(row['Path'])}"
+                      for _, row in plans.iterrows()]
+            choice = st.selectbox("Plan", range(len(labels)), format_func=lambda i: labels[i], key="prefill_plan")
+            
+            try:
+                with profile_step("prefill.extract_plan"):
+                    plan_row = plans.iloc[choice].to_dict()
+                    plan = extract_plan(plan_row["Path"], *find_plan_files(index, plan_row))
+            except (ValueError, ImportError, OSError, AttributeError) as e:
+                st.error(f"Could not read the plan: {e}")
+                return
+            
+            if plan["prescription_dose"] and plan["fractions"]:
+                st.write(f"**Prescription:** {plan['prescription_dose']:g} Gy in {plan['fractions']} fractions")
+            for target in plan["targets"]:
+                volume = f", {target['volume_cc']:g} cc" if target["volume_cc"] is not None else ""
+                st.write(f"- {target['name']}: {target['dose'] or 0:g} Gy{volume}")
+            
+            prefill = prefill_module_data(plan)
+            targets = [module_id for module_id in PREFILL_MODULES
+                       if selected_modules.get(module_id) and module_id in prefill]
+            names = ", ".join(self.modules[module_id].get_module_name() for module_id in targets)
+            st.caption(f"Prefills: {names}" if targets else "Select SBRT, SRS or Prior Dose to prefill from this plan.")
+            
+            if st.button("Prefill and Review", key="prefill_and_review", disabled=not targets, type="primary"):
+                for module_id in targets:
+                    self.modules[module_id].apply_prefill(prefill[module_id])
+                st.session_state.selected_modules = selected_modules
+                st.session_state.module_data = {}
+                st.session_state.workflow_step = "module_details"
+                self.draft_store.checkpoint(*self.modules.keys())
                 st.rerun()
     
     def _render_module_details_step(self):
@@ -134,6 +211,7 @@ class QuickWriteOrchestrator:
                 del st.session_state.registrations
             # Clear editing state
             st.session_state.current_editing_module = None
+            self.draft_store.checkpoint(*self.modules.keys())
             # Rerun to update UI
             st.rerun()
         
@@ -184,6 +262,7 @@ class QuickWriteOrchestrator:
                                 del st.session_state.registrations
                             # Update session state
                             st.session_state.module_data = module_data
+                            self.draft_store.checkpoint(module_id)
                             # Rerun to update UI
                             st.rerun()
                     
@@ -193,13 +272,14 @@ class QuickWriteOrchestrator:
                         st.markdown(f"### {module.get_module_name()} Details")
                         
                         # Pass common information to the module
-                        result = module.render_specialized_fields(
-                            common_info.get("physician", ""),
-                            common_info.get("physicist", ""),
-                            common_info.get("patient_age", 0),
-                            common_info.get("patient_sex", ""),
-                            common_info.get("patient_details", "")
-                        )
+                        with profile_step(f"{module_id}.render_specialized_fields"):
+                            result = module.render_specialized_fields(
+                                common_info.get("physician", ""),
+                                common_info.get("physicist", ""),
+                                common_info.get("patient_age", 0),
+                                common_info.get("patient_sex", ""),
+                                common_info.get("patient_details", "")
+                            )
                         
                         # Add an explicit save button
                         save_btn = st.button(f"Save {module.get_module_name()} Details", key=f"save_{module_id}")
@@ -215,6 +295,7 @@ class QuickWriteOrchestrator:
                                 st.success(f"{module.get_module_name()} details saved successfully.")
                                 # Update session state
                                 st.session_state.module_data = module_data
+                                self.draft_store.checkpoint(module_id)
                                 # Force rerun to update UI
                                 st.rerun()
                             else:
@@ -247,7 +328,8 @@ class QuickWriteOrchestrator:
                         st.markdown(f"### {module.get_module_name()} Preview")
                         # Generate a preview of the write-up
                         try:
-                            write_up_preview = module.generate_write_up(common_info, module_data[module_id])
+                            with profile_step(f"{module_id}.generate_write_up"):
+                                write_up_preview = module.generate_write_up(common_info, module_data[module_id])
                             if write_up_preview:
                                 # Show a preview of the first 500 characters
                                 st.markdown("**First 500 characters of generated write-up:**")
@@ -400,7 +482,8 @@ class QuickWriteOrchestrator:
                             continue
                         
                         # Generate the write-up
-                        write_up = module.generate_write_up(common_info, module_data[module_id])
+                        with profile_step(f"{module_id}.generate_write_up"):
+                            write_up = module.generate_write_up(common_info, module_data[module_id])
                         if write_up:
                             results[module.get_module_name()] = write_up
                 
@@ -413,7 +496,8 @@ class QuickWriteOrchestrator:
                 # Clear editing state when proceeding to results
                 if "current_editing_module" in st.session_state:
                     del st.session_state.current_editing_module
-                    
+                
+                self.draft_store.checkpoint(results=True)
                 st.rerun()
     
     def _render_results_step(self):
@@ -444,7 +528,8 @@ class QuickWriteOrchestrator:
         patient_sex = common_info.get("patient_sex", "")
         patient_name = f"{patient_age}yo_{patient_sex}"
         
-        WriteUpDisplay.display_multiple_write_ups(results, patient_name)
+        with profile_step("WriteUpDisplay"):
+            WriteUpDisplay.display_multiple_write_ups(results, patient_name)
         
         # Navigation buttons
         col1, col2, col3 = st.columns([1, 3, 1])
@@ -465,6 +550,15 @@ class QuickWriteOrchestrator:
         for key in ['workflow_step', 'common_info', 'selected_modules', 'module_data', 'results']:
             if key in st.session_state:
                 del st.session_state[key]
+        
+        # Results computed from the previous patient's files
+        for key in ['prior_dose_composite', 'sbrt_d2cm_percent', 'sbrt_motion_stats', 'sbrt_pending_metrics',
+                    'cied_measurement_log', 'dibh_breath_holds']:
+            if key in st.session_state:
+                del st.session_state[key]
+        
+        # Discard the saved draft so a reconnect doesn't bring it back
+        self.draft_store.clear()
     
     def _display_module_data_summary(self, module_id, module_data):
         """Display a summary of entered module data.
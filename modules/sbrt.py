@@ -1,6 +1,12 @@
 import streamlit as st
+import numpy as np
 from .base_module import BaseWriteUpModule
 from validation_utils import FormValidator, validate_dose_fractionation
+from plan_quality_utils import sbrt_plan_metrics, load_sbrt_tables, grade_sbrt_metrics, sbrt_tables_apply
+from radiobiology_utils import load_dose_grid, translate_constraints
+from utils import save_uploaded_file
+from constraint_utils import get_constraint_library, describe_rules
+from motion_utils import build_itv, iter_phase_masks, summarize_motion
 
 class SBRTModule(BaseWriteUpModule):
     """SBRT module for clinical documentation generation.
@@ -19,6 +25,16 @@ class SBRTModule(BaseWriteUpModule):
             "lung", "liver", "spine", "adrenal", "pancreas", 
             "kidney", "prostate", "lymph node", "bone", "oligometastasis"
         ]
+        
+        # Volume-dependent conformality criteria used to grade plan metrics
+        self.conformity_tables = load_sbrt_tables()
+        
+        # Verdict wording for the write-up
+        self.deviation_text = {
+            "none": "met the protocol criterion",
+            "minor": "was a minor deviation",
+            "major": "was a major deviation"
+        }
     
     def get_module_name(self):
         """Return the display name of this module."""
@@ -32,8 +48,24 @@ class SBRTModule(BaseWriteUpModule):
         """Return a list of required field names for this module."""
         return ["treatment_site", "dose", "fractions", "is_4dct", "target_volume", "ptv_coverage"]
     
+    def apply_prefill(self, data):
+        """Queue plan values for the dose, fractions and target volume inputs."""
+        fields = {"dose": "sbrt_dose", "fractions": "sbrt_fractions", "target_volume": "target_volume"}
+        pending = {widget_key: data[field] for field, widget_key in fields.items() if data.get(field) is not None}
+        if "sbrt_fractions" in pending:
+            fractions = int(pending.pop("sbrt_fractions"))
+            # The fractions input only accepts 1-10
+            if 1 <= fractions <= 10:
+                pending["sbrt_fractions"] = fractions
+        st.session_state.sbrt_pending_metrics = {**st.session_state.get("sbrt_pending_metrics", {}), **pending}
+    
     def render_specialized_fields(self, physician, physicist, patient_age, patient_sex, patient_details):
         """Render SBRT-specific input fields and return the generated data."""
+        # Metrics computed from a dose grid on the previous run, or prefilled
+        # plan values, fill the inputs before they are drawn
+        for key, value in st.session_state.pop("sbrt_pending_metrics", {}).items():
+            st.session_state[key] = value
+        
         # Create tabs for Basic Info and Treatment Details
         basic_tab, treatment_tab, metrics_tab = st.tabs([
             "Basic Information", "Treatment Details", "Plan Metrics"
@@ -74,6 +106,8 @@ class SBRTModule(BaseWriteUpModule):
                 
                 # PTV coverage
                 ptv_coverage = st.slider("PTV Coverage (%)", 90, 100, 95, key="ptv_coverage")
+            
+            self._render_itv_from_phases()
         
         with metrics_tab:
             # Plan quality metrics
@@ -96,6 +130,27 @@ class SBRTModule(BaseWriteUpModule):
                                     step=0.1,
                                     key="r50")
             
+            self._render_metrics_from_dose_grid(dose)
+            
+            # Grade the metrics against the volume-dependent protocol criteria
+            d2cm_percent = st.session_state.get("sbrt_d2cm_percent")
+            grades = grade_sbrt_metrics(
+                target_volume, {"pitv": pitv, "r50": r50, "d2cm": d2cm_percent}, self.conformity_tables,
+                treatment_site
+            )
+            if not sbrt_tables_apply(treatment_site, self.conformity_tables):
+                st.caption(f"The RTOG 0813/0915 conformality criteria are for lung SBRT; "
+                           f"{treatment_site} plans are not graded.")
+            for grade in grades.values():
+                message = (f"{grade['label']} {grade['value']:.2f}: no deviation < {grade['none']:.2f}, "
+                           f"minor ≤ {grade['minor']:.2f}")
+                if grade["verdict"] == "none":
+                    st.success(message)
+                elif grade["verdict"] == "minor":
+                    st.warning(message)
+                else:
+                    st.error(message)
+            
             # Add section for dose constraints
             st.markdown("#### Organ-at-Risk Constraints")
             
@@ -103,9 +158,11 @@ class SBRTModule(BaseWriteUpModule):
             if treatment_site:
                 constraints = self._get_dose_constraints(treatment_site)
                 if constraints:
-                    st.info(f"Reference constraints for {treatment_site} SBRT:")
+                    st.info(f"Reference constraints for {treatment_site} SBRT, with LQ-equivalent "
+                            f"limits for {fractions} fractions:")
+                    translated = translate_constraints(self._get_constraint_site(treatment_site), "sbrt", fractions)
                     for organ, limit in constraints.items():
-                        st.write(f"- **{organ}**: {limit}")
+                        st.write(f"- **{organ}**: {limit} ({fractions} fx: {describe_rules(translated[organ])})")
                 else:
                     st.info("No specific constraints available for this site.")
         
@@ -133,8 +190,13 @@ class SBRTModule(BaseWriteUpModule):
             if is_4dct == "Yes":
                 motion_text = "The patient was scanned in our CT simulator in the treatment position. "
                 motion_text += "A 4D kVCT simulation scan was performed with the patient immobilized to assess respiratory motion. "
-                motion_text += "Using the 4D dataset, a Maximum Intensity Projection (MIP) CT image set was reconstructed to generate an ITV "
-                motion_text += "that encompasses the motion envelope of the target."
+                motion_stats = st.session_state.get("sbrt_motion_stats")
+                if motion_stats:
+                    # The ITV was built from the phase GTVs, not from a MIP
+                    motion_text += self._motion_sentence(motion_stats)
+                else:
+                    motion_text += "Using the 4D dataset, a Maximum Intensity Projection (MIP) CT image set was reconstructed to generate an ITV "
+                    motion_text += "that encompasses the motion envelope of the target."
             else:
                 motion_text = "The patient was scanned in our CT simulator in the treatment position. "
                 motion_text += "The patient was immobilized using a customized immobilization device to limit motion during treatment and aid in inter-fractional repositioning."
@@ -153,6 +215,9 @@ class SBRTModule(BaseWriteUpModule):
                 "ptv_coverage": ptv_coverage,
                 "pitv": pitv,
                 "r50": r50,
+                "d2cm_percent": d2cm_percent,
+                "conformity_grades": grades,
+                "motion_stats": st.session_state.get("sbrt_motion_stats") if is_4dct == "Yes" else None,
                 "motion_text": motion_text,
                 "imaging_text": imaging_text
             }
@@ -172,6 +237,7 @@ class SBRTModule(BaseWriteUpModule):
         ptv_coverage = module_data.get("ptv_coverage", 95)
         pitv = module_data.get("pitv", 1.0)
         r50 = module_data.get("r50", 3.5)
+        d2cm_percent = module_data.get("d2cm_percent")
         motion_text = module_data.get("motion_text", "")
         imaging_text = module_data.get("imaging_text", "")
         
@@ -199,6 +265,9 @@ class SBRTModule(BaseWriteUpModule):
         write_up += f"the target volume of {target_volume} cc in all three spatial dimensions and that the dose fell sharply away from the target volume. "
         write_up += f"The treatment plan covered {ptv_coverage}% of the PTV with the prescribed isodose volume. "
         write_up += f"The PITV (Vpres iso / VPTV) was {pitv} and the R50 (Vol50% pres iso / VolPTV) was {r50}. "
+        if d2cm_percent is not None:
+            write_up += f"The maximum dose 2 cm from the PTV (D2cm) was {d2cm_percent:.1f}% of the prescription. "
+        write_up += self._deviation_summary(target_volume, module_data.get("conformity_grades"))
         write_up += "Normal tissue dose constraints for critical organs associated with the treatment site were reviewed.\n\n"
         
         # Image guidance section
@@ -210,63 +279,155 @@ class SBRTModule(BaseWriteUpModule):
         
         return write_up
     
-    def _get_dose_constraints(self, site):
-        """Get dose constraints for a specific treatment site."""
-        # SBRT dose constraints based on treatment site
-        constraints = {
-            "lung": {
-                "Spinal Cord": "Dmax < 18 Gy",
-                "Esophagus": "Dmax < 27 Gy",
-                "Brachial Plexus": "Dmax < 24 Gy",
-                "Heart": "Dmax < 30 Gy",
-                "Trachea": "Dmax < 30 Gy",
-                "Great vessels": "Dmax < 39 Gy"
-            },
-            "liver": {
-                "Liver (normal)": "V15 < 700 cc",
-                "Spinal Cord": "Dmax < 18 Gy",
-                "Stomach": "Dmax < 30 Gy",
-                "Duodenum": "Dmax < 24 Gy",
-                "Kidney": "V12 < 25%",
-                "Small Bowel": "Dmax < 27 Gy"
-            },
-            "spine": {
-                "Spinal Cord": "Dmax < 14 Gy",
-                "Cauda Equina": "Dmax < 16 Gy",
-                "Esophagus": "Dmax < 15 Gy",
-                "Kidney": "V12 < 25%"
-            },
-            "pancreas": {
-                "Duodenum": "Dmax < 24 Gy",
-                "Stomach": "Dmax < 22 Gy",
-                "Small Bowel": "Dmax < 27 Gy",
-                "Kidney": "V12 < 25%",
-                "Liver": "V15 < 700 cc"
-            },
-            "prostate": {
-                "Rectum": "V36 < 1 cc",
-                "Bladder": "V37 < 10 cc",
-                "Urethra": "V37 < 0.5 cc",
-                "Femoral Head": "V24 < 3 cc"
-            }
-        }
+    def _deviation_summary(self, target_volume, grades):
+        """Describe how the plan metrics compare with the protocol conformality criteria.
+        
+        Args:
+            target_volume: PTV volume in cc
+            grades: Grades computed by grade_sbrt_metrics when the form was rendered
+                (empty or None for sites the criteria do not cover)
+        """
+        if not grades:
+            return ""
+        
+        verdicts = [f"the {grade['label']} {self.deviation_text[grade['verdict']]}" for grade in grades.values()]
+        if len(verdicts) > 1:
+            verdicts = ", ".join(verdicts[:-1]) + f" and {verdicts[-1]}"
+        else:
+            verdicts = verdicts[0]
+        return (f"Compared with the RTOG 0813/0915 conformality criteria for a {target_volume} cc PTV, "
+                f"{verdicts}. ")
+    
+    def _render_itv_from_phases(self):
+        """Build the ITV from per-phase GTV masks and mark the plan as 4DCT-based.
+        
+        The ITV volume is kept with the motion statistics only; the target
+        volume field stays the PTV volume the conformality criteria are graded on.
+        """
+        with st.expander("Build ITV from 4DCT Phases", expanded=False):
+            st.caption("Upload one boolean GTV mask (.npy) per respiratory phase, or a single 4D array "
+                       "with the phases on the first axis, all on the same grid.")
+            phase_files = st.file_uploader("Phase GTV Masks", type=["npy"], accept_multiple_files=True,
+                                           key="sbrt_phase_files")
+            
+            spacing_cols = st.columns(3)
+            spacing = [
+                spacing_cols[i].number_input(f"{axis} Spacing (mm)", min_value=0.1, value=2.5, step=0.5,
+                                             key=f"sbrt_phase_spacing_{i}")
+                for i, axis in enumerate(["Slice", "Row", "Column"])
+            ]
+            
+            if phase_files and st.button("Build ITV", key="sbrt_build_itv"):
+                try:
+                    paths = [save_uploaded_file(phase_file) for phase_file in phase_files]
+                    result = build_itv(iter_phase_masks(paths), spacing)
+                except (ValueError, OSError) as e:
+                    st.error(f"Could not build the ITV: {e}")
+                    return
+                
+                st.session_state.sbrt_motion_stats = summarize_motion(result)
+                st.session_state.sbrt_pending_metrics = {
+                    **st.session_state.get("sbrt_pending_metrics", {}),
+                    "is_4dct": "Yes",
+                }
+                st.rerun()
+            
+            motion_stats = st.session_state.get("sbrt_motion_stats")
+            if motion_stats:
+                col1, col2, col3 = st.columns(3)
+                col1.metric("ITV Volume", f"{motion_stats['itv_volume']} cc")
+                col2.metric("ITV/GTV Ratio", f"{motion_stats['itv_gtv_ratio']:.2f}")
+                col3.metric("3D Motion", f"{motion_stats['motion_3d']} mm")
+                st.write("**Peak-to-peak centroid motion**: " + ", ".join(
+                    f"{axis} {value} mm" for axis, value in motion_stats["motion"].items()
+                ))
+                st.caption("The ITV volume is reported in the motion management section; enter the PTV "
+                           "volume as the target volume.")
+                if st.button("Clear ITV Results", key="sbrt_clear_itv"):
+                    del st.session_state.sbrt_motion_stats
+                    st.rerun()
+    
+    def _motion_sentence(self, motion_stats):
+        """Motion-management sentence for an ITV built from 4DCT phases."""
+        motion = motion_stats["motion"]
+        return (f"Using the 4D dataset, the GTV was contoured on all {motion_stats['phases']} respiratory phases and "
+                f"the ITV was generated as their union to encompass the motion envelope of the target. The GTV "
+                f"centroid moved {motion['SI']} mm superior-inferior, {motion['AP']} mm anterior-posterior and "
+                f"{motion['LR']} mm left-right, and the ITV of {motion_stats['itv_volume']} cc is "
+                f"{motion_stats['itv_gtv_ratio']:.2f} times the mean GTV volume.")
+    
+    def _render_metrics_from_dose_grid(self, prescription):
+        """Compute PITV, R50, coverage and D2cm from an uploaded dose grid and PTV mask."""
+        with st.expander("Compute Metrics from Dose Grid", expanded=False):
+            st.caption("Upload the plan dose (.npy in Gy, or DICOM RT Dose) and a boolean PTV mask (.npy) on the same grid.")
+            
+            dose_file = st.file_uploader("Dose Grid", type=["npy", "dcm"], key="sbrt_dose_file")
+            ptv_file = st.file_uploader("PTV Mask", type=["npy"], key="sbrt_ptv_file")
+            
+            spacing_cols = st.columns(3)
+            spacing = [
+                spacing_cols[i].number_input(f"{axis} Spacing (mm)", min_value=0.1, value=2.5, step=0.5,
+                                             key=f"sbrt_spacing_{i}")
+                for i, axis in enumerate(["Slice", "Row", "Column"])
+            ]
+            
+            if dose_file and ptv_file and prescription > 0 and st.button("Compute Plan Metrics", key="sbrt_compute_metrics"):
+                try:
+                    dose = load_dose_grid(save_uploaded_file(dose_file))
+                    ptv = np.load(save_uploaded_file(ptv_file), mmap_mode="r")
+                    metrics = sbrt_plan_metrics(dose, ptv, prescription, spacing)
+                except (ValueError, ImportError, OSError) as e:
+                    st.error(f"Could not compute plan metrics: {e}")
+                    return
+                
+                # Only fill inputs whose widgets accept the computed value
+                pending = {}
+                warnings = []
+                for key, value, low, high in [
+                    ("target_volume", round(metrics["target_volume"], 2), 0.01, None),
+                    ("ptv_coverage", int(round(metrics["coverage"])), 90, 100),
+                    ("pitv", round(metrics["pitv"], 2), 0.0, 2.0),
+                    ("r50", round(metrics["r50"], 2), 0.0, 10.0),
+                ]:
+                    if value < low or (high is not None and value > high):
+                        warnings.append(f"Computed {key.replace('_', ' ')} of {value} is outside the form's range and was not applied")
+                    else:
+                        pending[key] = value
+                
+                st.session_state.sbrt_pending_metrics = pending
+                st.session_state.sbrt_d2cm_percent = round(metrics["d2cm_percent"], 1)
+                st.session_state.sbrt_metric_warnings = warnings
+                st.rerun()
+            
+            for warning in st.session_state.pop("sbrt_metric_warnings", []):
+                st.warning(warning)
+            
+            if st.session_state.get("sbrt_d2cm_percent") is not None:
+                st.write(f"**D2cm**: {st.session_state.sbrt_d2cm_percent}% of prescription")
+                if st.button("Clear D2cm", key="sbrt_clear_d2cm"):
+                    del st.session_state.sbrt_d2cm_percent
+                    st.rerun()
+    
+    def _get_constraint_site(self, site):
+        """Map a treatment site to the site its SBRT constraints are stored under."""
+        library = get_constraint_library()
         
         # Handle oligometastasis sites
         if "oligometastatic" in site:
             base_site = site.split(" ")[1]
             # Try to find constraints for the specific oligometastasis location
-            for known_site in constraints:
-                if known_site in base_site:
-                    return constraints[known_site]
+            for known_site in library.sites("sbrt"):
+                if known_site != "oligometastatic" and known_site in base_site:
+                    return known_site
             # Default to generic constraints if specific location not found
-            return {
-                "Spinal Cord": "Dmax < 18 Gy",
-                "Small Bowel": "Dmax < 27 Gy",
-                "Kidney": "V12 < 25%",
-                "Liver": "V15 < 700 cc"
-            }
+            return "oligometastatic"
         
-        return constraints.get(site.lower(), {})
+        return site.lower()
+    
+    def _get_dose_constraints(self, site):
+        """Get dose constraints for a specific treatment site."""
+        # SBRT dose constraints based on treatment site
+        return get_constraint_library().get_display_constraints(self._get_constraint_site(site), "sbrt")
     
     # Legacy method for backward compatibility
     def render_sbrt_form(self):
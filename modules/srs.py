@@ -1,6 +1,10 @@
 import streamlit as st
+import numpy as np
 from .base_module import BaseWriteUpModule
 from validation_utils import FormValidator, validate_dose_fractionation
+from plan_quality_utils import srs_lesion_metrics
+from radiobiology_utils import load_dose_grid
+from utils import save_uploaded_file
 
 class SRSModule(BaseWriteUpModule):
     """SRS module for clinical documentation generation.
@@ -54,6 +58,40 @@ class SRSModule(BaseWriteUpModule):
         """Return a list of required field names for this module."""
         return ["lesions"]
     
+    def apply_prefill(self, data):
+        """Replace the lesion table with one lesion per plan target.
+        
+        Fields the plan does not give (site, plan quality metrics) keep the
+        form's defaults, and the lesion widgets are reset so they show the
+        new values.
+        """
+        lesions = data.get("lesions", [])[:10]
+        if not lesions:
+            return
+        
+        table = []
+        for i, planned in enumerate(lesions):
+            fractions = int(planned.get("fractions") or 1)
+            lesion = {
+                'site': self.brain_regions[0],
+                'volume': planned.get("volume") or 1.5,
+                'treatment_type': self.treatment_types["SRS" if fractions == 1 else "SRT"],
+                'dose': planned.get("dose") or 18.0,
+                'fractions': min(fractions, 10),
+                'prescription_isodose': 80.0,
+                'ptv_coverage': 98.0,
+                'conformity_index': 1.2,
+                'gradient_index': 3.0,
+                'max_dose': 125
+            }
+            lesion['volume'] = max(lesion['volume'], 0.01)
+            table.append(lesion)
+            for widget in ("treatment_type", "fractions", "volume", "dose"):
+                st.session_state.pop(f"lesion_{widget}_{i}", None)
+        
+        st.session_state.srs_lesions = table
+        st.session_state.num_lesions = len(table)
+    
     def render_specialized_fields(self, physician, physicist, patient_age, patient_sex, patient_details):
         """Render the specialized fields for SRS write-ups with multiple lesion support."""
         
@@ -131,6 +169,9 @@ class SRSModule(BaseWriteUpModule):
                 # Remove excess lesions
                 st.session_state.srs_lesions = st.session_state.srs_lesions[:num_lesions]
             
+            # Derive plan metrics from an exported dose grid
+            self._render_metrics_from_dose_grid()
+            
             # Copy feature for multiple lesions
             if num_lesions > 1:
                 with st.expander("Quick Copy Tool", expanded=False):
@@ -533,6 +574,8 @@ class SRSModule(BaseWriteUpModule):
             write_up += f"| Prescription Isodose | {lesion['prescription_isodose']}% |\n"
             write_up += f"| PTV Coverage | {lesion['ptv_coverage']}% |\n"
             write_up += f"| Conformity Index | {lesion['conformity_index']} |\n"
+            if lesion.get('paddick_ci') is not None:
+                write_up += f"| Paddick Conformity Index | {lesion['paddick_ci']} |\n"
             write_up += f"| Gradient Index | {lesion['gradient_index']} |\n"
             write_up += f"| Maximum Dose | {lesion['max_dose']}% |\n\n"
         else:
@@ -568,6 +611,84 @@ class SRSModule(BaseWriteUpModule):
         
         return write_up
     
+    def _render_metrics_from_dose_grid(self):
+        """Compute lesion plan metrics from an uploaded dose grid and labeled target mask.
+        
+        Lesion N is the region labeled N in the mask. Computed values replace
+        the lesion's volume, isodose, coverage, CI, GI and max dose fields.
+        """
+        with st.expander("Compute Metrics from Dose Grid", expanded=False):
+            st.caption("Upload the plan dose (.npy in Gy, or DICOM RT Dose) and a target mask (.npy) on the "
+                       "same grid where lesion 1 is labeled 1, lesion 2 is labeled 2, and so on.")
+            
+            dose_file = st.file_uploader("Dose Grid", type=["npy", "dcm"], key="srs_dose_file")
+            labels_file = st.file_uploader("Target Label Mask", type=["npy"], key="srs_labels_file")
+            
+            spacing_cols = st.columns(3)
+            spacing = [
+                spacing_cols[i].number_input(f"{axis} Spacing (mm)", min_value=0.1, value=1.0, step=0.25,
+                                             key=f"srs_spacing_{i}")
+                for i, axis in enumerate(["Slice", "Row", "Column"])
+            ]
+            
+            if dose_file and labels_file and st.button("Compute Plan Metrics", key="srs_compute_metrics"):
+                try:
+                    dose = load_dose_grid(save_uploaded_file(dose_file))
+                    labels = np.load(save_uploaded_file(labels_file), mmap_mode="r")
+                    prescriptions = {i + 1: lesion["dose"] for i, lesion in enumerate(st.session_state.srs_lesions)}
+                    metrics = srs_lesion_metrics(dose, np.asarray(labels), prescriptions, spacing)
+                except (ValueError, ImportError, OSError) as e:
+                    st.error(f"Could not compute plan metrics: {e}")
+                    return
+                
+                if not metrics:
+                    st.warning("No labeled targets matched the lesions in this form.")
+                    return
+                
+                st.session_state.srs_metric_warnings = self._apply_lesion_metrics(metrics)
+                st.rerun()
+            
+            for warning in st.session_state.pop("srs_metric_warnings", []):
+                st.warning(warning)
+    
+    def _apply_lesion_metrics(self, metrics):
+        """Copy computed metrics into the lesion table and reset the affected widgets.
+        
+        Args:
+            metrics: Dict mapping lesion label (1-based) to srs_lesion_metrics output
+            
+        Returns:
+            list: Warnings for values outside the form's input ranges
+        """
+        warnings = []
+        for label, values in metrics.items():
+            i = label - 1
+            if i >= len(st.session_state.srs_lesions):
+                warnings.append(f"Mask label {label} has no matching lesion in the form")
+                continue
+            lesion = st.session_state.srs_lesions[i]
+            
+            updates = {
+                "volume": (round(values["target_volume"], 2), 0.01, None, f"lesion_volume_{i}"),
+                "prescription_isodose": (round(values["prescription_isodose"], 1), 80.0, 100.0, f"lesion_isodose_{i}"),
+                "ptv_coverage": (round(values["coverage"], 1), 90.0, 100.0, f"lesion_coverage_{i}"),
+                "conformity_index": (round(values["rtog_ci"], 2), 0.01, 3.0, f"lesion_ci_text_{i}"),
+                "gradient_index": (round(values["gradient_index"], 2), 0.01, 10.0, f"lesion_gi_text_{i}"),
+                "max_dose": (int(round(values["max_dose_percent"])), 110, 150, f"lesion_maxdose_{i}"),
+            }
+            for field, (value, low, high, widget_key) in updates.items():
+                if value < low or (high is not None and value > high):
+                    warnings.append(f"Lesion {label}: computed {field.replace('_', ' ')} of {value} is outside "
+                                    f"the form's range and was not applied")
+                    continue
+                lesion[field] = value
+                # Drop the widget's state so it picks up the new value
+                st.session_state.pop(widget_key, None)
+            
+            lesion["paddick_ci"] = round(values["paddick_ci"], 2)
+        
+        return warnings
+    
     # Legacy method for backward compatibility
     def render_srs_form(self):
         """Legacy method to maintain backward compatibility."""
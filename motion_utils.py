@@ -0,0 +1,94 @@
+import numpy as np
+
+# Array axes of an axial image stack, as patient directions
+AXIS_NAMES = ("SI", "AP", "LR")
+
+
+def iter_phase_masks(paths):
+    """Yield the phase masks stored in .npy files, memory-mapped.
+
+    Each file holds either one phase (3D) or all phases stacked on the first
+    axis (4D); only the phase being processed is read into memory.
+    """
+    for path in paths:
+        masks = np.load(path, mmap_mode="r")
+        if masks.ndim == 4:
+            yield from masks
+        elif masks.ndim == 3:
+            yield masks
+        else:
+            raise ValueError(f"Phase mask {path} must be 3D or 4D, got {masks.ndim}D")
+
+
+def build_itv(phase_masks, spacing_mm):
+    """Union the per-phase GTV masks into an ITV and measure the target motion.
+
+    Phases are consumed one at a time, so memory holds the ITV and a single
+    phase regardless of how many phases there are. Each phase's centroid
+    comes from its three axis profiles rather than voxel coordinates.
+
+    Args:
+        phase_masks: Iterable of boolean masks on the same (slice, row, column) grid
+        spacing_mm: Voxel spacing (slice, row, column) in mm
+
+    Returns:
+        dict: "itv" mask, "itv_volume" and per-phase "gtv_volumes" (cc),
+            per-phase "centroids" (mm, phases x 3), "motion" peak-to-peak
+            centroid motion per axis (mm), "motion_3d" largest distance between
+            phase centroids (mm), "mean_gtv_volume" and "itv_gtv_ratio"
+            (ITV over mean GTV volume)
+    """
+    spacing = np.asarray(spacing_mm, dtype=float)
+    voxel_cc = float(np.prod(spacing)) / 1000.0
+    itv = None
+    volumes, centroids = [], []
+
+    for index, phase in enumerate(phase_masks):
+        phase = np.asarray(phase, dtype=bool)
+        if itv is None:
+            itv = np.zeros(phase.shape, dtype=bool)
+        elif phase.shape != itv.shape:
+            raise ValueError(f"Phase {index + 1} has shape {phase.shape}, expected {itv.shape}")
+
+        np.logical_or(itv, phase, out=itv)
+
+        # Centroid per axis from the mask's projection onto that axis
+        slice_row = phase.sum(axis=2)
+        profiles = (slice_row.sum(axis=1), slice_row.sum(axis=0), phase.sum(axis=(0, 1)))
+        count = int(profiles[0].sum())
+        if not count:
+            raise ValueError(f"Phase {index + 1} has an empty GTV mask")
+        centroid = [np.dot(profile, np.arange(profile.size)) / count for profile in profiles]
+        volumes.append(count * voxel_cc)
+        centroids.append(np.asarray(centroid) * spacing)
+
+    if itv is None:
+        raise ValueError("No phase masks were given")
+
+    volumes = np.asarray(volumes)
+    centroids = np.asarray(centroids)
+    offsets = centroids[:, np.newaxis, :] - centroids[np.newaxis, :, :]
+    itv_volume = float(np.count_nonzero(itv)) * voxel_cc
+
+    return {
+        "itv": itv,
+        "itv_volume": itv_volume,
+        "gtv_volumes": volumes,
+        "mean_gtv_volume": float(volumes.mean()),
+        "itv_gtv_ratio": itv_volume / float(volumes.mean()),
+        "centroids": centroids,
+        "motion": centroids.max(axis=0) - centroids.min(axis=0),
+        "motion_3d": float(np.sqrt((offsets ** 2).sum(axis=-1)).max()),
+    }
+
+
+def summarize_motion(result):
+    """Rounded plain-dict summary of build_itv results for display and the write-up."""
+    return {
+        "phases": int(len(result["gtv_volumes"])),
+        "itv_volume": round(result["itv_volume"], 2),
+        "mean_gtv_volume": round(result["mean_gtv_volume"], 2),
+        "itv_gtv_ratio": round(result["itv_gtv_ratio"], 2),
+        "motion": {name: round(float(value), 1) for name, value in zip(AXIS_NAMES, result["motion"])},
+        "motion_3d": round(result["motion_3d"], 1),
+    }
@@ -0,0 +1,309 @@
+import json
+
+import numpy as np
+
+try:
+    from scipy.ndimage import distance_transform_edt
+except ImportError:  # Fall back to the NumPy transform below
+    distance_transform_edt = None
+
+SBRT_TABLES_FILE = "data/sbrt_conformity_tables.json"
+
+# Distance from the PTV at which D2cm is evaluated
+D2CM_DISTANCE_MM = 20.0
+
+# Margin around each lesion's bounding box; must be wide enough to contain
+# the lesion's 50% isodose so the gradient index is complete
+DEFAULT_MARGIN_MM = 20.0
+
+
+def label_bounding_boxes(labels):
+    """Bounding box of every nonzero label in a labeled mask, in one pass.
+
+    Args:
+        labels: Integer array where each target is marked with its label
+
+    Returns:
+        dict: Label mapped to a tuple of (start, stop) index pairs per axis
+    """
+    coords = np.nonzero(labels)
+    if not coords[0].size:
+        return {}
+    values = labels[coords]
+
+    # Sort voxels by label once, then each label's coordinates are one slice
+    order = np.argsort(values, kind="stable")
+    values = values[order]
+    coords = [c[order] for c in coords]
+    unique, starts = np.unique(values, return_index=True)
+    stops = np.append(starts[1:], values.size)
+
+    boxes = {}
+    for label, start, stop in zip(unique, starts, stops):
+        boxes[int(label)] = tuple((int(c[start:stop].min()), int(c[start:stop].max()) + 1) for c in coords)
+    return boxes
+
+
+def _expand_box(box, margin_voxels, shape):
+    return tuple(
+        slice(max(lo - m, 0), min(hi + m, size))
+        for (lo, hi), m, size in zip(box, margin_voxels, shape)
+    )
+
+
+def _boxes_overlap(first, second):
+    return all(a.start < b.stop and b.start < a.stop for a, b in zip(first, second))
+
+
+def _nearest_lesion_voxels(labels, label, region, margin_voxels, spacing_mm):
+    """Voxels of region at least as close to lesion label as to any other lesion.
+
+    Distances are measured within region grown by the margin, so the parts
+    of neighbouring lesions that can be nearest to it are included.
+    """
+    outer = _expand_box([(s.start, s.stop) for s in region], margin_voxels, labels.shape)
+    nearby = np.asarray(labels[outer])
+    own = distance_from_mask(nearby == label, spacing_mm)
+    other = distance_from_mask((nearby != 0) & (nearby != label), spacing_mm)
+    inner = tuple(slice(r.start - o.start, r.stop - o.start) for r, o in zip(region, outer))
+    return (own <= other)[inner]
+
+
+def srs_lesion_metrics(dose, labels, prescriptions, spacing_mm, margin_mm=DEFAULT_MARGIN_MM):
+    """Plan-quality metrics for every lesion of a (multi-target) SRS plan.
+
+    The prescription and 50% isodose masks are thresholded once over the
+    whole grid per distinct prescription dose; each lesion is then evaluated
+    only inside its bounding box grown by margin_mm. Where that box reaches
+    another lesion's, isodose voxels are split between the lesions by
+    distance, each voxel going to the nearest lesion, so a neighbour's
+    isodose volume does not inflate the CI and GI.
+
+    Args:
+        dose: 3D dose array in Gy
+        labels: Integer array of the same shape marking each target with its label
+        prescriptions: Prescription dose in Gy, or dict mapping label to prescription
+        spacing_mm: Voxel spacing (slice, row, column) in mm
+        margin_mm: Margin around each target's bounding box in mm
+
+    Returns:
+        dict: Label mapped to a dict with target_volume (cc), coverage (%),
+            rtog_ci, paddick_ci, gradient_index, max_dose (Gy), max_dose_percent
+            and prescription_isodose (%)
+    """
+    if dose.shape != labels.shape:
+        raise ValueError(f"Target labels have shape {labels.shape}, dose grid has {dose.shape}")
+
+    boxes = label_bounding_boxes(labels)
+    if not isinstance(prescriptions, dict):
+        prescriptions = dict.fromkeys(boxes, prescriptions)
+
+    voxel_cc = float(np.prod(spacing_mm)) / 1000.0
+    margin_voxels = [int(np.ceil(margin_mm / s)) for s in spacing_mm]
+
+    regions = {label: _expand_box(box, margin_voxels, dose.shape) for label, box in boxes.items()}
+
+    # One threshold pass per distinct prescription, shared by its lesions
+    thresholds = {}
+    for rx in set(prescriptions[label] for label in boxes if label in prescriptions):
+        thresholds[rx] = (dose >= rx, dose >= 0.5 * rx)
+
+    metrics = {}
+    for label, box in boxes.items():
+        rx = prescriptions.get(label)
+        if not rx:
+            continue
+        piv_mask, half_mask = thresholds[rx]
+        region = regions[label]
+
+        target = labels[region] == label
+        piv = piv_mask[region]
+        half = half_mask[region]
+        if any(_boxes_overlap(region, regions[other]) for other in regions if other != label):
+            nearest = _nearest_lesion_voxels(labels, label, region, margin_voxels, spacing_mm)
+            piv, half = piv & nearest, half & nearest
+        target_voxels = np.count_nonzero(target)
+        piv_voxels = np.count_nonzero(piv)
+        covered_voxels = np.count_nonzero(piv & target)
+        half_voxels = np.count_nonzero(half)
+        max_dose = float(np.asarray(dose[region])[target].max())
+
+        metrics[label] = {
+            "target_volume": float(target_voxels * voxel_cc),
+            "coverage": float(100.0 * covered_voxels / target_voxels),
+            "rtog_ci": float(piv_voxels / target_voxels),
+            "paddick_ci": float(covered_voxels ** 2 / (target_voxels * piv_voxels)) if piv_voxels else 0.0,
+            "gradient_index": float(half_voxels / piv_voxels) if piv_voxels else float("inf"),
+            "max_dose": max_dose,
+            "max_dose_percent": 100.0 * max_dose / rx,
+            "prescription_isodose": 100.0 * rx / max_dose if max_dose else 0.0,
+        }
+    return metrics
+
+
+def _squared_distance_1d(f, spacing):
+    """Exact squared distance along the last axis: min_j f[..., j] + ((i - j) * spacing)^2."""
+    f = np.ascontiguousarray(f)
+    positions = np.arange(f.shape[-1]) * spacing
+    offsets = (positions[:, np.newaxis] - positions[np.newaxis, :]) ** 2
+    out = np.empty(f.shape)
+    # Lines are processed in blocks so the (lines, n, n) temporary stays small
+    lines = f.reshape(-1, f.shape[-1])
+    flat_out = out.reshape(-1, f.shape[-1])
+    block = max(1, 2 ** 22 // (f.shape[-1] ** 2))
+    for start in range(0, lines.shape[0], block):
+        flat_out[start:start + block] = (lines[start:start + block, np.newaxis, :] + offsets).min(axis=2)
+    return out
+
+
+def distance_from_mask(mask, spacing_mm):
+    """Euclidean distance in mm from every voxel to the nearest voxel of mask.
+
+    Uses scipy's transform when installed, otherwise an exact separable
+    transform in NumPy that is fine for the cropped regions used here.
+
+    Args:
+        mask: Boolean 3D array
+        spacing_mm: Voxel spacing (slice, row, column) in mm
+
+    Returns:
+        numpy.ndarray: Distance in mm (0 inside the mask)
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if distance_transform_edt is not None:
+        return distance_transform_edt(~mask, sampling=spacing_mm)
+
+    squared = np.where(mask, 0.0, np.inf)
+    for axis, spacing in enumerate(spacing_mm):
+        squared = np.moveaxis(_squared_distance_1d(np.moveaxis(squared, axis, -1), spacing), -1, axis)
+    return np.sqrt(squared)
+
+
+def sbrt_plan_metrics(dose, ptv_mask, prescription, spacing_mm, d2cm_distance_mm=D2CM_DISTANCE_MM):
+    """PTV volume, coverage, PITV, R50 and D2cm for an SBRT plan.
+
+    D2cm is the maximum dose anywhere at least 2 cm from the PTV. The
+    distance transform only runs on the PTV bounding box grown by 2 cm,
+    since every voxel outside that box is already further away.
+
+    Args:
+        dose: 3D dose array in Gy
+        ptv_mask: Boolean PTV mask with the same shape
+        prescription: Prescription dose in Gy
+        spacing_mm: Voxel spacing (slice, row, column) in mm
+        d2cm_distance_mm: Distance from the PTV for D2cm
+
+    Returns:
+        dict: target_volume (cc), coverage (%), pitv, r50, d2cm (Gy) and
+            d2cm_percent (% of prescription)
+    """
+    ptv_mask = np.asarray(ptv_mask, dtype=bool)
+    if dose.shape != ptv_mask.shape:
+        raise ValueError(f"PTV mask has shape {ptv_mask.shape}, dose grid has {dose.shape}")
+    if not ptv_mask.any():
+        raise ValueError("The PTV mask is empty")
+
+    voxel_cc = float(np.prod(spacing_mm)) / 1000.0
+    dose = np.asarray(dose)
+    ptv_voxels = np.count_nonzero(ptv_mask)
+    piv = dose >= prescription
+
+    # Box that contains everything closer than d2cm_distance_mm to the PTV
+    box = label_bounding_boxes(ptv_mask.astype(np.uint8))[1]
+    margin_voxels = [int(np.ceil(d2cm_distance_mm / s)) + 1 for s in spacing_mm]
+    region = _expand_box(box, margin_voxels, dose.shape)
+
+    distance = distance_from_mask(ptv_mask[region], spacing_mm)
+    outside = np.ones(dose.shape, dtype=bool)
+    outside[region] = distance >= d2cm_distance_mm
+    d2cm = float(dose[outside].max()) if outside.any() else 0.0
+
+    return {
+        "target_volume": float(ptv_voxels * voxel_cc),
+        "coverage": float(100.0 * np.count_nonzero(piv & ptv_mask) / ptv_voxels),
+        "pitv": float(np.count_nonzero(piv) / ptv_voxels),
+        "r50": float(np.count_nonzero(dose >= 0.5 * prescription) / ptv_voxels),
+        "d2cm": d2cm,
+        "d2cm_percent": 100.0 * d2cm / prescription,
+    }
+
+
+def load_sbrt_tables(path=SBRT_TABLES_FILE):
+    """Load the volume-dependent SBRT conformality tables."""
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def interpolate_sbrt_limits(ptv_volumes, tables):
+    """Deviation limits for every metric at each PTV volume, in one vectorized step.
+
+    Limits are linearly interpolated between the tabulated PTV volumes and
+    held at the first/last row outside the table.
+
+    Args:
+        ptv_volumes: PTV volume(s) in cc
+        tables: Tables from load_sbrt_tables
+
+    Returns:
+        dict: Metric mapped to {"none": array, "minor": array} of limits
+    """
+    volumes = np.asarray(tables["ptv_volume_cc"], dtype=float)
+    query = np.clip(np.atleast_1d(np.asarray(ptv_volumes, dtype=float)), volumes[0], volumes[-1])
+
+    # Shared interpolation weights for every column of the table
+    upper = np.clip(np.searchsorted(volumes, query, side="right"), 1, volumes.size - 1)
+    weight = (query - volumes[upper - 1]) / (volumes[upper] - volumes[upper - 1])
+
+    names = list(tables["metrics"])
+    columns = np.array([tables["metrics"][m][level] for m in names for level in ("none", "minor")], dtype=float)
+    limits = columns[:, upper - 1] * (1 - weight) + columns[:, upper] * weight
+
+    return {
+        name: {"none": limits[2 * i], "minor": limits[2 * i + 1]}
+        for i, name in enumerate(names)
+    }
+
+
+def sbrt_tables_apply(treatment_site, tables):
+    """Whether the conformality tables were derived for a treatment site."""
+    return str(treatment_site).strip().lower() in tables.get("sites", [])
+
+
+def grade_sbrt_metrics(ptv_volume, metrics, tables, treatment_site=None):
+    """Grade SBRT metrics as no deviation, minor deviation or major deviation.
+
+    Args:
+        ptv_volume: PTV volume in cc
+        metrics: Dict of metric values, e.g. {"pitv": 1.1, "r50": 4.2, "d2cm": 55.0}
+            (D2cm as % of prescription); missing or None values are skipped
+        tables: Tables from load_sbrt_tables
+        treatment_site: Optional treatment site; sites the tables do not
+            cover (e.g. liver or spine for the lung tables) are not graded
+
+    Returns:
+        dict: Metric mapped to {"label", "value", "none", "minor", "verdict"}
+            where verdict is "none", "minor" or "major"
+    """
+    if treatment_site is not None and not sbrt_tables_apply(treatment_site, tables):
+        return {}
+    limits = interpolate_sbrt_limits(ptv_volume, tables)
+    grades = {}
+    for name, value in metrics.items():
+        if value is None or name not in limits:
+            continue
+        none_limit = float(limits[name]["none"][0])
+        minor_limit = float(limits[name]["minor"][0])
+        if value < none_limit:
+            verdict = "none"
+        elif value <= minor_limit:
+            verdict = "minor"
+        else:
+            verdict = "major"
+        grades[name] = {
+            "label": tables["metrics"][name]["label"],
+            "value": float(value),
+            "none": none_limit,
+            "minor": minor_limit,
+            "verdict": verdict,
+        }
+    return grades
@@ -0,0 +1,224 @@
+import copy
+import hashlib
+import json
+import os
+import tempfile
+from functools import lru_cache
+
+try:
+    import pydicom
+except ImportError:  # DICOM RT Plan support is optional
+    pydicom = None
+
+from dicom_utils import open_dicom_file
+from dvh_utils import voxel_volume_cc
+from structure_utils import read_structures, rasterize_structure_set
+
+# Extracted plans are kept here as JSON, keyed by the plan, structure set and
+# dose files, so reopening a patient does not parse or rasterize anything
+PLAN_CACHE_DIR = os.path.join(tempfile.gettempdir(), "quickwrite_plan_cache")
+PLAN_CACHE_VERSION = 4
+
+# Structures treated as targets when the plan has no target dose references,
+# in order of preference: only the first type present is used, so a lesion
+# contoured as both a GTV and a PTV counts once
+TARGET_PREFIXES = ("ptv", "gtv", "itv", "ctv")
+
+# Modules that can be prefilled from a plan
+PREFILL_MODULES = ("sbrt", "srs", "prior_dose")
+
+
+def read_plan(path):
+    """Prescription of a DICOM RT Plan.
+
+    Target doses come from the plan's target dose references. Plans without
+    them fall back to the sum of the beam doses per fraction times the
+    number of fractions, with no named targets.
+
+    Args:
+        path: Path to an RTPLAN file
+
+    Returns:
+        dict: "label", "patient_id", "fractions", "prescription_dose" (Gy),
+            "structure_set_uid" and "targets" (list of dicts with "name" and
+            "dose" in Gy)
+    """
+    if pydicom is None:
+        raise ImportError("pydicom is required to read DICOM RT Plans")
+    dataset = pydicom.dcmread(path)
+    if dataset.get("Modality") != "RTPLAN":
+        raise ValueError(f"{os.path.basename(path)} is not an RT Plan")
+
+    fraction_groups = dataset.get("FractionGroupSequence", [])
+    fractions = int(fraction_groups[0].NumberOfFractionsPlanned) if fraction_groups and \
+        fraction_groups[0].get("NumberOfFractionsPlanned") else None
+
+    targets = [
+        {"name": str(reference.get("DoseReferenceDescription") or f"Target {reference.DoseReferenceNumber}"),
+         "dose": round(float(reference.TargetPrescriptionDose), 2)}
+        for reference in dataset.get("DoseReferenceSequence", [])
+        if reference.get("DoseReferenceType") == "TARGET" and reference.get("TargetPrescriptionDose") is not None
+    ]
+    if targets:
+        prescription = max(target["dose"] for target in targets)
+    elif fraction_groups and fractions:
+        beam_doses = [float(beam.BeamDose) for beam in fraction_groups[0].get("ReferencedBeamSequence", [])
+                      if beam.get("BeamDose") is not None]
+        prescription = round(sum(beam_doses) * fractions, 2) if beam_doses else None
+    else:
+        prescription = None
+
+    structure_sets = dataset.get("ReferencedStructureSetSequence", [])
+    return {
+        "label": str(dataset.get("RTPlanLabel", "") or os.path.basename(path)),
+        "patient_id": str(dataset.get("PatientID", "")),
+        "fractions": fractions,
+        "prescription_dose": prescription,
+        "structure_set_uid": str(structure_sets[0].ReferencedSOPInstanceUID) if structure_sets else None,
+        "targets": targets,
+    }
+
+
+def find_plan_files(index, plan):
+    """Structure set and dose files that belong with a plan in a DICOM index.
+
+    The structure set referenced by the plan is preferred, then any in the
+    same study; the dose is the first RT Dose in the plan's study.
+
+    Args:
+        index: DataFrame from dicom_utils.index_directory
+        plan: Index row (dict) of the RT Plan
+
+    Returns:
+        tuple: (structure set path, dose path); either may be None
+    """
+    study = index[index["StudyInstanceUID"] == plan["StudyInstanceUID"]]
+    structure_path = None
+    referenced = extract_plan(plan["Path"])["structure_set_uid"]
+    structures = index[index["SOPInstanceUID"] == referenced] if referenced else study.iloc[:0]
+    if structures.empty:
+        structures = study[study["Modality"] == "RTSTRUCT"]
+    if not structures.empty:
+        structure_path = structures["Path"].iloc[0]
+
+    doses = study[study["Modality"] == "RTDOSE"]
+    dose_path = doses.sort_values("Path")["Path"].iloc[0] if not doses.empty else None
+    return structure_path, dose_path
+
+
+def _file_signature(path):
+    if not path:
+        return None
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+def _target_volumes(targets, structure_path, dose_path):
+    """Volume (cc) of each target on the dose grid, adding targets found by name when the plan has none."""
+    structures = read_structures(structure_path)
+    if not targets:
+        for prefix in TARGET_PREFIXES:
+            targets = [{"name": name, "dose": None} for name in structures if name.lower().startswith(prefix)]
+            if targets:
+                break
+
+    grid = open_dicom_file(dose_path)
+    names = [target["name"] for target in targets if target["name"] in structures]
+    masks = rasterize_structure_set(structure_path, grid.origin_mm, (grid.slice_step_mm,) + grid.spacing_mm[1:],
+                                    grid.shape, names, orientation=grid.orientation)
+    voxel_cc = voxel_volume_cc(grid.spacing_mm)
+    for target in targets:
+        mask = masks.get(target["name"])
+        target["volume_cc"] = round(float(mask.sum(dtype=float)) * voxel_cc, 2) if mask is not None else None
+    return targets
+
+
+@lru_cache(maxsize=32)
+def _extract_plan(signatures, cache_dir):
+    cache_path = None
+    if cache_dir:
+        digest = hashlib.sha1(json.dumps([PLAN_CACHE_VERSION, signatures]).encode("utf-8")).hexdigest()
+        cache_path = os.path.join(cache_dir, f"{digest}.json")
+        try:
+            with open(cache_path, "r") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            pass
+
+    plan_path, structure_path, dose_path = (signature[0] if signature else None for signature in signatures)
+    plan = read_plan(plan_path)
+    if structure_path and dose_path:
+        plan["targets"] = _target_volumes(plan["targets"], structure_path, dose_path)
+    for target in plan["targets"]:
+        target.setdefault("volume_cc", None)
+        if target["dose"] is None:
+            target["dose"] = plan["prescription_dose"]
+
+    if cache_path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(f"{cache_path}.tmp", "w") as file:
+                json.dump(plan, file)
+            os.replace(f"{cache_path}.tmp", cache_path)
+        except OSError:
+            pass
+    return plan
+
+
+def extract_plan(plan_path, structure_path=None, dose_path=None, cache_dir=PLAN_CACHE_DIR):
+    """Prescription and target volumes of a plan, cached per plan.
+
+    The result is cached in memory and as JSON on disk, keyed by the path,
+    modification time and size of each file, so reopening a patient (in
+    this session or a later one) neither parses the plan nor rasterizes
+    its targets again.
+
+    Args:
+        plan_path: Path to the RTPLAN file
+        structure_path: Optional RTSTRUCT with the target contours
+        dose_path: Optional RT Dose whose grid the target volumes are measured on
+        cache_dir: Cache directory, or None to keep the result in memory only
+
+    Returns:
+        dict: read_plan fields, with a "volume_cc" (None if unknown) for every target
+    """
+    signatures = tuple(_file_signature(path) for path in (plan_path, structure_path, dose_path))
+    return copy.deepcopy(_extract_plan(signatures, cache_dir))
+
+
+def prefill_module_data(plan):
+    """Map an extracted plan onto the module_data fields of the modules it can fill.
+
+    Only fields the plan determines are included; everything else is left
+    for the form.
+
+    Args:
+        plan: Dict from extract_plan
+
+    Returns:
+        dict: Module ID mapped to partial module data: SBRT "dose",
+            "fractions" and "target_volume", SRS "lesions" (one per target
+            with "dose", "fractions" and "volume"), and Prior Dose
+            "current_dose" and "current_fractions"
+    """
+    dose, fractions = plan.get("prescription_dose"), plan.get("fractions")
+    targets = plan.get("targets", [])
+    prefill = {}
+
+    if dose and fractions:
+        prefill["prior_dose"] = {"current_dose": dose, "current_fractions": fractions}
+        prefill["sbrt"] = {"dose": dose, "fractions": fractions}
+        # The primary target is the one prescribed the highest dose, the largest of those if several
+        prescribed = [target for target in targets if target["dose"] == dose and target.get("volume_cc")]
+        if prescribed:
+            prefill["sbrt"]["target_volume"] = max(target["volume_cc"] for target in prescribed)
+
+    if fractions and targets:
+        prefill["srs"] = {"lesions": [
+            {"dose": target["dose"], "fractions": fractions, "volume": target.get("volume_cc")}
+            for target in targets if target["dose"]
+        ]}
+        if not prefill["srs"]["lesions"]:
+            del prefill["srs"]
+
+    return prefill
@@ -0,0 +1,207 @@
+import streamlit as st
+import os
+import threading
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# Number of samples kept per step, per session and per server
+MAX_SAMPLES = 500
+
+# Server-wide samples shared by every session in this process
+_server_samples = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+_server_lock = threading.Lock()
+
+# Per-thread stack of the steps currently being timed
+_local = threading.local()
+
+# Allocation tracking is process-wide, so only one session measures at a time
+_memory_lock = threading.Lock()
+_started_tracing = False
+
+
+def profiling_enabled():
+    """Return True if render profiling is switched on for this session.
+
+    Profiling is opt-in: it is enabled from the Developer Options sidebar, or
+    for every session by setting the QUICKWRITE_PROFILE environment variable.
+    """
+    if os.environ.get("QUICKWRITE_PROFILE", "") not in ("", "0"):
+        return True
+    return bool(st.session_state.get("profiling_enabled", False))
+
+
+def memory_profiling_enabled():
+    """Return True if allocation tracking is switched on for the server.
+
+    tracemalloc slows down every allocation in the process, so it is never
+    turned on from a session; set the QUICKWRITE_PROFILE_MEMORY environment
+    variable to record peak allocations alongside the timings.
+    """
+    return os.environ.get("QUICKWRITE_PROFILE_MEMORY", "") not in ("", "0")
+
+
+def _update_tracing():
+    """Start or stop tracemalloc to match memory_profiling_enabled()."""
+    global _started_tracing
+    if memory_profiling_enabled():
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+    elif _started_tracing:
+        tracemalloc.stop()
+        _started_tracing = False
+
+
+@contextmanager
+def profile_step(name):
+    """Time a block of rendering work and record it under the given step name.
+
+    Records wall-clock time, and with memory_profiling_enabled() the peak
+    traced memory allocated while the block ran. tracemalloc is process-wide,
+    so one session at a time measures allocations (steps that start while
+    another session is measuring record timing only), and the figures are an
+    upper bound under concurrent sessions. When profiling is disabled this
+    does nothing.
+
+    Args:
+        name: Step name, e.g. "collect_common_info" or "srs.generate_write_up"
+    """
+    _update_tracing()
+    if not profiling_enabled():
+        yield
+        return
+
+    stack = _local.__dict__.setdefault("stack", [])
+    # The outermost step of a thread takes the memory lock; nested steps
+    # measure only if it did
+    if stack:
+        measuring = stack[-1]["measuring"]
+    else:
+        measuring = tracemalloc.is_tracing() and _memory_lock.acquire(blocking=False)
+
+    # Steps can nest (a workflow step wraps module calls), and each step
+    # resets the tracemalloc peak, so carry peaks up the stack by hand
+    frame = {"measuring": measuring}
+    if measuring:
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+        frame.update(start=current, peak=current)
+        tracemalloc.reset_peak()
+    stack.append(frame)
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        stack.pop()
+        alloc_kb = None
+        if measuring:
+            peak = max(frame["peak"], tracemalloc.get_traced_memory()[1]) if tracemalloc.is_tracing() else 0
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            else:
+                _memory_lock.release()
+            alloc_kb = (peak - frame["start"]) / 1024 if peak else None
+        _record_sample(name, elapsed_ms, alloc_kb)
+
+
+def _record_sample(name, elapsed_ms, alloc_kb):
+    """Store one timing sample (alloc_kb None when not measured) for this session and for the server."""
+    session_samples = st.session_state.setdefault("_profiler_samples", {})
+    session_samples.setdefault(name, deque(maxlen=MAX_SAMPLES)).append((elapsed_ms, alloc_kb))
+
+    with _server_lock:
+        _server_samples[name].append((elapsed_ms, alloc_kb))
+
+
+def summarize_samples(samples):
+    """Aggregate timing samples into percentiles per step.
+
+    Args:
+        samples: Dict mapping step name to a sequence of (elapsed_ms, alloc_kb)
+
+    Returns:
+        pandas.DataFrame: One row per step, slowest p95 first
+    """
+    rows = []
+    for name, step_samples in samples.items():
+        if not step_samples:
+            continue
+        values = np.asarray(step_samples, dtype=float)
+        p50, p95, p99 = np.percentile(values[:, 0], [50, 95, 99])
+        # Timing-only samples have no allocation figure
+        allocs = values[:, 1][~np.isnan(values[:, 1])]
+        rows.append({
+            "Step": name,
+            "Calls": len(values),
+            "p50 (ms)": round(p50, 1),
+            "p95 (ms)": round(p95, 1),
+            "p99 (ms)": round(p99, 1),
+            "Max (ms)": round(values[:, 0].max(), 1),
+            "Peak alloc p95 (KB)": round(np.percentile(allocs, 95), 1) if allocs.size else None,
+        })
+
+    columns = ["Step", "Calls", "p50 (ms)", "p95 (ms)", "p99 (ms)", "Max (ms)", "Peak alloc p95 (KB)"]
+    if not rows:
+        return pd.DataFrame(columns=columns)
+    return pd.DataFrame(rows, columns=columns).sort_values("p95 (ms)", ascending=False, ignore_index=True)
+
+
+def get_session_summary():
+    """Return the timing summary for the current session."""
+    return summarize_samples(st.session_state.get("_profiler_samples", {}))
+
+
+def get_server_summary():
+    """Return the timing summary across all sessions in this server process."""
+    with _server_lock:
+        snapshot = {name: list(samples) for name, samples in _server_samples.items()}
+    return summarize_samples(snapshot)
+
+
+def add_profiler_panel(location="sidebar"):
+    """Add the render profiler toggle and timing tables.
+
+    The tables show timings recorded up to the previous rerun, since the panel
+    is drawn before the workflow renders.
+
+    Args:
+        location: Where to place the panel - "sidebar" or "main"
+    """
+    container = st.sidebar if location == "sidebar" else st.container()
+
+    with container:
+        st.checkbox("Enable render profiler", key="profiling_enabled")
+
+        if not profiling_enabled():
+            return
+
+        with st.expander("Render Timings", expanded=False):
+            if not memory_profiling_enabled():
+                st.caption("Timing only; set QUICKWRITE_PROFILE_MEMORY on the server to record allocations.")
+            session_tab, server_tab = st.tabs(["This Session", "Server"])
+
+            with session_tab:
+                summary = get_session_summary()
+                if summary.empty:
+                    st.info("No timings recorded yet.")
+                else:
+                    st.dataframe(summary, hide_index=True, use_container_width=True)
+
+            with server_tab:
+                summary = get_server_summary()
+                if summary.empty:
+                    st.info("No timings recorded yet.")
+                else:
+                    st.dataframe(summary, hide_index=True, use_container_width=True)
+
+            if st.button("Clear Session Timings", key="clear_profiler_timings"):
+                st.session_state._profiler_samples = {}
+                st.rerun()
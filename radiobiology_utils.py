@@ -0,0 +1,532 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from dvh_utils import compute_dvhs
+from constraint_utils import get_constraint_library
+from dicom_utils import open_dicom_file
+
+# Default α/β ratios (Gy) by structure name pattern (a regular expression
+# searched in the lowercased name; most are plain keywords). Serial CNS
+# tissues use 2 Gy, other late-responding normal tissues 3 Gy, tumors 10 Gy.
+STRUCTURE_ALPHA_BETA = {
+    r"spinal[ _]?cord": 2.0,
+    # "Cord" on its own (e.g. "Cord_PRV"), but not a vocal cord
+    r"(?<![a-z])(?<!vocal )(?<!vocal_)cord(?![a-z])": 2.0,
+    "cauda equina": 2.0,
+    "brain stem": 2.0,
+    "brainstem": 2.0,
+    "optic": 2.0,
+    "chiasm": 2.0,
+    "brachial plexus": 2.0,
+    "sacral plexus": 2.0,
+    "retina": 2.0,
+    "tumor": 10.0,
+    "gtv": 10.0,
+    "ctv": 10.0,
+    "ptv": 10.0,
+}
+
+DEFAULT_ALPHA_BETA = 3.0
+
+_ALPHA_BETA_PATTERNS = [(re.compile(pattern), alpha_beta) for pattern, alpha_beta in STRUCTURE_ALPHA_BETA.items()]
+
+# α/β values shown in sensitivity tables when none are given
+SENSITIVITY_ALPHA_BETAS = (1.0, 2.0, 3.0, 5.0, 10.0)
+
+# Per-organ tissue recovery models for prior courses
+RECOVERY_MODELS_FILE = "data/recovery_models.json"
+
+MONTHS = ["January", "February", "March", "April", "May", "June", "July",
+          "August", "September", "October", "November", "December"]
+
+# DICOM RT Dose grids converted to Gy are kept here as .npy, keyed by the
+# source file, so the patient's export folder is never written to
+DOSE_CACHE_DIR = os.path.join(tempfile.gettempdir(), "quickwrite_dose_grids")
+
+# Number of axial slices converted at a time when building composite grids;
+# a 512x512 float32 slice is 1 MB, so a chunk stays in the tens of MB
+COMPOSITE_CHUNK_SLICES = 16
+
+
+def get_alpha_beta(structure):
+    """Return the default α/β ratio for a structure name.
+
+    Args:
+        structure: Structure name, e.g. "Spinal cord" or "Left optic nerve"
+
+    Returns:
+        float: α/β in Gy
+    """
+    name = structure.lower()
+    for pattern, alpha_beta in _ALPHA_BETA_PATTERNS:
+        if pattern.search(name):
+            return alpha_beta
+    return DEFAULT_ALPHA_BETA
+
+
+def calculate_bed(total_dose, fractions, alpha_beta):
+    """Biologically effective dose from the linear-quadratic model.
+
+    BED = nd(1 + d/(α/β)). All arguments broadcast against each other, so
+    arrays of courses, α/β values or whole grids are evaluated in one call.
+
+    Args:
+        total_dose: Total physical dose in Gy (scalar or array)
+        fractions: Number of fractions (scalar or array)
+        alpha_beta: α/β ratio in Gy (scalar or array)
+
+    Returns:
+        numpy.ndarray: BED in Gy
+    """
+    total_dose = np.asarray(total_dose, dtype=float)
+    dose_per_fraction = total_dose / np.asarray(fractions, dtype=float)
+    return total_dose * (1.0 + dose_per_fraction / np.asarray(alpha_beta, dtype=float))
+
+
+def calculate_eqd2(total_dose, fractions, alpha_beta):
+    """Equivalent dose in 2 Gy fractions: EQD2 = BED / (1 + 2/(α/β)).
+
+    Args:
+        total_dose: Total physical dose in Gy (scalar or array)
+        fractions: Number of fractions (scalar or array)
+        alpha_beta: α/β ratio in Gy (scalar or array)
+
+    Returns:
+        numpy.ndarray: EQD2 in Gy
+    """
+    alpha_beta = np.asarray(alpha_beta, dtype=float)
+    return calculate_bed(total_dose, fractions, alpha_beta) / (1.0 + 2.0 / alpha_beta)
+
+
+def convert_dose(total_dose, fractions, alpha_beta, method):
+    """Convert physical dose with the given method.
+
+    Args:
+        total_dose: Total physical dose in Gy (scalar or array)
+        fractions: Number of fractions (scalar or array)
+        alpha_beta: α/β ratio in Gy (scalar or array)
+        method: "BED", "EQD2" or "Raw Dose"
+
+    Returns:
+        numpy.ndarray: Converted dose in Gy
+    """
+    if method == "BED":
+        return calculate_bed(total_dose, fractions, alpha_beta)
+    if method == "EQD2":
+        return calculate_eqd2(total_dose, fractions, alpha_beta)
+    # Raw dose doesn't depend on α/β but still broadcasts to its shape
+    return np.asarray(total_dose, dtype=float) + 0.0 * np.asarray(alpha_beta, dtype=float)
+
+
+def isoeffective_dose(total_dose, fractions, alpha_beta, reference_fractions=None):
+    """Total dose in a given number of fractions with the same BED as a reference dose.
+
+    Solves nd(1 + d/(α/β)) = BED for the total dose nd.
+
+    Args:
+        total_dose: Reference total dose in Gy (scalar or array)
+        fractions: Number of fractions to convert to
+        alpha_beta: α/β ratio in Gy
+        reference_fractions: Number of fractions of the reference dose, or
+            None if it was given in 2 Gy fractions
+
+    Returns:
+        numpy.ndarray: Isoeffective total dose in Gy
+    """
+    total_dose = np.asarray(total_dose, dtype=float)
+    alpha_beta = np.asarray(alpha_beta, dtype=float)
+    if reference_fractions is None:
+        bed = total_dose * (1.0 + 2.0 / alpha_beta)
+    else:
+        bed = calculate_bed(total_dose, reference_fractions, alpha_beta)
+    n_alpha_beta = np.asarray(fractions, dtype=float) * alpha_beta
+    return 0.5 * n_alpha_beta * (np.sqrt(1.0 + 4.0 * bed / n_alpha_beta) - 1.0)
+
+
+def cumulative_dose(courses, alpha_betas, method="EQD2"):
+    """Sum converted doses over treatment courses for one or more α/β values.
+
+    Args:
+        courses: Sequence of (total_dose, fractions) pairs, one per course
+        alpha_betas: α/β ratio or sequence of ratios (e.g. one per structure)
+        method: "BED", "EQD2" or "Raw Dose"
+
+    Returns:
+        tuple: (per_course, total) where per_course has shape
+            (len(alpha_betas), len(courses)) and total has shape (len(alpha_betas),)
+    """
+    courses = np.asarray(courses, dtype=float).reshape(-1, 2)
+    alpha_betas = np.atleast_1d(np.asarray(alpha_betas, dtype=float))[:, np.newaxis]
+
+    per_course = convert_dose(courses[:, 0], courses[:, 1], alpha_betas, method)
+    return per_course, per_course.sum(axis=1)
+
+
+def sensitivity_grid(doses, fractions, alpha_betas, method="EQD2"):
+    """Evaluate every combination of dose, fractionation and α/β at once.
+
+    Args:
+        doses: Sequence of total doses in Gy
+        fractions: Sequence of fraction numbers
+        alpha_betas: Sequence of α/β ratios in Gy
+        method: "BED", "EQD2" or "Raw Dose"
+
+    Returns:
+        numpy.ndarray: Array of shape (len(alpha_betas), len(doses), len(fractions))
+    """
+    ab = np.asarray(alpha_betas, dtype=float)[:, np.newaxis, np.newaxis]
+    dose = np.asarray(doses, dtype=float)[np.newaxis, :, np.newaxis]
+    fx = np.asarray(fractions, dtype=float)[np.newaxis, np.newaxis, :]
+    return convert_dose(dose, fx, ab, method)
+
+
+def course_sensitivity_table(courses, alpha_betas=SENSITIVITY_ALPHA_BETAS, method="EQD2"):
+    """Tabulate each course and the cumulative dose across a range of α/β values.
+
+    Args:
+        courses: Sequence of (label, total_dose, fractions) tuples
+        alpha_betas: α/β ratios to tabulate
+        method: "BED" or "EQD2"
+
+    Returns:
+        pandas.DataFrame: One row per course plus a cumulative row, one column per α/β
+    """
+    labels = [label for label, _, _ in courses]
+    per_course, total = cumulative_dose([(dose, fx) for _, dose, fx in courses], alpha_betas, method)
+
+    table = pd.DataFrame(
+        np.vstack([per_course.T, total]).round(1),
+        index=labels + ["Cumulative"],
+        columns=[f"α/β = {ab:g} Gy" for ab in alpha_betas]
+    )
+    table.index.name = "Course"
+    return table
+
+
+def get_method_abbreviation(dose_calc_method):
+    """Return "BED", "EQD2" or "Raw Dose" for a Prior Dose calculation method label."""
+    if dose_calc_method.startswith("BED"):
+        return "BED"
+    if dose_calc_method.startswith("EQD2"):
+        return "EQD2"
+    return "Raw Dose"
+
+
+def load_recovery_models(path=RECOVERY_MODELS_FILE):
+    """Load the per-organ tissue recovery models.
+
+    Args:
+        path: Path to the recovery model JSON file
+
+    Returns:
+        dict: The recovery configuration; if the file is missing or invalid,
+            a configuration that credits no recovery
+    """
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {
+            "default_model": "no_recovery",
+            "models": {"no_recovery": {"label": "No recovery credited", "keywords": [],
+                                       "months": [0], "recovery": [0.0]}}
+        }
+
+
+def get_recovery_model(structure, recovery_models):
+    """Return the name of the recovery model that applies to a structure."""
+    name = structure.lower()
+    for model_name, model in recovery_models["models"].items():
+        if _keyword_pattern(tuple(model.get("keywords", []))).search(name):
+            return model_name
+    return recovery_models["default_model"]
+
+
+@lru_cache(maxsize=64)
+def _keyword_pattern(keywords):
+    """Compile a model's keywords into a single alternation (never matches when empty)."""
+    return re.compile("|".join(f"(?:{keyword})" for keyword in keywords) or "(?!)")
+
+
+def months_between(month, year, reference_month, reference_year):
+    """Whole months from one month/year to a later reference month/year (never negative)."""
+    start = int(year) * 12 + MONTHS.index(month) if month in MONTHS else int(year) * 12
+    end = int(reference_year) * 12 + MONTHS.index(reference_month) if reference_month in MONTHS else int(reference_year) * 12
+    return max(end - start, 0)
+
+
+def recovery_fractions(structures, elapsed_months, recovery_models):
+    """Recovered fraction of each prior course's dose, for every structure.
+
+    Each distinct model is interpolated once over all courses, then rows are
+    gathered per structure, so the cost doesn't grow with structures x courses
+    beyond a single indexing step.
+
+    Args:
+        structures: Structure names
+        elapsed_months: Months since each prior course
+        recovery_models: Configuration from load_recovery_models
+
+    Returns:
+        numpy.ndarray: Array of shape (len(structures), len(elapsed_months))
+    """
+    elapsed = np.asarray(elapsed_months, dtype=float)
+    model_names = [get_recovery_model(s, recovery_models) for s in structures]
+    unique_models = sorted(set(model_names))
+
+    curves = np.array([
+        np.interp(elapsed, recovery_models["models"][m]["months"], recovery_models["models"][m]["recovery"])
+        for m in unique_models
+    ]).reshape(len(unique_models), elapsed.size)
+    return curves[[unique_models.index(m) for m in model_names]]
+
+
+def discounted_cumulative_dose(prior_courses, current_course, alpha_betas, recovery, method="EQD2"):
+    """Cumulative dose with and without crediting recovery of prior courses.
+
+    Args:
+        prior_courses: Sequence of (total_dose, fractions) for each prior course
+        current_course: (total_dose, fractions) of the current course
+        alpha_betas: α/β ratio per structure
+        recovery: Recovered fractions, shape (structures, prior courses)
+        method: "BED", "EQD2" or "Raw Dose"
+
+    Returns:
+        tuple: (undiscounted, discounted) totals, one per structure
+    """
+    per_course, total = cumulative_dose(list(prior_courses) + [current_course], alpha_betas, method)
+    prior = per_course[:, :-1]
+    discounted = (prior * (1.0 - np.asarray(recovery, dtype=float))).sum(axis=1) + per_course[:, -1]
+    return total, discounted
+
+
+def load_dose_grid(path, cache_dir=DOSE_CACHE_DIR):
+    """Open a 3D dose grid without reading it into memory.
+
+    NumPy .npy files are memory-mapped directly. DICOM RT Dose files are
+    converted to Gy frame by frame into a float32 .npy in cache_dir, keyed by
+    the file's path, size and modification time, which is then memory-mapped.
+
+    Args:
+        path: Path to a .npy or DICOM RT Dose file
+        cache_dir: Directory for converted DICOM grids
+
+    Returns:
+        numpy.ndarray: Read-only memory-mapped dose grid in Gy, indexed
+            (slice, row, column)
+    """
+    if path.lower().endswith(".npy"):
+        grid = np.load(path, mmap_mode="r")
+        if grid.ndim != 3:
+            raise ValueError(f"{os.path.basename(path)} is not a 3D dose grid")
+        return grid
+
+    stat = os.stat(path)
+    digest = hashlib.sha1(json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime_ns]).encode("utf-8"))
+    converted = os.path.join(cache_dir, f"{digest.hexdigest()}_gy.npy")
+    if not os.path.exists(converted):
+        volume = open_dicom_file(path)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write under a temporary name so a concurrent reader never sees a partial file
+        temp_path = f"{converted}.{os.getpid()}.tmp.npy"
+        grid = np.lib.format.open_memmap(temp_path, mode="w+", dtype=np.float32, shape=volume.shape)
+        volume.to_array(out=grid)
+        grid.flush()
+        del grid
+        os.replace(temp_path, converted)
+    return np.load(converted, mmap_mode="r")
+
+
+def build_alpha_beta_labels(structure_masks, structure_alpha_beta=None, default_alpha_beta=DEFAULT_ALPHA_BETA):
+    """Assign every voxel an α/β through a compact label map.
+
+    Rather than a full float α/β grid, each voxel gets a uint8 label that
+    indexes a small lookup table. Where structures overlap, the lowest α/β
+    (the most conservative for hypofractionated courses) wins.
+
+    Args:
+        structure_masks: Dict mapping structure name to a boolean 3D mask
+        structure_alpha_beta: Optional dict of α/β overrides by structure name
+        default_alpha_beta: α/β for voxels outside every structure
+
+    Returns:
+        tuple: (labels, lookup) where lookup[labels] gives the voxel α/β, or
+            (None, lookup) when there are no masks
+    """
+    structure_alpha_beta = structure_alpha_beta or {}
+    alpha_betas = {name: structure_alpha_beta.get(name, get_alpha_beta(name)) for name in structure_masks}
+    if len(alpha_betas) > 254:
+        raise ValueError("At most 254 structures can be mapped")
+
+    lookup = np.array([default_alpha_beta] + list(alpha_betas.values()), dtype=np.float32)
+    if not structure_masks:
+        return None, lookup
+
+    shape = next(iter(structure_masks.values())).shape
+    labels = np.zeros(shape, dtype=np.uint8)
+
+    # Paint highest α/β first so lower values overwrite them where masks overlap
+    order = sorted(range(len(alpha_betas)), key=lambda i: -lookup[i + 1])
+    names = list(alpha_betas)
+    for i in order:
+        labels[np.asarray(structure_masks[names[i]], dtype=bool)] = i + 1
+    return labels, lookup
+
+
+def composite_eqd2(dose_grids, fractions, alpha_beta=DEFAULT_ALPHA_BETA, labels=None, out=None,
+                   chunk_slices=COMPOSITE_CHUNK_SLICES):
+    """Sum several dose grids voxel by voxel in EQD2.
+
+    Each voxel of each course is converted with EQD2 = D(D/n + α/β)/(2 + α/β)
+    and accumulated into a float32 composite. Grids are processed a few
+    slices at a time, so memory-mapped inputs are never fully loaded and
+    peak memory is the output grid plus one chunk per course.
+
+    Args:
+        dose_grids: Sequence of 3D dose arrays in Gy, all the same shape
+            (memory-mapped arrays are fine)
+        fractions: Number of fractions for each grid
+        alpha_beta: α/β in Gy, or a lookup table indexed by labels
+        labels: Optional uint8 label map from build_alpha_beta_labels
+        out: Optional array (e.g. a np.memmap) to write the composite into
+        chunk_slices: Number of slices processed at a time
+
+    Returns:
+        numpy.ndarray: Composite EQD2 grid in Gy
+    """
+    if len(dose_grids) != len(fractions):
+        raise ValueError("Each dose grid needs a number of fractions")
+    shape = dose_grids[0].shape
+    for grid in dose_grids:
+        if grid.shape != shape:
+            raise ValueError(f"Dose grids must share one shape, got {grid.shape} and {shape}")
+    if labels is not None and labels.shape != shape:
+        raise ValueError("The structure masks don't match the dose grid shape")
+
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+    lookup = np.asarray(alpha_beta, dtype=np.float32)
+
+    for start in range(0, shape[0], chunk_slices):
+        chunk = slice(start, min(start + chunk_slices, shape[0]))
+        ab = lookup[labels[chunk]] if labels is not None else lookup
+        total = np.zeros((chunk.stop - chunk.start,) + shape[1:], dtype=np.float32)
+        for grid, n in zip(dose_grids, fractions):
+            dose = np.asarray(grid[chunk], dtype=np.float32)
+            total += dose * (dose / np.float32(n) + ab) / (2.0 + ab)
+        out[chunk] = total
+
+    return out
+
+
+def summarize_composite(composite, structure_masks=None, voxel_volume_cc=None,
+                        chunk_slices=COMPOSITE_CHUNK_SLICES, constraint_site=None):
+    """Maximum composite dose overall, plus DVH metrics per structure.
+
+    Args:
+        composite: Composite dose grid
+        structure_masks: Optional dict mapping structure name to a boolean mask
+        voxel_volume_cc: Voxel volume in cc; when given, D0.03cc is reported
+        chunk_slices: Number of slices processed at a time
+        constraint_site: Optional treatment site; when given, the structure DVHs
+            are checked against that site's conventional (EQD2) constraints
+
+    Returns:
+        dict: {"max": float, "structures": {name: {"max", "mean"[, "d0.03cc"]}}}
+            plus "constraints" (list of evaluation rows) when constraint_site is given
+    """
+    overall_max = 0.0
+    for start in range(0, composite.shape[0], chunk_slices):
+        overall_max = max(overall_max, float(np.asarray(composite[start:start + chunk_slices]).max()))
+
+    dvhs = compute_dvhs(composite, structure_masks or {}, voxel_volume_cc or 1.0, chunk_slices=chunk_slices)
+    structures = {}
+    for name, dvh in dvhs.items():
+        if not dvh.volume_cc:
+            continue
+        structures[name] = {"max": dvh.max_dose, "mean": dvh.mean_dose}
+        if voxel_volume_cc:
+            structures[name]["d0.03cc"] = float(dvh.dose_at_volume(0.03))
+
+    summary = {"max": overall_max, "structures": structures}
+    if constraint_site:
+        evaluated = {name: dvh for name, dvh in dvhs.items() if name in structures}
+        summary["constraints"] = get_constraint_library().evaluate(
+            evaluated, constraint_site, "conventional"
+        ).to_dict("records")
+    return summary
+
+
+@lru_cache(maxsize=4096)
+def _translate_rules(site, organ, regime, fractions, alpha_beta):
+    library = get_constraint_library()
+    record = library.get_constraint(site, organ, regime)
+    if record is None:
+        return None
+    reference = library.reference_fractions(record)
+
+    rules = []
+    for rule in record["rules"]:
+        rule = dict(rule)
+        # Vx and critical-volume rules convert their dose level; dose rules convert their limit
+        if rule["metric"] in ("v", "cv"):
+            rule["param"] = round(float(isoeffective_dose(rule["param"], fractions, alpha_beta, reference)), 1)
+        elif rule["unit"] == "Gy":
+            rule["limit"] = round(float(isoeffective_dose(rule["limit"], fractions, alpha_beta, reference)), 1)
+        rules.append(rule)
+    return tuple(rules)
+
+
+def translate_constraint(site, organ, regime, fractions, alpha_beta=None):
+    """Convert a stored constraint to another number of fractions with LQ scaling.
+
+    Dose limits (and the dose levels of Vx rules) are replaced by the dose
+    with the same BED in the requested number of fractions; volume limits
+    are unchanged. Mean-dose limits are converted as if the whole organ
+    received the mean dose, which is only an approximation. Results are
+    cached per (site, organ, regime, fractions, α/β), so they are computed
+    once per schedule rather than on every rerun.
+
+    Args:
+        site: Treatment site, or None for site-independent organ limits
+        organ: Organ name as stored in the constraint library
+        regime: Regime of the stored constraint ("conventional", "sbrt" or "srs")
+        fractions: Number of fractions to convert to
+        alpha_beta: α/β ratio in Gy (defaults to get_alpha_beta(organ))
+
+    Returns:
+        list: Converted rules, or None if the constraint doesn't exist
+    """
+    if alpha_beta is None:
+        alpha_beta = get_alpha_beta(organ)
+    rules = _translate_rules(site.lower() if site else None, organ.lower(), regime,
+                             int(fractions), float(alpha_beta))
+    return [dict(rule) for rule in rules] if rules is not None else None
+
+
+def translate_constraints(site, regime, fractions, alpha_betas=None):
+    """Convert every constraint for a site to another number of fractions.
+
+    Args:
+        site: Treatment site
+        regime: Regime of the stored constraints
+        fractions: Number of fractions to convert to
+        alpha_betas: Optional dict mapping organ name to α/β in Gy; matched
+            case-insensitively, other organs use get_alpha_beta
+
+    Returns:
+        dict: Organ mapped to its converted rules, in library order
+    """
+    overrides = {name.lower(): value for name, value in (alpha_betas or {}).items()}
+    return {
+        record["organ"]: translate_constraint(site, record["organ"], regime, fractions,
+                                              overrides.get(record["organ"].lower()))
+        for record in get_constraint_library().get_constraints(site, regime)
+    }
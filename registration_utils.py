@@ -0,0 +1,356 @@
+import numpy as np
+
+# Downsampling factors evaluated, coarse to fine
+DEFAULT_LEVELS = (8, 4, 2)
+
+# Levels that would sample more primary voxels than this are skipped
+DEFAULT_MAX_SAMPLES = 4_000_000
+
+# Joint histogram bins for mutual information
+MI_BINS = 64
+
+# Primary slices sampled per pass, which bounds the memory of each level
+SLAB_SLICES = 16
+
+
+def rigid_transform(rotation_deg=(0.0, 0.0, 0.0), translation_mm=(0.0, 0.0, 0.0), center_mm=None):
+    """4x4 matrix of a rigid transform from primary to secondary coordinates.
+
+    Coordinates are in mm along the array axes (slice, row, column). The
+    rotations are applied about each axis in turn, around center_mm (the
+    origin by default), followed by the translation.
+
+    Returns:
+        numpy.ndarray: Homogeneous 4x4 matrix
+    """
+    rotation = np.eye(3)
+    for axis, angle in enumerate(np.radians(rotation_deg)):
+        a, b = [i for i in range(3) if i != axis]
+        step = np.eye(3)
+        step[a, a] = step[b, b] = np.cos(angle)
+        step[a, b], step[b, a] = -np.sin(angle), np.sin(angle)
+        rotation = step @ rotation
+
+    center = np.zeros(3) if center_mm is None else np.asarray(center_mm, dtype=float)
+    matrix = np.eye(4)
+    matrix[:3, :3] = rotation
+    matrix[:3, 3] = center - rotation @ center + np.asarray(translation_mm, dtype=float)
+    return matrix
+
+
+def apply_transform(matrix, points_mm):
+    """Map points (N x 3, mm) through a 4x4 transform."""
+    points_mm = np.asarray(points_mm, dtype=float)
+    return points_mm @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def _trilinear(volume, coords):
+    """Sample a volume at fractional (3, N) indices; returns values and an in-bounds mask."""
+    shape = np.array(volume.shape)
+    inside = np.all((coords >= 0) & (coords <= (shape - 1)[:, np.newaxis]), axis=0)
+    coords = coords[:, inside]
+    low = np.minimum(np.floor(coords).astype(np.intp), (shape - 2)[:, np.newaxis])
+    frac = coords - low
+    i, j, k = low
+    fi, fj, fk = frac
+
+    values = np.zeros(coords.shape[1])
+    for di in (0, 1):
+        wi = fi if di else 1 - fi
+        for dj in (0, 1):
+            wj = fj if dj else 1 - fj
+            for dk in (0, 1):
+                wk = fk if dk else 1 - fk
+                values += wi * wj * wk * volume[i + di, j + dj, k + dk]
+    return values, inside
+
+
+def _intensity_range(volume, factor):
+    """Intensity range of a volume from a strided subsample."""
+    sample = np.asarray(volume[::factor, ::factor, ::factor], dtype=float)
+    low, high = float(sample.min()), float(sample.max())
+    return (low, high) if high > low else (low, low + 1.0)
+
+
+def _evaluate_level(primary, secondary, matrix, primary_spacing, secondary_spacing, secondary_origin,
+                    factor, ranges, bins):
+    """Accumulate NCC sums and the joint histogram over every factor-th primary voxel, slab by slab."""
+    rows = np.arange(0, primary.shape[1], factor)
+    cols = np.arange(0, primary.shape[2], factor)
+    row_grid, col_grid = np.meshgrid(rows * primary_spacing[1], cols * primary_spacing[2], indexing="ij")
+    in_plane = np.column_stack([row_grid.ravel(), col_grid.ravel()])
+
+    totals = np.zeros(6)
+    histogram = np.zeros((bins, bins))
+    slices = np.arange(0, primary.shape[0], factor)
+    for start in range(0, slices.size, SLAB_SLICES):
+        slab = slices[start:start + SLAB_SLICES]
+        fixed = np.asarray(primary[slab][:, ::factor, ::factor], dtype=float).ravel()
+
+        points = np.column_stack([
+            np.repeat(slab * primary_spacing[0], in_plane.shape[0]),
+            np.tile(in_plane, (slab.size, 1)),
+        ])
+        indices = ((apply_transform(matrix, points) - secondary_origin) / secondary_spacing).T
+        moving, inside = _trilinear(secondary, indices)
+        fixed = fixed[inside]
+        if not fixed.size:
+            continue
+
+        totals += [fixed.size, fixed.sum(), moving.sum(), (fixed ** 2).sum(), (moving ** 2).sum(), (fixed * moving).sum()]
+        # The range comes from the coarsest level; clip so finer levels keep every sample
+        histogram += np.histogram2d(np.clip(fixed, *ranges[0]), np.clip(moving, *ranges[1]), bins=bins, range=ranges)[0]
+    return totals, histogram
+
+
+def _metrics_from_sums(totals, histogram):
+    n, sum_f, sum_m, sum_ff, sum_mm, sum_fm = totals
+    if n < 2:
+        return {"samples": int(n), "ncc": None, "mutual_information": None}
+    covariance = sum_fm / n - sum_f / n * sum_m / n
+    variance = (sum_ff / n - (sum_f / n) ** 2) * (sum_mm / n - (sum_m / n) ** 2)
+    ncc = covariance / np.sqrt(variance) if variance > 0 else 0.0
+
+    joint = histogram / histogram.sum()
+    marginal_f = joint.sum(axis=1, keepdims=True)
+    marginal_m = joint.sum(axis=0, keepdims=True)
+    nonzero = joint > 0
+    mutual_information = float(np.sum(joint[nonzero] * np.log2(joint[nonzero] / (marginal_f @ marginal_m)[nonzero])))
+    return {"samples": int(n), "ncc": float(ncc), "mutual_information": mutual_information}
+
+
+def registration_metrics(primary, secondary, matrix, primary_spacing, secondary_spacing,
+                         secondary_origin=(0.0, 0.0, 0.0), levels=DEFAULT_LEVELS,
+                         max_samples=DEFAULT_MAX_SAMPLES, bins=MI_BINS):
+    """Mutual information and normalized cross-correlation of a rigid registration.
+
+    The secondary image is resampled (trilinear) at every factor-th primary
+    voxel through the transform, coarse level first. Each level is processed
+    in slabs of primary slices and only accumulates running sums and a joint
+    histogram, so memory-mapped full-resolution volumes are never loaded
+    whole; levels above max_samples are skipped and the finest evaluated
+    level is reported.
+
+    Args:
+        primary: Primary image (slice, row, column), e.g. the planning CT
+        secondary: Secondary image on its own grid
+        matrix: 4x4 transform from primary to secondary mm coordinates (rigid_transform)
+        primary_spacing: Primary voxel spacing in mm; the primary origin is 0
+        secondary_spacing: Secondary voxel spacing in mm
+        secondary_origin: Position of the secondary's first voxel in mm
+        levels: Downsampling factors to evaluate, coarse to fine
+        max_samples: Largest number of primary voxels sampled at one level
+        bins: Joint histogram bins per image
+
+    Returns:
+        dict: "levels" (factor, samples, ncc, mutual_information per evaluated
+            level) and the finest level's "factor", "samples", "ncc" (-1 to 1)
+            and "mutual_information" (bits); raises ValueError if the images
+            do not overlap
+    """
+    primary_spacing = np.asarray(primary_spacing, dtype=float)
+    secondary_spacing = np.asarray(secondary_spacing, dtype=float)
+    secondary_origin = np.asarray(secondary_origin, dtype=float)
+    coarsest = max(levels)
+    ranges = [_intensity_range(primary, coarsest), _intensity_range(secondary, coarsest)]
+
+    results = []
+    for factor in levels:
+        samples = np.prod([-(-size // factor) for size in primary.shape])
+        if samples > max_samples and results:
+            break
+        totals, histogram = _evaluate_level(primary, secondary, matrix, primary_spacing, secondary_spacing,
+                                            secondary_origin, factor, ranges, bins)
+        results.append({"factor": factor, **_metrics_from_sums(totals, histogram)})
+
+    if results[-1]["ncc"] is None:
+        raise ValueError("The images do not overlap under this transform")
+    return {"levels": results, **results[-1]}
+
+
+def landmark_errors(primary_points, secondary_points, matrix):
+    """Target registration error of paired landmarks.
+
+    Args:
+        primary_points: N x 3 landmark positions on the primary (mm)
+        secondary_points: The same landmarks on the secondary (mm)
+        matrix: 4x4 transform from primary to secondary coordinates
+
+    Returns:
+        numpy.ndarray: Distance (mm) between each mapped primary landmark and its secondary position
+    """
+    primary_points = np.atleast_2d(np.asarray(primary_points, dtype=float))
+    secondary_points = np.atleast_2d(np.asarray(secondary_points, dtype=float))
+    if primary_points.shape != secondary_points.shape or primary_points.shape[1] != 3:
+        raise ValueError("Landmarks must be paired N x 3 coordinates")
+    return np.linalg.norm(apply_transform(matrix, primary_points) - secondary_points, axis=1)
+
+
+def summarize_registration(metrics, errors=None):
+    """Rounded plain-dict summary of registration QA for display and the write-up."""
+    summary = {
+        "mutual_information": round(metrics["mutual_information"], 3),
+        "ncc": round(metrics["ncc"], 3),
+        "factor": metrics["factor"],
+        "samples": metrics["samples"],
+    }
+    if errors is not None and len(errors):
+        summary.update({
+            "landmarks": int(len(errors)),
+            "tre_mean": round(float(np.mean(errors)), 2),
+            "tre_max": round(float(np.max(errors)), 2),
+        })
+    return summary
+
+
+# Histogram bin widths and ranges used for the streamed DVF percentiles;
+# values outside a range are counted in an underflow or overflow bin
+MAGNITUDE_BIN_MM = 0.01
+MAGNITUDE_RANGE_MM = (0.0, 100.0)
+JACOBIAN_BIN = 0.001
+JACOBIAN_RANGE = (-2.0, 8.0)
+
+
+def load_dvf(path):
+    """Memory-map a deformation vector field stored as .npy.
+
+    The field holds displacements in mm on the primary grid, with the three
+    (slice, row, column) components on the last axis or on the first.
+
+    Returns:
+        numpy.ndarray: Memory-mapped (slice, row, column, 3) view
+    """
+    dvf = np.load(path, mmap_mode="r")
+    if dvf.ndim == 4 and dvf.shape[-1] != 3 and dvf.shape[0] == 3:
+        dvf = np.moveaxis(dvf, 0, -1)
+    if dvf.ndim != 4 or dvf.shape[-1] != 3:
+        raise ValueError(f"Deformation vector field must be (slices, rows, columns, 3), got {dvf.shape}")
+    return dvf
+
+
+def jacobian_determinant(dvf, spacing_mm):
+    """Jacobian determinant of x -> x + u(x) for a (slice, row, column, 3) displacement field in mm."""
+    gradients = [np.gradient(np.asarray(dvf[..., component], dtype=float), *spacing_mm) for component in range(3)]
+    # j[c][a] = d(x_c + u_c) / d x_a
+    j = [[gradients[c][a] + (1.0 if c == a else 0.0) for a in range(3)] for c in range(3)]
+    return (j[0][0] * (j[1][1] * j[2][2] - j[1][2] * j[2][1])
+            - j[0][1] * (j[1][0] * j[2][2] - j[1][2] * j[2][0])
+            + j[0][2] * (j[1][0] * j[2][1] - j[1][1] * j[2][0]))
+
+
+def _histogram_counts(values, bin_width, value_range):
+    """Fixed-range histogram with an underflow bin first and an overflow bin last."""
+    low, high = value_range
+    bins = int(round((high - low) / bin_width))
+    # Shifted by one bin so underflow lands in bin 0; truncation is floor once clipped at zero
+    scaled = (values - (low - bin_width)) / bin_width
+    np.clip(scaled, 0, bins + 1, out=scaled)
+    return np.bincount(scaled.astype(np.int64), minlength=bins + 2)
+
+
+def _histogram_percentiles(counts, bin_width, value_range, percentiles, minimum, maximum):
+    """Percentiles (upper bin edges) from _histogram_counts counts.
+
+    Percentiles falling in the underflow or overflow bin are reported as the
+    minimum or maximum value seen.
+    """
+    cumulative = np.cumsum(counts)
+    positions = np.searchsorted(cumulative, np.asarray(percentiles) / 100.0 * cumulative[-1])
+    values = value_range[0] + positions * bin_width
+    values = np.where(positions == 0, minimum, np.where(positions == counts.size - 1, maximum, values))
+    return np.clip(values, minimum, maximum)
+
+
+def analyze_dvf(dvf, spacing_mm, chunk_slices=SLAB_SLICES, mask=None):
+    """Jacobian and displacement statistics of a deformation vector field, in slabs.
+
+    Each slab of slices is read with one slice of overlap on either side, so
+    its central-difference gradients equal those of the whole field, and only
+    running sums and fixed-range histograms are kept between slabs. A
+    memory-mapped multi-GB field therefore costs one slab of RAM, whatever
+    its values; the percentiles are exact to the histogram bin width inside
+    MAGNITUDE_RANGE_MM and JACOBIAN_RANGE. Voxels with a non-finite
+    displacement or Jacobian are counted and left out of the statistics.
+
+    Args:
+        dvf: (slice, row, column, 3) displacements in mm (see load_dvf)
+        spacing_mm: Voxel spacing (slice, row, column) in mm
+        chunk_slices: Slices per slab
+        mask: Optional boolean (slice, row, column) mask restricting the statistics
+
+    Returns:
+        dict: "voxels" analyzed, "nonfinite_voxels" left out, Jacobian "jacobian_min", "jacobian_max", "jacobian_mean",
+            "jacobian_p1" and "jacobian_p99", "folding_percent" (voxels with a
+            Jacobian <= 0), and displacement "magnitude_mean", "magnitude_p50",
+            "magnitude_p95", "magnitude_p99" and "magnitude_max" in mm
+    """
+    slices = dvf.shape[0]
+    if mask is not None and mask.shape != dvf.shape[:3]:
+        raise ValueError(f"Mask shape {mask.shape} does not match the field {dvf.shape[:3]}")
+
+    voxels = folded = nonfinite = 0
+    jacobian_sum = magnitude_sum = 0.0
+    jacobian_min, jacobian_max, magnitude_max = np.inf, -np.inf, 0.0
+    jacobian_counts = magnitude_counts = 0
+
+    for start in range(0, slices, chunk_slices):
+        stop = min(start + chunk_slices, slices)
+        low, high = max(start - 1, 0), min(stop + 1, slices)
+        slab = np.asarray(dvf[low:high], dtype=float)
+        jacobian = jacobian_determinant(slab, spacing_mm)[start - low:stop - low]
+        magnitude = np.sqrt(np.sum(slab[start - low:stop - low] ** 2, axis=-1))
+        if mask is not None:
+            inside = np.asarray(mask[start:stop], dtype=bool)
+            jacobian, magnitude = jacobian[inside], magnitude[inside]
+        else:
+            jacobian, magnitude = jacobian.ravel(), magnitude.ravel()
+        finite = np.isfinite(jacobian) & np.isfinite(magnitude)
+        if not finite.all():
+            nonfinite += int(finite.size - np.count_nonzero(finite))
+            jacobian, magnitude = jacobian[finite], magnitude[finite]
+        if not jacobian.size:
+            continue
+
+        voxels += jacobian.size
+        folded += int(np.count_nonzero(jacobian <= 0))
+        jacobian_sum += float(jacobian.sum())
+        magnitude_sum += float(magnitude.sum())
+        jacobian_min = min(jacobian_min, float(jacobian.min()))
+        jacobian_max = max(jacobian_max, float(jacobian.max()))
+        magnitude_max = max(magnitude_max, float(magnitude.max()))
+
+        magnitude_counts = magnitude_counts + _histogram_counts(magnitude, MAGNITUDE_BIN_MM, MAGNITUDE_RANGE_MM)
+        jacobian_counts = jacobian_counts + _histogram_counts(jacobian, JACOBIAN_BIN, JACOBIAN_RANGE)
+
+    if not voxels:
+        raise ValueError("The deformation vector field has no voxels to analyze")
+
+    jacobian_p1, jacobian_p99 = _histogram_percentiles(jacobian_counts, JACOBIAN_BIN, JACOBIAN_RANGE, (1, 99),
+                                                       jacobian_min, jacobian_max)
+    magnitude_p50, magnitude_p95, magnitude_p99 = _histogram_percentiles(
+        magnitude_counts, MAGNITUDE_BIN_MM, MAGNITUDE_RANGE_MM, (50, 95, 99), 0.0, magnitude_max
+    )
+    return {
+        "voxels": int(voxels),
+        "nonfinite_voxels": int(nonfinite),
+        "jacobian_min": jacobian_min,
+        "jacobian_max": jacobian_max,
+        "jacobian_mean": jacobian_sum / voxels,
+        "jacobian_p1": float(jacobian_p1),
+        "jacobian_p99": float(jacobian_p99),
+        "folding_percent": 100.0 * folded / voxels,
+        "magnitude_mean": magnitude_sum / voxels,
+        "magnitude_p50": float(magnitude_p50),
+        "magnitude_p95": float(magnitude_p95),
+        "magnitude_p99": float(magnitude_p99),
+        "magnitude_max": magnitude_max,
+    }
+
+
+def summarize_dvf(stats):
+    """Rounded plain-dict summary of analyze_dvf results for display and the write-up."""
+    summary = {key: round(value, 3 if key.startswith("jacobian") else 2) for key, value in stats.items()
+               if not key.endswith("voxels")}
+    summary["voxels"] = stats["voxels"]
+    summary["nonfinite_voxels"] = stats.get("nonfinite_voxels", 0)
+    return summary
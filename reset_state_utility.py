@@ -1,4 +1,5 @@
 import streamlit as st
+from draft_utils import DraftStore
 
 def add_reset_button(location="sidebar"):
     """Add a reset button to clear session state for debugging.
@@ -10,6 +11,7 @@ def add_reset_button(location="sidebar"):
         with st.sidebar:
             st.markdown("### Developer Options")
             if st.button("🔄 Reset Application State", key="dev_reset"):
+                DraftStore().clear()
                 for key in list(st.session_state.keys()):
                     if key != "developer_mode":  # Preserve developer mode setting
                         del st.session_state[key]
@@ -18,6 +20,7 @@ def add_reset_button(location="sidebar"):
     else:
         # Add a small button in the main interface
         if st.button("🔄 Reset", key="dev_reset_main"):
+            DraftStore().clear()
             for key in list(st.session_state.keys()):
                 if key != "developer_mode":  # Preserve developer mode setting
                     del st.session_state[key]
@@ -0,0 +1,227 @@
+import numpy as np
+import pandas as pd
+
+# Columns of a respiratory trace export; session (or fraction) is optional
+TRACE_REQUIRED_COLUMNS = ("time", "amplitude")
+TRACE_SESSION_COLUMNS = ("session", "fraction")
+
+# Samples read from the CSV at a time
+DEFAULT_CHUNK_SIZE = 100000
+
+HOLD_COLUMNS = [
+    "Session", "Start (s)", "End (s)", "Duration (s)", "Level (mm)", "SD (mm)", "Range (mm)", "Drift (mm)"
+]
+
+
+class BreathHoldDetector:
+    """Streaming breath-hold plateau detection for one session's breathing trace.
+
+    The trace is smoothed with a centred moving average and a breath hold is
+    any stretch of at least min_duration_s where the smoothed signal moves
+    slower than max_velocity. Samples are fed in chunks; only the samples
+    that a later chunk can still change (the end of the smoothing window and
+    an unfinished plateau) are carried over, so memory is bounded by the
+    longest breath hold rather than the trace.
+    """
+
+    def __init__(self, smoothing_s=0.5, max_velocity=1.0, min_duration_s=5.0, max_gap_s=1.0):
+        """Set the detection parameters.
+
+        Args:
+            smoothing_s: Width of the moving-average window in seconds
+            max_velocity: Largest smoothed signal velocity (mm/s) within a breath hold
+            min_duration_s: Shortest plateau counted as a breath hold
+            max_gap_s: Gaps in the time stamps longer than this end a plateau
+        """
+        self.smoothing_s = smoothing_s
+        self.max_velocity = max_velocity
+        self.min_duration_s = min_duration_s
+        self.max_gap_s = max_gap_s
+        self.holds = []
+        self._time = np.empty(0)
+        self._amplitude = np.empty(0)
+        self._offset = 0
+        self._half = None
+
+    def feed(self, time, amplitude):
+        """Add the next samples of the trace (in time order)."""
+        self._time = np.concatenate([self._time, np.asarray(time, dtype=float)])
+        self._amplitude = np.concatenate([self._amplitude, np.asarray(amplitude, dtype=float)])
+        self._process(final=False)
+
+    def finish(self):
+        """Flush the remaining samples and return the breath holds found."""
+        self._process(final=True)
+        return self.holds
+
+    def _process(self, final):
+        time, amplitude = self._time, self._amplitude
+        n = time.size
+        if n < 3:
+            if final:
+                self._time, self._amplitude = np.empty(0), np.empty(0)
+            return
+
+        if self._half is None:
+            sample_interval = float(np.median(np.diff(time)))
+            self._half = max(int(round(self.smoothing_s / sample_interval / 2)), 1)
+        half = self._half
+
+        # Centred moving average from a cumulative sum, shrinking at the buffer edges
+        index = np.arange(n)
+        low = np.maximum(index - half, 0)
+        high = np.minimum(index + half + 1, n)
+        totals = np.concatenate([[0.0], np.cumsum(amplitude)])
+        smoothed = (totals[high] - totals[low]) / (high - low)
+
+        # Velocity across one smoothing window, which averages out sample noise
+        before, after = np.maximum(index - half, 0), np.minimum(index + half, n - 1)
+        elapsed = time[after] - time[before]
+        velocity = np.divide(smoothed[after] - smoothed[before], elapsed,
+                             out=np.zeros(n), where=elapsed > 0)
+        still = np.abs(velocity) < self.max_velocity
+        still[np.flatnonzero(np.diff(time) > self.max_gap_s) + 1] = False
+        edges = np.diff(np.concatenate([[0], still.astype(np.int8), [0]]))
+        starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+        # Samples within two half-windows of the end can still change
+        reach = 2 * half + 1
+        settled = n if final else n - reach
+        new = starts >= self._offset
+        complete = new & ((ends < settled) | final)
+        long_enough = complete & (time[np.maximum(ends - 1, 0)] - time[starts] >= self.min_duration_s)
+        self._add_holds(time, amplitude, starts[long_enough], ends[long_enough])
+
+        if final:
+            self._time, self._amplitude = np.empty(0), np.empty(0)
+            self._offset = 0
+            return
+
+        # Keep an unfinished plateau and the smoothing context before it
+        open_runs = new & ~complete
+        resume = min(int(starts[open_runs][0]), settled) if open_runs.any() else settled
+        resume = max(resume, self._offset)
+        keep = max(resume - reach, 0)
+        self._time, self._amplitude = time[keep:], amplitude[keep:]
+        self._offset = resume - keep
+
+    def _add_holds(self, time, amplitude, starts, ends):
+        """Per-hold statistics of the raw signal, computed with one reduceat per quantity."""
+        if not starts.size:
+            return
+        bounds = np.column_stack([starts, ends]).ravel()
+        counts = ends - starts
+        t = time - time[starts[0]]
+
+        # A hold may end at the last sample; reduceat needs every bound to be a valid index
+        def reduce(ufunc, values):
+            return ufunc.reduceat(np.append(values, values[-1]), bounds)[::2]
+
+        sum_a, sum_aa = reduce(np.add, amplitude), reduce(np.add, amplitude ** 2)
+        sum_t, sum_tt, sum_ta = reduce(np.add, t), reduce(np.add, t ** 2), reduce(np.add, t * amplitude)
+        level = sum_a / counts
+        sd = np.sqrt(np.maximum(sum_aa / counts - level ** 2, 0.0))
+        spread = reduce(np.maximum, amplitude) - reduce(np.minimum, amplitude)
+
+        # Least-squares slope over each hold, times its duration
+        duration = time[ends - 1] - time[starts]
+        denominator = counts * sum_tt - sum_t ** 2
+        slope = np.divide(counts * sum_ta - sum_t * sum_a, denominator,
+                          out=np.zeros_like(sum_a), where=denominator > 0)
+
+        self.holds.extend(zip(time[starts].tolist(), time[ends - 1].tolist(), duration.tolist(),
+                              level.tolist(), sd.tolist(), spread.tolist(), (slope * duration).tolist()))
+
+
+def _session_column(columns):
+    for name in TRACE_SESSION_COLUMNS:
+        if name in columns:
+            return name
+    return None
+
+
+def detect_breath_holds(source, chunk_size=DEFAULT_CHUNK_SIZE, **detector_options):
+    """Find the breath holds in a respiratory trace CSV, reading it in chunks.
+
+    Args:
+        source: Path or file-like object of a CSV with time (s) and amplitude (mm)
+            columns and optionally a session or fraction column (header case is ignored)
+        chunk_size: Samples read at a time
+        **detector_options: Passed to BreathHoldDetector
+
+    Returns:
+        pandas.DataFrame: One row per breath hold (HOLD_COLUMNS)
+    """
+    detectors = {}
+    for chunk in pd.read_csv(source, chunksize=chunk_size, skipinitialspace=True):
+        chunk.columns = [str(column).strip().lower() for column in chunk.columns]
+        missing = [column for column in TRACE_REQUIRED_COLUMNS if column not in chunk.columns]
+        if missing:
+            raise ValueError(f"Respiratory trace is missing column(s): {', '.join(missing)}")
+
+        time = pd.to_numeric(chunk["time"], errors="coerce").to_numpy()
+        amplitude = pd.to_numeric(chunk["amplitude"], errors="coerce").to_numpy()
+        session_column = _session_column(chunk.columns)
+        sessions = chunk[session_column].astype(str).to_numpy() if session_column else np.full(len(chunk), "1")
+
+        valid = ~(np.isnan(time) | np.isnan(amplitude))
+        codes, names = pd.factorize(sessions[valid])
+        for code, name in enumerate(names):
+            rows = codes == code
+            if name not in detectors:
+                detectors[name] = BreathHoldDetector(**detector_options)
+            detectors[name].feed(time[valid][rows], amplitude[valid][rows])
+
+    if not detectors:
+        raise ValueError("Respiratory trace has no samples")
+
+    holds = [(name,) + hold for name, detector in detectors.items() for hold in detector.finish()]
+    return pd.DataFrame(holds, columns=HOLD_COLUMNS)
+
+
+def summarize_breath_holds(holds, tolerance_mm=2.0):
+    """Intra- and inter-breath-hold stability statistics.
+
+    Args:
+        holds: DataFrame from detect_breath_holds
+        tolerance_mm: Largest acceptable amplitude range within a hold and
+            deviation of a hold's level from the session median
+
+    Returns:
+        tuple: (per-session DataFrame, dict of overall statistics; empty if there are no holds)
+    """
+    if holds.empty:
+        return pd.DataFrame(), {}
+
+    grouped = holds.groupby("Session", sort=False)
+    level_deviation = (holds["Level (mm)"] - grouped["Level (mm)"].transform("median")).abs()
+    holds = holds.assign(**{"Within Tolerance": (holds["Range (mm)"] <= tolerance_mm) & (level_deviation <= tolerance_mm)})
+    grouped = holds.groupby("Session", sort=False)
+
+    sessions = grouped.agg(**{
+        "Breath Holds": ("Level (mm)", "size"),
+        "Mean Duration (s)": ("Duration (s)", "mean"),
+        "Mean Level (mm)": ("Level (mm)", "mean"),
+        "Intra-Hold SD (mm)": ("SD (mm)", "mean"),
+        "Max Drift (mm)": ("Drift (mm)", lambda drift: drift.abs().max()),
+        "Inter-Hold SD (mm)": ("Level (mm)", "std"),
+        "Within Tolerance (%)": ("Within Tolerance", "mean"),
+    }).reset_index()
+    sessions["Within Tolerance (%)"] *= 100.0
+
+    # Pooled within-session SD of the hold levels, and spread of the session means
+    deviations = holds["Level (mm)"] - grouped["Level (mm)"].transform("mean")
+    degrees = len(holds) - len(sessions)
+    summary = {
+        "breath_holds": int(len(holds)),
+        "sessions": int(len(sessions)),
+        "mean_duration": round(float(holds["Duration (s)"].mean()), 1),
+        "intra_hold_sd": round(float(holds["SD (mm)"].mean()), 2),
+        "mean_drift": round(float(holds["Drift (mm)"].abs().mean()), 2),
+        "max_drift": round(float(holds["Drift (mm)"].abs().max()), 2),
+        "inter_hold_sd": round(float(np.sqrt((deviations ** 2).sum() / degrees)), 2) if degrees > 0 else None,
+        "inter_session_sd": round(float(sessions["Mean Level (mm)"].std()), 2) if len(sessions) > 1 else None,
+        "within_tolerance": round(float(holds["Within Tolerance"].mean() * 100.0), 1),
+        "tolerance_mm": tolerance_mm,
+    }
+    return sessions.round(2), summary
@@ -0,0 +1,317 @@
+import hashlib
+import os
+import tempfile
+from functools import lru_cache
+
+import numpy as np
+
+try:
+    import pydicom
+except ImportError:  # DICOM RT Structure Set support is optional
+    pydicom = None
+
+# Sub-rows per voxel row used to resolve partial coverage along the row axis;
+# coverage along the column axis is computed exactly
+DEFAULT_SUBSAMPLES = 4
+
+# Rasterized masks are shared by every session in this process and across runs
+STRUCTURE_CACHE_DIR = os.path.join(tempfile.gettempdir(), "quickwrite_structure_masks")
+MASK_CACHE_VERSION = 2
+
+# Cached fractions are stored as 16-bit integers out of this many levels
+FRACTION_LEVELS = 65535
+
+# Contour planes closer together than this (mm) are treated as one plane
+PLANE_TOLERANCE_MM = 0.01
+
+# Row and column direction cosines of a head-first supine axial grid
+AXIAL_ORIENTATION = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0)
+
+
+@lru_cache(maxsize=8)
+def _read_structure_set(path, mtime_ns, size):
+    if pydicom is None:
+        raise ImportError("pydicom is required to read DICOM RT Structure Sets")
+    dataset = pydicom.dcmread(path)
+    if dataset.get("Modality") != "RTSTRUCT":
+        raise ValueError(f"{os.path.basename(path)} is not an RT Structure Set")
+
+    names = {int(roi.ROINumber): str(roi.ROIName) for roi in dataset.get("StructureSetROISequence", [])}
+    structures = {}
+    for roi in dataset.get("ROIContourSequence", []):
+        contours = []
+        for contour in roi.get("ContourSequence", []):
+            if contour.get("ContourGeometricType", "CLOSED_PLANAR") != "CLOSED_PLANAR":
+                continue
+            # Parse the raw decimal strings directly rather than one DS object per coordinate
+            element = contour.get_item(0x30060050)
+            if element is None:
+                continue
+            value = element.value
+            if isinstance(value, bytes):
+                points = np.array(value.decode("ascii").split("\\"), dtype=float)
+            else:
+                points = np.asarray(value, dtype=float)
+            if points.size >= 9:
+                contours.append(points.reshape(-1, 3))
+        if contours:
+            structures[names.get(int(roi.ReferencedROINumber), f"ROI {roi.ReferencedROINumber}")] = contours
+    return structures
+
+
+def read_structures(path):
+    """Closed planar contours of every structure in a DICOM RT Structure Set.
+
+    Parsed sets are cached per file, so reading the same file again (from
+    another module, or on a rerun) costs a stat call.
+
+    Args:
+        path: Path to an RTSTRUCT file
+
+    Returns:
+        dict: Structure name mapped to a list of (points, 3) arrays of
+            patient coordinates (x, y, z) in mm, one per contour
+    """
+    stat = os.stat(path)
+    return _read_structure_set(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def _plane_coverage(polygons, rows, columns, subsamples):
+    """Fraction of every pixel of one plane inside the polygons (even-odd rule).
+
+    Polygons are in pixel coordinates (column, row) with pixel centres on
+    integers. Each pixel row is split into sub-rows; on each sub-row the
+    covered length of every pixel is exact, from the sorted edge crossings.
+
+    Returns:
+        tuple: (first row, first column, fractions over the polygons' bounding
+            box), or (0, 0, None) if no pixel is covered
+    """
+    # Shift so pixel j spans [j, j + 1)
+    u0 = np.concatenate([polygon[:, 0] for polygon in polygons]) + 0.5
+    v0 = np.concatenate([polygon[:, 1] for polygon in polygons]) + 0.5
+    u1 = np.concatenate([np.roll(polygon[:, 0], -1) for polygon in polygons]) + 0.5
+    v1 = np.concatenate([np.roll(polygon[:, 1], -1) for polygon in polygons]) + 0.5
+
+    first = max(int(np.floor(v0.min())), 0)
+    last = min(int(np.ceil(v0.max())), rows)
+    left = max(int(np.floor(u0.min())), 0)
+    right = min(int(np.ceil(u0.max())), columns)
+    if first >= last or left >= right:
+        return 0, 0, None
+    width = right - left
+    sub_rows = first + (np.arange((last - first) * subsamples) + 0.5) / subsamples
+
+    # Sub-rows crossed by each edge, half-open (lower end in, upper end out)
+    # so a vertex between two edges is counted once
+    low, high = np.minimum(v0, v1), np.maximum(v0, v1)
+    begin = np.clip(np.ceil((low - first) * subsamples - 0.5), 0, sub_rows.size).astype(np.int64)
+    end = np.clip(np.ceil((high - first) * subsamples - 0.5), 0, sub_rows.size).astype(np.int64)
+    counts = end - begin
+    total = int(counts.sum())
+    if not total:
+        return 0, 0, None
+    edge = np.repeat(np.arange(counts.size), counts)
+    row = begin[edge] + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    x = u0[edge] + (sub_rows[row] - v0[edge]) * (u1[edge] - u0[edge]) / (v1[edge] - v0[edge])
+    order = np.lexsort((x, row))
+    row, x = row[order], np.clip(x[order] - left, 0.0, width)
+
+    # Every sub-row has an even number of crossings, so the global parity
+    # alternates entering (+1) and leaving (-1) the structure
+    weight = np.where(np.arange(x.size) % 2 == 0, 1.0, -1.0)
+
+    # Pixel j is covered fully by the runs entered left of it (running sum of
+    # the weights) plus partly by the crossings inside it
+    stride = width + 2
+    step = np.floor(x).astype(np.int64)
+    flat = row * stride + step
+    size = sub_rows.size * stride
+    inside = np.cumsum(np.bincount(flat + 1, weights=weight, minlength=size + 1)[:size].reshape(-1, stride), axis=1)
+    partial = np.bincount(flat, weights=weight * (step + 1 - x), minlength=size).reshape(-1, stride)
+    coverage = inside[:, :width] + partial[:, :width]
+
+    fractions = coverage.reshape(last - first, subsamples, width).mean(axis=1)
+    return first, left, np.clip(fractions, 0.0, 1.0).astype(np.float32)
+
+
+def _grid_axes(orientation):
+    """Row direction, column direction and slice normal of an axial grid.
+
+    Contours are drawn on axial planes, so any other slice orientation
+    raises ValueError rather than producing a misplaced mask.
+    """
+    orientation = np.asarray(AXIAL_ORIENTATION if orientation is None else orientation, dtype=float)
+    row_direction, column_direction = orientation[:3], orientation[3:]
+    normal = np.cross(row_direction, column_direction)
+    if abs(abs(normal[2]) - 1.0) > 1e-3:
+        raise ValueError("Contours can only be rasterized onto axial grids")
+    return row_direction, column_direction, normal
+
+
+def rasterize_contours(contours, origin_mm, spacing_mm, shape, subsamples=DEFAULT_SUBSAMPLES, orientation=None):
+    """Convert planar contours to a fractional voxel mask on an axial grid.
+
+    Each distinct contour plane is rasterized once; every grid slice between
+    the first and last contour takes the nearest contour plane, and the
+    structure ends half the median contour plane spacing beyond its first
+    and last contour, so uneven contour spacing never leaves gaps.
+    Prone and feet-first grids are handled through the orientation, and
+    slices running against the slice normal through a negative slice
+    spacing; non-axial grids raise ValueError.
+
+    Args:
+        contours: List of (points, 3) arrays of patient coordinates in mm
+        origin_mm: Patient coordinates (x, y, z) of the first voxel centre
+        spacing_mm: Voxel spacing (slice, row, column) in mm; the slice
+            spacing is signed along the slice normal (DicomVolume.slice_step_mm)
+        shape: Grid shape (slices, rows, columns)
+        subsamples: Sub-rows per voxel row for partial-volume fractions
+        orientation: ImageOrientationPatient direction cosines of the rows
+            and columns (head-first supine if None)
+
+    Returns:
+        numpy.ndarray: float32 fraction (0-1) of each voxel inside the structure
+    """
+    row_direction, column_direction, normal = _grid_axes(orientation)
+    slices, rows, columns = shape
+    mask = np.zeros(shape, dtype=np.float32)
+    if not contours:
+        return mask
+
+    # Group contours by their position along the slice normal, in pixel coordinates
+    origin = np.asarray(origin_mm, dtype=float)
+    planes = {}
+    for points in contours:
+        offsets = points - origin
+        key = round(float(offsets[0] @ normal) / PLANE_TOLERANCE_MM)
+        pixels = np.column_stack([offsets @ row_direction / spacing_mm[2], offsets @ column_direction / spacing_mm[1]])
+        planes.setdefault(key, []).append(pixels)
+    plane_z = np.array(sorted(planes), dtype=float) * PLANE_TOLERANCE_MM
+    plane_keys = sorted(planes)
+    # Beyond the end planes the structure extends half a (typical) contour gap
+    half_gap = np.median(np.diff(plane_z)) / 2.0 if plane_z.size > 1 else abs(spacing_mm[0]) / 2.0
+
+    # Nearest contour plane for every grid slice
+    slice_z = np.arange(slices) * spacing_mm[0]
+    if plane_z.size > 1:
+        upper = np.clip(np.searchsorted(plane_z, slice_z), 1, plane_z.size - 1)
+        nearest = upper - ((slice_z - plane_z[upper - 1]) <= (plane_z[upper] - slice_z))
+    else:
+        nearest = np.zeros(slices, dtype=np.int64)
+    in_range = ((slice_z >= plane_z[0] - half_gap - PLANE_TOLERANCE_MM)
+                & (slice_z <= plane_z[-1] + half_gap + PLANE_TOLERANCE_MM))
+
+    rasterized = {}
+    for index in np.flatnonzero(in_range):
+        plane = int(nearest[index])
+        if plane not in rasterized:
+            rasterized[plane] = _plane_coverage(planes[plane_keys[plane]], rows, columns, subsamples)
+        first, left, fractions = rasterized[plane]
+        if fractions is not None:
+            mask[index, first:first + fractions.shape[0], left:left + fractions.shape[1]] = fractions
+    return mask
+
+
+def _mask_cache_key(contours, origin_mm, spacing_mm, shape, subsamples, orientation):
+    """Digest of a structure's contour points and the grid geometry."""
+    digest = hashlib.sha1(str(MASK_CACHE_VERSION).encode("utf-8"))
+    for points in contours:
+        digest.update(np.ascontiguousarray(points, dtype=np.float64).tobytes())
+    geometry = np.concatenate([np.asarray(origin_mm, dtype=float), np.asarray(spacing_mm, dtype=float),
+                               np.asarray(shape, dtype=float), [subsamples],
+                               np.asarray(AXIAL_ORIENTATION if orientation is None else orientation, dtype=float)])
+    digest.update(np.round(geometry, 4).tobytes())
+    return digest.hexdigest()
+
+
+def rasterize_structure(contours, origin_mm, spacing_mm, shape, subsamples=DEFAULT_SUBSAMPLES,
+                        cache_dir=STRUCTURE_CACHE_DIR, orientation=None):
+    """rasterize_contours with a compressed on-disk cache.
+
+    Masks are stored cropped to their bounding box as 16-bit fractions in
+    a compressed .npz, keyed by the contour points and the grid geometry,
+    so a structure is rasterized once per grid no matter which module or
+    rerun asks for it.
+
+    Args:
+        contours: List of (points, 3) arrays of patient coordinates in mm
+        origin_mm: Patient coordinates (x, y, z) of the first voxel centre
+        spacing_mm: Voxel spacing (slice, row, column) in mm
+        shape: Grid shape (slices, rows, columns)
+        subsamples: Sub-rows per voxel row for partial-volume fractions
+        cache_dir: Cache directory, or None to skip the cache
+        orientation: Row and column direction cosines (head-first supine if None)
+
+    Returns:
+        numpy.ndarray: float32 fraction (0-1) of each voxel inside the structure
+    """
+    shape = tuple(int(size) for size in shape)
+    if cache_dir is None:
+        return rasterize_contours(contours, origin_mm, spacing_mm, shape, subsamples, orientation)
+
+    _grid_axes(orientation)
+    key = _mask_cache_key(contours, origin_mm, spacing_mm, shape, subsamples, orientation)
+    path = os.path.join(cache_dir, key + ".npz")
+    mask = np.zeros(shape, dtype=np.float32)
+    try:
+        with np.load(path) as cached:
+            start, levels = cached["start"], cached["fractions"]
+        mask[tuple(slice(a, a + n) for a, n in zip(start, levels.shape))] = levels / np.float32(FRACTION_LEVELS)
+        return mask
+    except (OSError, KeyError, ValueError):
+        pass
+
+    mask = rasterize_contours(contours, origin_mm, spacing_mm, shape, subsamples, orientation)
+
+    # Bounding box from the per-axis projections
+    start, stop = [], []
+    for axis in range(3):
+        touched = np.flatnonzero(mask.any(axis=tuple(other for other in range(3) if other != axis)))
+        start.append(touched[0] if touched.size else 0)
+        stop.append(touched[-1] + 1 if touched.size else 0)
+    levels = np.round(mask[tuple(map(slice, start, stop))] * FRACTION_LEVELS).astype(np.uint16)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write under a temporary name so a concurrent reader never sees a partial file
+        temp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(temp_path, start=np.array(start, dtype=np.int64), fractions=levels)
+        os.replace(temp_path, path)
+    except OSError:
+        pass
+
+    # Return the stored values so a cached mask is identical to a fresh one
+    mask[tuple(map(slice, start, stop))] = levels / np.float32(FRACTION_LEVELS)
+    return mask
+
+
+def rasterize_structure_set(path, origin_mm, spacing_mm, shape, names=None, subsamples=DEFAULT_SUBSAMPLES,
+                            cache_dir=STRUCTURE_CACHE_DIR, orientation=None):
+    """Fractional masks on a grid for the structures of an RT Structure Set.
+
+    Args:
+        path: Path to an RTSTRUCT file
+        origin_mm: Patient coordinates (x, y, z) of the first voxel centre
+        spacing_mm: Voxel spacing (slice, row, column) in mm, with the slice
+            spacing signed along the slice normal
+        shape: Grid shape (slices, rows, columns)
+        names: Structures to rasterize (all with contours if None)
+        subsamples: Sub-rows per voxel row for partial-volume fractions
+        cache_dir: Mask cache directory, or None to skip the cache
+        orientation: Row and column direction cosines (head-first supine if None)
+
+    Returns:
+        dict: Structure name mapped to its float32 mask; structures that
+            do not touch the grid are left out
+    """
+    structures = read_structures(path)
+    missing = [name for name in names or [] if name not in structures]
+    if missing:
+        raise ValueError(f"Structure(s) not in the structure set: {', '.join(missing)}")
+
+    masks = {}
+    for name in names or structures:
+        mask = rasterize_structure(structures[name], origin_mm, spacing_mm, shape, subsamples, cache_dir, orientation)
+        if mask.any():
+            masks[name] = mask
+    return masks
@@ -0,0 +1,453 @@
+"""Microbenchmarks for write-up generation, validation and search functions.
+
+Times every module's generate_write_up at realistic and extreme input sizes,
+the dose/fractionation validators, and the QA Bank, P&P and Inventory search
+functions on synthetic data sets. Results are compared against the stored
+baseline in tests/benchmark_baseline.json and the run fails if any benchmark
+is slower than the baseline by more than the threshold.
+
+Timings are machine-specific: regenerate the baseline on the machine that
+runs the comparison.
+
+Usage:
+    python tests/benchmark_modules.py                    # compare to baseline
+    python tests/benchmark_modules.py --update-baseline  # record a new baseline
+    python tests/benchmark_modules.py --filter srs --threshold 0.25
+"""
+import argparse
+import copy
+import io
+import json
+import os
+import sys
+import tempfile
+import timeit
+from unittest.mock import MagicMock
+
+import numpy as np
+
+# Add the parent directory to the path to import modules
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from modules.dibh import DIBHModule
+from modules.fusion import FusionModule
+from modules.prior_dose import PriorDoseModule
+from modules.pacemaker import PacemakerModule
+from modules.sbrt import SBRTModule
+from modules.srs import SRSModule
+from modules.qa_bank import QABankModule
+from modules.pnp import PnPModule
+from modules.inventory import InventoryModule
+from validation_utils import validate_dose_fractionation, validate_treatment_site_consistency, validate_prescriptions
+from audit_utils import audit_prescription_csv
+from cied_utils import stratify_devices, get_peripheral_dose_table, device_position_grid
+from invivo_utils import MeasurementLog
+from respiratory_utils import detect_breath_holds
+from motion_utils import build_itv
+from registration_utils import rigid_transform, registration_metrics, analyze_dvf
+import dicom_utils
+import prefill_utils
+from structure_utils import rasterize_contours
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# Differences smaller than this (seconds per call) are treated as noise
+NOISE_FLOOR = 2e-6
+
+COMMON_INFO = {
+    "physician": "Smith",
+    "physicist": "Brown",
+    "patient_age": 65,
+    "patient_sex": "female",
+    "patient_details": "a 65-year-old female",
+}
+
+SITES = ["brain", "left frontal lobe", "brainstem", "lung", "breast", "prostate", "liver", "pelvis", "spine", None]
+
+
+def _config_manager():
+    """Return a config manager stub so modules don't read data/config.json."""
+    config_manager = MagicMock()
+    config_manager.get_physicians.return_value = ["Smith"]
+    config_manager.get_physicists.return_value = ["Brown"]
+    return config_manager
+
+
+def _load_json(filename):
+    with open(os.path.join(ROOT_DIR, "data", filename), "r") as f:
+        return json.load(f)
+
+
+def _scaled(records, count):
+    """Repeat sample records (with unique IDs) until there are count of them."""
+    scaled = []
+    for i in range(count):
+        record = copy.deepcopy(records[i % len(records)])
+        record["id"] = f"{record['id']}-{i}"
+        scaled.append(record)
+    return scaled
+
+
+def _srs_data(num_lesions):
+    lesion = {
+        "site": "left frontal lobe", "volume": 1.5, "treatment_type": "SRS (Single Fraction)",
+        "dose": 18.0, "fractions": 1, "prescription_isodose": 80.0, "ptv_coverage": 98.0,
+        "conformity_index": 1.2, "gradient_index": 3.0, "max_dose": 125,
+    }
+    return {"lesions": [dict(lesion) for _ in range(num_lesions)]}
+
+
+def _prior_dose_data(num_courses):
+    return {
+        "current_site": "spine", "current_dose": 30.0, "current_fractions": 10,
+        "spine_location": "T4-T6", "has_overlap": "Yes",
+        "dose_calc_method": "EQD2 (Equivalent Dose in 2 Gy fractions)",
+        "critical_structures": ["Spinal cord", "Esophagus", "Heart"],
+        "prior_treatments": [
+            {"site": "spine", "dose": 20.0, "fractions": 5, "month": "March", "year": 2015 + i % 8, "spine_location": "T5"}
+            for i in range(num_courses)
+        ],
+    }
+
+
+def _fusion_data(num_registrations):
+    return {
+        "lesion": "brain", "anatomical_region": "brain",
+        "registrations": [
+            {"primary": "CT", "secondary": ["MRI", "PET/CT", "CT", "CBCT"][i % 4], "method": ["Rigid", "Deformable"][i % 2]}
+            for i in range(num_registrations)
+        ],
+    }
+
+
+def _write_up_benchmarks():
+    """Benchmarks for each module's generate_write_up."""
+    config_manager = _config_manager()
+    dibh, fusion, prior_dose = DIBHModule(config_manager), FusionModule(config_manager), PriorDoseModule(config_manager)
+    pacemaker, sbrt, srs = PacemakerModule(config_manager), SBRTModule(config_manager), SRSModule(config_manager)
+
+    dibh_data = {"treatment_site": "left breast", "dose": 40.05, "fractions": 15, "immobilization_device": "breast board"}
+    pacemaker_data = {
+        "treatment_site": "lung", "dose": 60.0, "fractions": 30, "device_vendor": "Medtronic", "device_model": "Azure",
+        "device_serial": "ABC123", "pacing_dependent": "No", "risk_level": "Medium",
+        "tps_max_dose": 1.2, "tps_mean_dose": 0.4, "osld_mean_dose": 0.03,
+    }
+    sbrt_data = {
+        "treatment_site": "lung", "dose": 50.0, "fractions": 5, "target_volume": 12.3, "ptv_coverage": 95,
+        "pitv": 1.1, "r50": 4.2, "motion_text": "Motion text.", "imaging_text": "Imaging text.",
+    }
+
+    benchmarks = {
+        "dibh.generate_write_up": lambda: dibh.generate_write_up(COMMON_INFO, dibh_data),
+        "pacemaker.generate_write_up": lambda: pacemaker.generate_write_up(COMMON_INFO, pacemaker_data),
+        "sbrt.generate_write_up": lambda: sbrt.generate_write_up(COMMON_INFO, sbrt_data),
+    }
+    for count in (1, 10):
+        data = _fusion_data(count)
+        benchmarks[f"fusion.generate_write_up[{count}_registrations]"] = lambda data=data: fusion.generate_write_up(COMMON_INFO, data)
+    for count in (1, 20):
+        data = _prior_dose_data(count)
+        benchmarks[f"prior_dose.generate_write_up[{count}_courses]"] = lambda data=data: prior_dose.generate_write_up(COMMON_INFO, data)
+    for count in (1, 10, 50):
+        data = _srs_data(count)
+        benchmarks[f"srs.generate_write_up[{count}_lesions]"] = lambda data=data: srs.generate_write_up(COMMON_INFO, data)
+    return benchmarks
+
+
+def _validator_benchmarks():
+    """Benchmarks for the dose/fractionation validators over many prescriptions."""
+    prescriptions = [(10 + (i * 7) % 70, 1 + (i * 3) % 35, SITES[i % len(SITES)]) for i in range(1000)]
+
+    def validate_all():
+        for dose, fractions, site in prescriptions:
+            validate_dose_fractionation(dose, fractions, site)
+
+    def validate_consistency_all():
+        for dose, fractions, site in prescriptions:
+            validate_treatment_site_consistency(site, dose, fractions)
+
+    benchmarks = {
+        "validate_dose_fractionation[1000_rx]": validate_all,
+        "validate_treatment_site_consistency[1000_rx]": validate_consistency_all,
+    }
+    # Both validators over the same prescriptions in one bulk call
+    for count in (1000, 50000):
+        doses, fractions, sites = zip(*(prescriptions * (count // 1000)))
+        benchmarks[f"validate_prescriptions[{count}_rx]"] = (
+            lambda doses=doses, fractions=fractions, sites=sites: validate_prescriptions(doses, fractions, sites)
+        )
+
+    # Batch audit of a CSV export, parsed from memory
+    rows = ["site,dose,fractions,technique,physician"]
+    rows += [f"{site or ''},{dose},{fractions},VMAT,Dr. {i % 4}"
+             for i, (dose, fractions, site) in enumerate(prescriptions * 10)]
+    export = "\n".join(rows)
+    benchmarks["audit_prescription_csv[10000_rx]"] = lambda: audit_prescription_csv(io.StringIO(export))
+    return benchmarks
+
+
+def _cied_benchmarks():
+    """Benchmarks for batch TG-203 risk stratification of a device clinic."""
+    distances = [
+        "More than 10 cm from treatment field edge", "Less than 10 cm from field edge but not in direct field",
+        "Within 3 cm of field edge", "CIED in direct beam",
+    ]
+    benchmarks = {}
+    for count in (1000, 100000):
+        columns = (
+            [("Yes", "No", "Unknown")[i % 3] for i in range(count)],
+            [("No", "Yes")[i % 7 == 0] for i in range(count)],
+            [(i * 0.37) % 8 if i % 4 else 0.0 for i in range(count)],
+            [distances[i % len(distances)] for i in range(count)],
+        )
+        benchmarks[f"stratify_devices[{count}_patients]"] = lambda columns=columns: stratify_devices(*columns)
+
+    # Peripheral dose over a fine grid of candidate device positions
+    table = get_peripheral_dose_table()
+    x, y, grid = device_position_grid(10.0, 5.0, 3.0, steps=201)
+    benchmarks["peripheral_dose.device_dose[201x201_grid]"] = lambda: table.device_dose("6 MV", grid, 10.0, 7500)
+
+    # A full course of per-fraction readings arriving one fraction at a time
+    def log_course(fractions=40):
+        log = MeasurementLog(fractions, "OSLD (nanoDot)", calibration=1e-5)
+        for fraction in range(1, fractions + 1):
+            log.add_fraction(fraction, [20000 + 100 * fraction, 21000], hours=0.5)
+        return log.summary()
+
+    benchmarks["measurement_log.add_fraction[40_fractions]"] = log_course
+    return benchmarks
+
+
+def _respiratory_benchmarks():
+    """Benchmarks for breath-hold detection on a synthetic multi-fraction trace."""
+    rows = ["fraction,time,amplitude"]
+    for fraction in range(1, 16):
+        t = np.arange(0, 300, 0.04)
+        # 20 s free breathing, then a 15 s breath hold, repeated
+        holding = (t % 35) >= 20
+        amplitude = np.where(holding, 12 + 0.05 * (t % 35 - 20), 5 * np.sin(np.pi * t / 4) ** 2)
+        rows += [f"{fraction},{x:.2f},{a:.3f}" for x, a in zip(t, amplitude)]
+    trace = "\n".join(rows)
+    return {
+        "detect_breath_holds[15_fractions]": lambda: detect_breath_holds(io.StringIO(trace)),
+        "detect_breath_holds[15_fractions_chunked]": lambda: detect_breath_holds(io.StringIO(trace), chunk_size=5000),
+    }
+
+
+def _motion_benchmarks():
+    """Benchmarks for the ITV builder, registration QA and contour rasterization on synthetic volumes."""
+    grid = np.indices((64, 128, 128), sparse=True)
+    phases = [
+        (grid[0] - 30 - 4 * np.sin(np.pi * phase / 10)) ** 2 + (grid[1] - 64) ** 2 + (grid[2] - 64) ** 2 <= 144
+        for phase in range(10)
+    ]
+    benchmarks = {"build_itv[10_phases_64x128x128]": lambda: build_itv(iter(phases), (2.5, 1.0, 1.0))}
+
+    # Registration QA of a full-resolution CT slab against a coarser MR
+    z, y, x = np.ogrid[:100, :512, :512]
+    ct = (1000 * (((y - 256) / 200) ** 2 + ((x - 256) / 220) ** 2 < 1)
+          + 300 * (((z - 50) / 20) ** 2 + ((y - 230) / 50) ** 2 + ((x - 300) / 60) ** 2 < 1)).astype(np.int16)
+    mr = ct[::2, ::2, ::2].astype(np.float32)
+    transform = rigid_transform((0.0, 0.0, 2.0), (2.0, 3.0, -4.0), center_mm=(125.0, 256.0, 256.0))
+    benchmarks["registration_metrics[100x512x512]"] = (
+        lambda: registration_metrics(ct, mr, transform, (2.5, 1.0, 1.0), (5.0, 2.0, 2.0))
+    )
+
+    # Jacobian and displacement statistics of a deformation field, slab by slab
+    z, y, x = np.meshgrid(np.arange(64), np.arange(256), np.arange(256), indexing="ij", sparse=True)
+    dvf = np.empty((64, 256, 256, 3), dtype=np.float32)
+    dvf[..., 0], dvf[..., 1], dvf[..., 2] = 2 * np.sin(y / 20), 1.5 * np.cos(z / 8), 0.02 * (x - 128)
+    benchmarks["analyze_dvf[64x256x256]"] = lambda: analyze_dvf(dvf, (2.5, 1.0, 1.0))
+
+    # Partial-volume rasterization of a large structure, one contour per plane
+    angles = np.linspace(0, 2 * np.pi, 400, endpoint=False)
+    contours = [np.column_stack([150 * np.cos(angles), 120 * np.sin(angles), np.full(angles.size, z)])
+                for z in np.arange(-100.0, 100.0, 2.0)]
+    benchmarks["rasterize_contours[100_planes_100x512x512]"] = (
+        lambda: rasterize_contours(contours, (-256.0, -256.0, -100.0), (2.0, 1.0, 1.0), (100, 512, 512))
+    )
+    return benchmarks
+
+
+def _dicom_benchmarks(num_files=1000):
+    """Benchmarks for rescanning an indexed DICOM export and reopening a plan (skipped without pydicom)."""
+    if dicom_utils.pydicom is None:
+        return {}
+    import pydicom
+
+    # Kept alive by the benchmark closure
+    export = tempfile.TemporaryDirectory(prefix="dicom_benchmark_")
+    pixels = np.zeros((512, 512), dtype=np.int16).tobytes()
+    for i in range(num_files):
+        dataset = pydicom.Dataset()
+        dataset.file_meta = pydicom.dataset.FileMetaDataset()
+        dataset.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        dataset.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.2"
+        dataset.PatientID, dataset.Modality = f"P{i // 100}", "CT"
+        dataset.StudyInstanceUID, dataset.SeriesInstanceUID = f"1.2.{i // 100}", f"1.2.{i // 100}.1"
+        dataset.SOPInstanceUID, dataset.ImagePositionPatient = f"1.2.{i // 100}.1.{i}", [0, 0, i % 100]
+        dataset.file_meta.MediaStorageSOPInstanceUID = dataset.SOPInstanceUID
+        dataset.Rows = dataset.Columns = 512
+        dataset.BitsAllocated, dataset.PixelRepresentation, dataset.PixelData = 16, 1, pixels
+        dataset.save_as(os.path.join(export.name, f"CT{i:05d}.dcm"), enforce_file_format=True)
+    dicom_utils.index_directory(export.name)
+
+    def rescan(export=export):
+        # Drop the in-memory index so the on-disk index is reloaded and checked
+        dicom_utils._build_index.cache_clear()
+        return dicom_utils.index_directory(export.name)
+
+    # A treatment plan reopened in a new session, read from the extraction cache
+    plan = pydicom.Dataset()
+    plan.file_meta = pydicom.dataset.FileMetaDataset()
+    plan.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    plan.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.481.5"
+    plan.SOPInstanceUID = plan.file_meta.MediaStorageSOPInstanceUID = "1.2.0.2.1"
+    plan.Modality = "RTPLAN"
+    fraction_group = pydicom.Dataset()
+    fraction_group.NumberOfFractionsPlanned = 3
+    plan.FractionGroupSequence = [fraction_group]
+    plan.DoseReferenceSequence = []
+    for number in range(1, 11):
+        reference = pydicom.Dataset()
+        reference.DoseReferenceNumber, reference.DoseReferenceType = number, "TARGET"
+        reference.DoseReferenceDescription, reference.TargetPrescriptionDose = f"PTV_{number}", 24.0
+        plan.DoseReferenceSequence.append(reference)
+    plan_path = os.path.join(export.name, "plan", "RP.dcm")
+    os.makedirs(os.path.dirname(plan_path))
+    plan.save_as(plan_path, enforce_file_format=True)
+    cache_dir = os.path.join(export.name, "plan_cache")
+    prefill_utils.extract_plan(plan_path, cache_dir=cache_dir)
+
+    def reopen_plan(export=export):
+        prefill_utils._extract_plan.cache_clear()
+        return prefill_utils.extract_plan(plan_path, cache_dir=cache_dir)
+
+    return {
+        f"dicom_utils.index_directory[{num_files}_files_rescan]": rescan,
+        "prefill_utils.extract_plan[10_targets_reopen]": reopen_plan,
+    }
+
+
+def _search_benchmarks():
+    """Benchmarks for the QA Bank, P&P and Inventory searches on synthetic data."""
+    qa_tests = _load_json("qa_tests.json")["tests"]
+    pp_documents = _load_json("pp_documents.json")["documents"]
+    equipment = _load_json("inventory_equipment.json")["items"]
+    user_data = _load_json("inventory_user_data.json")
+
+    benchmarks = {}
+    for count in (100, 10000):
+        # Build the modules without touching their data files on disk
+        qa_bank = QABankModule.__new__(QABankModule)
+        qa_bank.qa_tests = {"tests": _scaled(qa_tests, count)}
+        benchmarks[f"qa_bank._search_tests[{count}]"] = (
+            lambda qa_bank=qa_bank: qa_bank._search_tests("output", "All Categories", "All Frequencies")
+        )
+
+        pnp = PnPModule.__new__(PnPModule)
+        pnp.pp_documents = {"documents": _scaled(pp_documents, count)}
+        benchmarks[f"pnp._search_pp_documents[{count}]"] = (
+            lambda pnp=pnp: pnp._search_pp_documents("patient", "All Categories")
+        )
+
+        inventory = InventoryModule.__new__(InventoryModule)
+        inventory.equipment = {"items": _scaled(equipment, count)}
+        inventory.user_data = user_data
+        benchmarks[f"inventory._filter_equipment[{count}]"] = (
+            lambda inventory=inventory: inventory._filter_equipment("chamber", "All Categories", "All", [], "All")
+        )
+    return benchmarks
+
+
+def collect_benchmarks():
+    """Return all benchmarks as a dict mapping name to a zero-argument callable."""
+    benchmarks = {}
+    benchmarks.update(_write_up_benchmarks())
+    benchmarks.update(_validator_benchmarks())
+    benchmarks.update(_cied_benchmarks())
+    benchmarks.update(_respiratory_benchmarks())
+    benchmarks.update(_motion_benchmarks())
+    benchmarks.update(_dicom_benchmarks())
+    benchmarks.update(_search_benchmarks())
+    return benchmarks
+
+
+def time_benchmark(func, repeat=5):
+    """Return the best seconds-per-call for func over several timing runs."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """Find benchmarks that are slower than the baseline by more than threshold.
+
+    Args:
+        results: Dict mapping benchmark name to seconds per call
+        baseline: Dict mapping benchmark name to baseline seconds per call
+        threshold: Allowed fractional slowdown, e.g. 0.5 for 50%
+
+    Returns:
+        list: (name, baseline_seconds, current_seconds) for each regression
+    """
+    regressions = []
+    for name, seconds in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        if seconds > reference * (1 + threshold) and seconds - reference > NOISE_FLOOR:
+            regressions.append((name, reference, seconds))
+    return regressions
+
+
+def _format_time(seconds):
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:9.1f} µs"
+    return f"{seconds * 1e3:9.2f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run QuickWrite microbenchmarks.")
+    parser.add_argument("--update-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.5, help="allowed slowdown before failing (0.5 = 50%%)")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this text")
+    args = parser.parse_args()
+
+    os.chdir(ROOT_DIR)
+    benchmarks = {name: func for name, func in collect_benchmarks().items() if args.filter in name}
+
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, "r") as f:
+            baseline = json.load(f)
+
+    results = {}
+    for name, func in benchmarks.items():
+        results[name] = time_benchmark(func)
+        reference = baseline.get(name)
+        change = f"{(results[name] / reference - 1) * 100:+6.1f}%" if reference else "    new"
+        print(f"{name:<55} {_format_time(results[name])}  {change}")
+
+    if args.update_baseline:
+        baseline.update(results)
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(dict(sorted(baseline.items())), f, indent=2)
+            f.write("\n")
+        print(f"\nBaseline updated: {BASELINE_FILE}")
+        return 0
+
+    regressions = compare_to_baseline(results, baseline, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}:")
+        for name, reference, seconds in regressions:
+            print(f"  - {name}: {_format_time(reference).strip()} -> {_format_time(seconds).strip()}")
+        return 1
+
+    print("\nNo regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
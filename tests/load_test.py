@@ -0,0 +1,228 @@
+"""Headless load test for the QuickWrite workflow.
+
+Drives N simulated residents through the full QuickWrite path with
+Streamlit's AppTest (common info, module selection, every module's details,
+write-up generation and results) and reports rerun latency percentiles,
+memory per session and the failure rate.
+
+AppTest installs a process-global runtime for each script run, so reruns
+from different sessions can't execute at the same instant in one process.
+The harness therefore models a single server worker: sessions run
+concurrently in threads, their reruns queue for the one worker, and the
+reported latency is what a user would see (queueing plus execution).
+
+Usage:
+    python tests/load_test.py --sessions 20 --concurrency 10
+    python tests/load_test.py --sessions 50 --modules dibh,srs --think-time 2 --json report.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Add the parent directory to the path so the app and its modules import
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from streamlit.testing.v1 import AppTest
+
+ALL_MODULES = ["dibh", "fusion", "prior_dose", "pacemaker", "sbrt", "srs"]
+
+# The simulated server worker: one script run at a time
+_worker_lock = threading.Lock()
+
+
+class SimulatedResident:
+    """One scripted user session walking through the QuickWrite workflow."""
+
+    def __init__(self, session_index, module_ids, think_time=0.0, timeout=60):
+        """Initialize the session.
+
+        Args:
+            session_index: Index of this session, used to vary the inputs
+            module_ids: Modules to select and complete
+            think_time: Seconds the resident pauses between interactions
+            timeout: Seconds allowed for a single rerun
+        """
+        self.session_index = session_index
+        self.module_ids = module_ids
+        self.think_time = think_time
+        self.timeout = timeout
+        self.latencies_ms = []
+        self.service_ms = []
+        self.error = None
+        self.app = None
+
+    def run(self):
+        """Run the full workflow, recording the latency of every rerun.
+
+        Returns:
+            SimulatedResident: self, for use with executor.map
+        """
+        try:
+            self.app = AppTest.from_file(os.path.join(ROOT_DIR, "app.py"), default_timeout=self.timeout)
+            self._rerun(self.app)
+
+            # Landing page -> QuickWrite
+            self._rerun(self.app.button(key="quickwrite_btn").click())
+
+            # Common information
+            self._rerun(self.app.number_input(key="common_age").set_value(40 + self.session_index % 50))
+            self._rerun(self.app.button(key="basic_info_continue").click())
+
+            # Module selection
+            for module_id in self.module_ids:
+                self._rerun(self.app.checkbox(key=f"select_{module_id}").check())
+            self._rerun(self.app.button(key="module_selection_continue").click())
+
+            # Module details
+            for module_id in self.module_ids:
+                self._fill_module(module_id)
+                self._rerun(self.app.button(key=f"save_{module_id}").click())
+                if module_id not in self.app.session_state["module_data"]:
+                    raise RuntimeError(f"{module_id} details were not saved")
+
+            # Results
+            self._rerun(self.app.button(key="generate_write_ups").click())
+            if self.app.session_state["workflow_step"] != "results":
+                raise RuntimeError("workflow did not reach the results step")
+            if len(self.app.session_state["results"]) != len(self.module_ids):
+                raise RuntimeError("not every selected write-up was generated")
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+
+        return self
+
+    def _fill_module(self, module_id):
+        """Enter the inputs a module needs beyond its defaults."""
+        if module_id == "fusion":
+            add_buttons = [b for b in self.app.button if b.label == "Add Registration"]
+            self._rerun(add_buttons[0].click())
+        elif module_id == "prior_dose":
+            self._rerun(self.app.button(key="add_prior_treatment").click())
+
+    def _rerun(self, widget_or_app):
+        """Run the script once and record how long the user waited for it."""
+        if self.think_time and self.latencies_ms:
+            time.sleep(self.think_time)
+
+        start = time.perf_counter()
+        with _worker_lock:
+            service_start = time.perf_counter()
+            widget_or_app.run()
+            end = time.perf_counter()
+        self.latencies_ms.append((end - start) * 1000)
+        self.service_ms.append((end - service_start) * 1000)
+
+        if self.app.exception:
+            raise RuntimeError(self.app.exception[0].message)
+
+
+def run_load_test(sessions, concurrency, module_ids, think_time=0.0):
+    """Run simulated sessions concurrently and summarize the results.
+
+    Args:
+        sessions: Total number of simulated residents
+        concurrency: Number of sessions running at the same time
+        module_ids: Modules each resident completes
+        think_time: Seconds each resident pauses between interactions
+
+    Returns:
+        dict: Latency percentiles, memory per session and failure rate
+    """
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        residents = list(executor.map(
+            lambda i: SimulatedResident(i, module_ids, think_time).run(),
+            range(sessions)
+        ))
+    wall_time = time.perf_counter() - start
+
+    # Memory still held while every session's state is alive
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = np.array([ms for r in residents for ms in r.latencies_ms])
+    service = np.array([ms for r in residents for ms in r.service_ms])
+    failures = [r for r in residents if r.error]
+
+    report = {
+        "sessions": sessions,
+        "concurrency": concurrency,
+        "think_time_s": think_time,
+        "modules": module_ids,
+        "reruns": int(latencies.size),
+        "wall_time_s": round(wall_time, 2),
+        "reruns_per_s": round(latencies.size / wall_time, 1) if wall_time > 0 else 0.0,
+        "memory_per_session_kb": round((retained - baseline) / 1024 / sessions, 1),
+        "peak_memory_mb": round((peak - baseline) / 1024 / 1024, 1),
+        "failure_rate": round(len(failures) / sessions, 4),
+        "failures": [f"session {r.session_index}: {r.error}" for r in failures[:10]],
+    }
+    if latencies.size:
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        report.update({
+            "latency_p50_ms": round(p50, 1),
+            "latency_p95_ms": round(p95, 1),
+            "latency_p99_ms": round(p99, 1),
+            "latency_max_ms": round(latencies.max(), 1),
+            "service_p50_ms": round(np.percentile(service, 50), 1),
+        })
+
+    return report
+
+
+def print_report(report):
+    """Print the load test summary."""
+    print(f"Sessions: {report['sessions']} ({report['concurrency']} concurrent), modules: {', '.join(report['modules'])}")
+    print(f"Reruns: {report['reruns']} in {report['wall_time_s']} s ({report['reruns_per_s']} reruns/s)")
+    if "latency_p50_ms" in report:
+        print(f"Rerun latency: p50 {report['latency_p50_ms']} ms, p95 {report['latency_p95_ms']} ms, "
+              f"p99 {report['latency_p99_ms']} ms, max {report['latency_max_ms']} ms")
+        print(f"Script execution time per rerun (without queueing): p50 {report['service_p50_ms']} ms")
+    print(f"Memory per session: {report['memory_per_session_kb']} KB (peak {report['peak_memory_mb']} MB total)")
+    print(f"Failure rate: {report['failure_rate']:.1%}")
+    for failure in report["failures"]:
+        print(f"  - {failure}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the QuickWrite workflow headlessly.")
+    parser.add_argument("--sessions", type=int, default=10, help="number of simulated residents")
+    parser.add_argument("--concurrency", type=int, default=5, help="sessions running at the same time")
+    parser.add_argument("--modules", default=",".join(ALL_MODULES), help="comma-separated module IDs to complete")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds each resident pauses between interactions")
+    parser.add_argument("--json", dest="json_path", help="also write the report to this JSON file")
+    args = parser.parse_args()
+
+    module_ids = [m.strip() for m in args.modules.split(",") if m.strip()]
+    unknown = [m for m in module_ids if m not in ALL_MODULES]
+    if unknown:
+        parser.error(f"unknown modules: {', '.join(unknown)}")
+
+    # Keep simulated drafts out of the real draft store
+    with tempfile.TemporaryDirectory() as draft_dir:
+        os.environ["QUICKWRITE_DRAFT_DIR"] = draft_dir
+        os.chdir(ROOT_DIR)
+        report = run_load_test(args.sessions, args.concurrency, module_ids, args.think_time)
+
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    return 1 if report["failure_rate"] > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,7 @@
 import unittest
 import sys
 import os
+import tempfile
 from unittest.mock import MagicMock, patch
 
 # Add the parent directory to the path to import modules
@@ -9,7 +10,45 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 # Import modules to test
 from modules.base_module import BaseWriteUpModule
 from modules.templates import ConfigManager
-from validation_utils import FormValidator, validate_dose_fractionation
+from validation_utils import (
+    FormValidator, validate_dose_fractionation, validate_treatment_site_consistency, validate_prescriptions
+)
+from radiobiology_utils import (
+    calculate_bed, calculate_eqd2, cumulative_dose, sensitivity_grid,
+    build_alpha_beta_labels, composite_eqd2, summarize_composite,
+    load_recovery_models, recovery_fractions, isoeffective_dose, translate_constraint,
+    get_alpha_beta, get_recovery_model, load_dose_grid
+)
+import numpy as np
+import pandas as pd
+from dvh_utils import compute_dvhs
+from constraint_utils import get_constraint_library, describe_rules
+from audit_utils import audit_prescription_csv
+import dicom_utils
+from dicom_utils import index_directory, summarize_series, open_series
+import structure_utils
+from structure_utils import rasterize_contours, rasterize_structure_set
+import prefill_utils
+from prefill_utils import extract_plan, prefill_module_data
+from invivo_utils import MeasurementLog, corrected_dose
+from respiratory_utils import detect_breath_holds, summarize_breath_holds
+from motion_utils import build_itv, iter_phase_masks, summarize_motion
+from registration_utils import (
+    rigid_transform, registration_metrics, landmark_errors, load_dvf, analyze_dvf, jacobian_determinant
+)
+from cied_utils import (
+    stratify_devices, calculate_risk_level, DOSE_CATEGORIES, get_peripheral_dose_table, device_position_grid,
+    dose_category_margin
+)
+import io
+from plan_quality_utils import (
+    srs_lesion_metrics, sbrt_plan_metrics, distance_from_mask, load_sbrt_tables, grade_sbrt_metrics
+)
+from modules.prior_dose import PriorDoseModule
+from modules.pacemaker import PacemakerModule
+from modules.sbrt import SBRTModule
+from streamlit.testing.v1 import AppTest
+from utils import save_uploaded_file, file_source_path
 
 # Mock classes for testing
 class MockModule(BaseWriteUpModule):
@@ -146,6 +185,21 @@ class TestValidationUtils(unittest.TestCase):
         is_valid, message = validate_dose_fractionation(50, 5, "lung")
         self.assertTrue(is_valid)
     
+    def test_bulk_validation_matches_single_prescriptions(self):
+        """validate_prescriptions gives the same results as the per-prescription validators."""
+        sites = ["Brainstem", "left frontal lobe", "lung", "Breast", "prostate", "liver metastasis",
+                 "pelvis", "spine", None]
+        prescriptions = [(dose, fractions, site) for site in sites
+                         for dose in (8, 12, 16, 20, 30, 36.25, 45, 60, 78)
+                         for fractions in (0, 1, 3, 5, 10, 15, 25, 39)]
+        doses, fractions, rx_sites = zip(*prescriptions)
+        
+        results = validate_prescriptions(doses, fractions, rx_sites)
+        
+        for (dose, fx, site), row in zip(prescriptions, results.itertuples(index=False)):
+            self.assertEqual((row[0], row[1]), validate_dose_fractionation(dose, fx, site))
+            self.assertEqual((row[2], row[3]), validate_treatment_site_consistency(site, dose, fx))
+    
     def test_form_validator(self):
         """Test FormValidator functionality."""
         validator = FormValidator()
@@ -182,5 +236,845 @@ class TestValidationUtils(unittest.TestCase):
         self.assertEqual(len(validator.warnings), 1)
 
 
+class TestAuditUtils(unittest.TestCase):
+    """Test cases for the batch prescription audit."""
+    
+    def test_audit_streams_chunks_and_groups_findings(self):
+        """Findings and per-site/physician counts are the same however the CSV is chunked."""
+        export = io.StringIO(
+            "Site, Dose, Fractions, Technique, Physician\n"
+            "Prostate, 78, 39, VMAT, Dr. A\n"
+            "Brain, 30, 1, SRS, Dr. A\n"
+            "breast, 50, 5, 3D, Dr. B\n"
+            "Lung, , 5, SBRT, Dr. B\n"
+            "Lung, 54, 3, SBRT, Dr. B\n"
+        )
+        report = audit_prescription_csv(export, chunk_size=2)
+        
+        self.assertEqual((report["rows"], report["errors"], report["warnings"]), (5, 3, 0))
+        self.assertEqual(list(report["findings"]["Row"].unique()), [2, 3, 4])
+        self.assertIn("Missing or non-numeric dose/fractions", report["findings"]["Issue"].tolist())
+        
+        by_physician = report["by_physician"].set_index("Physician")
+        self.assertEqual(by_physician.loc["Dr. B", "Prescriptions"], 3)
+        self.assertEqual(by_physician.loc["Dr. B", "With Errors"], 2)
+        by_site = report["by_site"].set_index("Site")
+        self.assertEqual(by_site.loc["lung", "Prescriptions"], 2)
+        
+        with self.assertRaises(ValueError):
+            audit_prescription_csv(io.StringIO("site,dose\nlung,50\n"))
+
+
+class TestRadiobiologyUtils(unittest.TestCase):
+    """Test cases for the BED/EQD2 engine and its use in the Prior Dose write-up."""
+    
+    def test_cord_keyword_skips_vocal_cords(self):
+        """Spinal cord names get the CNS α/β and recovery model; vocal cords do not."""
+        models = load_recovery_models()
+        for name in ("Spinal cord", "SpinalCord", "Cord_PRV"):
+            self.assertEqual(get_alpha_beta(name), 2.0)
+            self.assertEqual(get_recovery_model(name, models), "spinal_cord")
+        for name in ("Vocal cord", "Vocal_Cord_L"):
+            self.assertEqual(get_alpha_beta(name), 3.0)
+            self.assertEqual(get_recovery_model(name, models), models["default_model"])
+    
+    def test_bed_and_eqd2(self):
+        """LQ conversions match hand-calculated values and 2 Gy fractions are unchanged."""
+        self.assertAlmostEqual(float(calculate_bed(30, 10, 3)), 60.0)
+        self.assertAlmostEqual(float(calculate_eqd2(30, 10, 3)), 36.0)
+        self.assertAlmostEqual(float(calculate_eqd2(60, 30, 2)), 60.0)
+        
+        per_course, total = cumulative_dose([(20, 5), (30, 10)], [2, 3], "EQD2")
+        self.assertEqual(per_course.shape, (2, 2))
+        self.assertAlmostEqual(total[0], 30.0 + 37.5)
+        
+        grid = sensitivity_grid([20, 30, 40], [1, 5, 10, 15], [2, 3, 10], "BED")
+        self.assertEqual(grid.shape, (3, 3, 4))
+        self.assertAlmostEqual(grid[1, 1, 2], float(calculate_bed(30, 10, 3)))
+    
+    def test_constraint_translation_to_other_fraction_counts(self):
+        """Converted limits keep the BED of the stored constraint; volume limits are unchanged."""
+        # 18 Gy in 3 fractions (α/β 2) has BED 72 Gy, matched by 22.29 Gy in 5 fractions
+        converted = float(isoeffective_dose(18, 5, 2, reference_fractions=3))
+        self.assertAlmostEqual(float(calculate_bed(converted, 5, 2)), 72.0)
+        self.assertAlmostEqual(float(isoeffective_dose(50, 25, 3)), 50.0)
+        
+        cord = translate_constraint("lung", "Spinal Cord", "sbrt", 5)
+        self.assertEqual(cord, [{"metric": "max", "param": None, "limit": 22.3, "unit": "Gy"}])
+        self.assertEqual(translate_constraint("lung", "Spinal Cord", "sbrt", 3)[0]["limit"], 18.0)
+        
+        lungs = translate_constraint("thorax", "Lungs", "conventional", 15)
+        self.assertEqual(lungs[0]["limit"], 30.0)
+        self.assertGreater(lungs[0]["param"], 20.0)
+        self.assertIsNone(translate_constraint("thorax", "Pancreas", "conventional", 15))
+    
+    def test_recovery_fractions_per_structure_and_course(self):
+        """Recovery is interpolated per organ model and elapsed time."""
+        models = load_recovery_models()
+        recovery = recovery_fractions(["Spinal cord", "Heart"], [3, 9, 60], models)
+        self.assertEqual(recovery.shape, (2, 3))
+        np.testing.assert_allclose(recovery[0], [0.0, 0.325, 0.5])
+        np.testing.assert_allclose(recovery[1], [0.0, 0.0, 0.0])
+    
+    def test_composite_eqd2_uses_structure_alpha_beta(self):
+        """Voxel-wise composites match per-voxel EQD2 sums, chunk by chunk."""
+        rng = np.random.default_rng(0)
+        grids = [rng.uniform(0, 30, (7, 4, 5)).astype(np.float32) for _ in range(2)]
+        cord = np.zeros((7, 4, 5), dtype=bool)
+        cord[2:5, 1:3, 1:4] = True
+        
+        labels, lookup = build_alpha_beta_labels({"Spinal cord": cord})
+        composite = composite_eqd2(grids, [5, 10], lookup, labels, chunk_slices=3)
+        
+        alpha_beta = np.where(cord, 2.0, 3.0)
+        expected = calculate_eqd2(grids[0], 5, alpha_beta) + calculate_eqd2(grids[1], 10, alpha_beta)
+        np.testing.assert_allclose(composite, expected, rtol=1e-5)
+        
+        summary = summarize_composite(composite, {"Spinal cord": cord}, chunk_slices=2)
+        self.assertAlmostEqual(summary["structures"]["Spinal cord"]["max"], float(expected[cord].max()), places=3)
+        self.assertAlmostEqual(summary["max"], float(expected.max()), places=3)
+    
+    def test_prior_dose_write_up_fills_cumulative_dose(self):
+        """Critical structures get cumulative values instead of placeholders."""
+        module = PriorDoseModule(MagicMock())
+        module_data = {
+            "current_site": "spine", "current_dose": 30.0, "current_fractions": 10,
+            "current_month": "March", "current_year": 2026,
+            "prior_treatments": [{"site": "spine", "dose": 20.0, "fractions": 5, "month": "March", "year": 2020}],
+            "has_overlap": "Yes", "dose_calc_method": "EQD2 (Equivalent Dose in 2 Gy fractions)",
+            "critical_structures": ["Spinal cord", "Esophagus"],
+        }
+        write_up = module.generate_write_up({"physician": "Smith", "physicist": "Brown"}, module_data)
+        self.assertNotIn("XXXX", write_up)
+        self.assertIn("Spinal cord which received a cumulative EQD2 of up to 67.5 Gy (α/β = 2 Gy)", write_up)
+        self.assertIn("Esophagus which received a cumulative EQD2 of up to 64.0 Gy (α/β = 3 Gy)\n", write_up)
+        
+        # Six years after the prior course the cord model credits 50% recovery
+        self.assertIn("or 52.5 Gy after discounting prior courses for tissue recovery", write_up)
+        self.assertIn("deemed acceptable", write_up)
+    
+    def test_prior_dose_write_up_lists_failed_composite_constraints(self):
+        """Failed composite constraint checks replace the acceptability statement."""
+        module = PriorDoseModule(MagicMock())
+        module_data = {
+            "current_site": "spine", "current_dose": 30.0, "current_fractions": 10,
+            "prior_treatments": [{"site": "spine", "dose": 20.0, "fractions": 5, "month": "March", "year": 2020}],
+            "has_overlap": "Yes", "dose_calc_method": "EQD2 (Equivalent Dose in 2 Gy fractions)",
+            "composite_summary": {"courses": 2, "default_alpha_beta": 3.0, "max": 61.2, "structures": {}, "constraints": [
+                {"Organ": "Spinal Cord", "Metric": "D0.03cc", "Limit": 50.0, "Value": 55.4, "Unit": "Gy", "Passed": False},
+                {"Organ": "Esophagus", "Metric": "Dmean", "Limit": 34.0, "Value": 12.1, "Unit": "Gy", "Passed": True},
+            ]},
+        }
+        write_up = module.generate_write_up({"physician": "Smith", "physicist": "Brown"}, module_data)
+        self.assertNotIn("deemed acceptable", write_up)
+        self.assertIn("- Spinal Cord D0.03cc of 55.4 Gy (limit 50 Gy)", write_up)
+        self.assertNotIn("Esophagus Dmean", write_up)
+
+
+class TestDVHUtils(unittest.TestCase):
+    """Test cases for the histogram-based DVH engine."""
+    
+    def test_dvh_metrics_on_linear_dose(self):
+        """Metrics match analytic values for a dose that rises linearly along one axis."""
+        # 100 slices of 1 cc voxels, slice k receives k * 0.5 Gy
+        dose = np.repeat(np.arange(100) * 0.5, 4).reshape(100, 2, 2)
+        whole = np.ones(dose.shape, dtype=bool)
+        half = np.zeros(dose.shape)
+        half[50:] = 0.5  # fractional mask over the upper half
+        
+        dvhs = compute_dvhs(dose, {"Whole": whole, "Half": half}, voxel_volume_cc=1.0, chunk_slices=7)
+        
+        self.assertAlmostEqual(dvhs["Whole"].volume_cc, 400.0)
+        self.assertAlmostEqual(dvhs["Whole"].max_dose, 49.5)
+        self.assertAlmostEqual(dvhs["Whole"].mean_dose, 24.75)
+        self.assertAlmostEqual(float(dvhs["Whole"].volume_at_dose(25.0)), 50.0)
+        self.assertAlmostEqual(float(dvhs["Whole"].dose_at_percent(50)), 25.0, delta=0.5)
+        self.assertAlmostEqual(float(dvhs["Whole"].dose_at_volume(0.03)), 49.5, places=2)
+        
+        self.assertAlmostEqual(dvhs["Half"].volume_cc, 100.0)
+        self.assertAlmostEqual(dvhs["Half"].mean_dose, 37.25)
+        self.assertAlmostEqual(dvhs["Half"].min_dose, 25.0)
+
+
+class TestConstraintUtils(unittest.TestCase):
+    """Test cases for the structured dose-constraint library."""
+    
+    def test_evaluate_dvhs_against_site_constraints(self):
+        """Every rule for the supplied structures is evaluated with its value and margin."""
+        # Slice k receives k * 0.5 Gy; cord gets the upper slices, lungs the lower ones
+        dose = np.repeat(np.arange(100) * 0.5, 4).reshape(100, 2, 2)
+        cord = np.zeros(dose.shape, dtype=bool)
+        cord[90:] = True
+        lungs = np.zeros(dose.shape, dtype=bool)
+        lungs[:60] = True
+        dvhs = compute_dvhs(dose, {"SPINAL CORD": cord, "Lungs": lungs, "Shoulder": lungs}, voxel_volume_cc=1.0)
+        
+        results = get_constraint_library().evaluate(dvhs, "Thorax", "conventional").set_index("Metric")
+        
+        self.assertEqual(list(results["Organ"]), ["Spinal Cord", "Lungs", "Lungs"])
+        self.assertAlmostEqual(results.loc["D0.03cc", "Value"], 49.5, places=1)
+        self.assertAlmostEqual(results.loc["D0.03cc", "Margin"], 0.5, places=1)
+        self.assertAlmostEqual(results.loc["V20Gy", "Value"], 100 * 20 / 60, places=1)
+        self.assertFalse(results.loc["V20Gy", "Passed"])
+        self.assertTrue(results.loc["Dmean", "Passed"])
+    
+    def test_critical_volume_constraint(self):
+        """Liver V15 < 700 cc is a critical volume: at least 700 cc must stay under 15 Gy."""
+        library = get_constraint_library()
+        for total, hot, passed in ((2000, 1000, True), (1000, 400, False)):
+            dose = np.full((total, 1, 1), 10.0)
+            dose[:hot] = 20.0
+            dvhs = compute_dvhs(dose, {"Liver (normal)": np.ones(dose.shape, dtype=bool)}, voxel_volume_cc=1.0)
+            result = library.evaluate(dvhs, "liver", "sbrt").iloc[0]
+            self.assertEqual(result["Metric"], "CV15Gy")
+            self.assertAlmostEqual(result["Value"], total - hot)
+            self.assertEqual(bool(result["Passed"]), passed)
+            self.assertAlmostEqual(result["Margin"], total - hot - 700)
+        self.assertEqual(describe_rules(library.get_constraint("liver", "Liver (normal)", "sbrt")["rules"]),
+                         "CV15Gy ≥ 700 cc")
+        
+        # A bare oligometastasis site has no constraints, as before; a location gets the generic ones
+        sbrt = SBRTModule(MagicMock())
+        self.assertEqual(sbrt._get_dose_constraints("oligometastasis"), {})
+        self.assertEqual(list(sbrt._get_dose_constraints("oligometastatic adrenal")),
+                         ["Spinal Cord", "Small Bowel", "Kidney", "Liver"])
+        self.assertIn("Liver (normal)", sbrt._get_dose_constraints("oligometastatic liver"))
+    
+    def test_legacy_lookups(self):
+        """Organ-level limits keep the shape the validation rules always returned."""
+        self.assertEqual(
+            get_constraint_library().get_organ_limits("Spinal Cord", "srs"), {"max": 14, "unit": "Gy"}
+        )
+        self.assertIsNone(get_constraint_library().get_organ_limits("cochlea", "sbrt"))
+
+
+class TestCIEDUtils(unittest.TestCase):
+    """Test cases for batch TG-203 risk stratification."""
+    
+    def test_batch_matches_per_patient_assessment(self):
+        """Every input combination gets the same category and risk as the single-patient path."""
+        distances = ["More than 10 cm from treatment field edge", "Within 3 cm of field edge", "CIED in direct beam"]
+        cases = [
+            (pacing, neutron, dose, distance)
+            for pacing in ("Yes", "No", "Unknown")
+            for neutron in ("Yes", "No")
+            for dose in (0.0, 1.99, 2.0, 5.0, 5.01)
+            for distance in distances
+        ]
+        results = stratify_devices(*[[case[i] for case in cases] for i in range(4)])
+        
+        estimates = {distances[0]: 0.5, distances[1]: 3.0, distances[2]: 7.0}
+        for (pacing, neutron, dose, distance), row in zip(cases, results.itertuples(index=False)):
+            max_dose = dose or estimates[distance]
+            category = DOSE_CATEGORIES[0 if max_dose < 2 else 1 if max_dose <= 5 else 2]
+            self.assertEqual(row[0], max_dose)
+            self.assertEqual(row[1], category)
+            self.assertEqual(row[2], calculate_risk_level(pacing == "Yes", category, neutron == "Yes"))
+        
+        # Lowering the upper threshold moves 5 Gy devices into the top category
+        restratified = stratify_devices(["Yes"], ["No"], [5.0], [distances[0]], edges=(2.0, 4.0))
+        self.assertEqual(restratified["Risk Level"].tolist(), ["High"])
+
+    
+    def test_peripheral_dose_over_position_grid(self):
+        """Table points are reproduced exactly and a position grid is evaluated in one call."""
+        table = get_peripheral_dose_table()
+        self.assertAlmostEqual(float(table.percent_of_dmax("6 MV", 3.0, 10.0)), 4.2)
+        # Log-linear between distances, clamped beyond the table
+        between = float(table.percent_of_dmax("6 MV", 2.5, 10.0))
+        self.assertAlmostEqual(between, np.sqrt(6.5 * 4.2))
+        self.assertAlmostEqual(float(table.percent_of_dmax("6 MV", 60.0, 10.0)), 0.2)
+        
+        x, y, distances = device_position_grid(10.0, 3.0, 1.0, steps=5)
+        self.assertEqual(distances.shape, (5, 5))
+        np.testing.assert_allclose(distances[2], [2.0, 2.5, 3.0, 3.5, 4.0])
+        doses = table.device_dose("6 MV", distances, 10.0, 7500)
+        self.assertAlmostEqual(float(doses[2, 2]), 0.042 * 75)
+        np.testing.assert_allclose(dose_category_margin([1.5, 5.0, 6.0]), [0.5, 0.0, np.nan])
+
+    
+    def test_measurement_log_streams_cumulative_dose_and_alerts(self):
+        """Incremental totals match a full recomputation and thresholds are flagged once, when reached."""
+        log = MeasurementLog(10, "OSLD (nanoDot)", calibration=1e-5)
+        readings = [[30000, 32000], [31000], [60000, 64000], [90000]]
+        alerts = []
+        for fraction, values in enumerate(readings, start=1):
+            alerts.append(log.add_fraction(fraction, values, hours=1.0))
+        
+        fraction_doses = [corrected_dose(values, 1.0, "OSLD (nanoDot)", 1e-5).mean() for values in readings]
+        self.assertAlmostEqual(log.cumulative_dose, sum(fraction_doses))
+        self.assertAlmostEqual(log.projected_dose, sum(fraction_doses) / 4 * 10)
+        self.assertAlmostEqual(log.fraction_dose_sd, float(np.std(fraction_doses, ddof=1)))
+        
+        # The projection passes 2 Gy at fraction 1; the hotter readings push it past 5 Gy
+        # and the measured total past 2 Gy at fraction 4
+        self.assertEqual([(a["kind"], a["threshold"]) for a in alerts[0]], [("projected", 2.0)])
+        self.assertEqual(alerts[1] + alerts[2], [])
+        self.assertEqual([(a["kind"], a["threshold"]) for a in alerts[3]], [("projected", 5.0), ("measured", 2.0)])
+        
+        with self.assertRaises(ValueError):
+            log.add_fraction(2, [30000], hours=1.0)
+    
+    def test_write_up_reports_estimated_device_dose(self):
+        """Without a TPS dose the note cites the estimate, and the 2 Gy statement follows the dose."""
+        module = PacemakerModule(MagicMock())
+        module_data = {"device_vendor": "Medtronic", "pacing_dependent": "No", "risk_level": "Medium",
+                       "fractions": 25, "tps_max_dose": 0.0, "tps_mean_dose": 0.0,
+                       "estimated_max_dose": 3.0, "estimated_dose_source": "field_distance"}
+        write_up = module.generate_write_up({"physician": "Smith", "physicist": "Brown"}, module_data)
+        self.assertIn("estimated at 3 Gy from its distance to the treatment field edge", write_up)
+        self.assertIn("exceeds the AAPM recommended total dose of 2 Gy", write_up)
+        self.assertNotIn("was 0.0 Gy", write_up)
+        
+        module_data.update(tps_max_dose=0.4, tps_mean_dose=0.1, estimated_max_dose=0.4, estimated_dose_source="tps")
+        write_up = module.generate_write_up({"physician": "Smith", "physicist": "Brown"}, module_data)
+        self.assertIn("The maximum dose to the device was 0.4 Gy, with a mean dose of 0.1 Gy, which is well below", write_up)
+
+
+
+class TestRespiratoryUtils(unittest.TestCase):
+    """Test cases for breath-hold detection in respiratory traces."""
+    
+    def _trace_csv(self):
+        """Two sessions of 20 s free breathing followed by a drifting 15 s breath hold, three times."""
+        rng = np.random.default_rng(0)
+        rows = ["fraction,time,amplitude"]
+        for session in (1, 2):
+            t = 0.0
+            for hold in range(3):
+                breathing = np.arange(0, 20, 0.04)
+                rows += [f"{session},{t + x:.2f},{5 * np.sin(np.pi * x / 4) ** 2 + rng.normal(0, 0.1):.3f}"
+                         for x in breathing]
+                t += 20
+                holding = np.arange(0, 15, 0.04)
+                level = 12 + 0.5 * session
+                rows += [f"{session},{t + x:.2f},{level + 0.05 * x + rng.normal(0, 0.1):.3f}" for x in holding]
+                t += 15
+        return "\n".join(rows)
+    
+    def test_streamed_detection_matches_whole_trace(self):
+        """Small chunks find the same breath holds as reading the trace at once."""
+        trace = self._trace_csv()
+        holds = detect_breath_holds(io.StringIO(trace))
+        streamed = detect_breath_holds(io.StringIO(trace), chunk_size=97)
+        pd.testing.assert_frame_equal(holds, streamed)
+        
+        self.assertEqual(holds["Session"].tolist(), ["1"] * 3 + ["2"] * 3)
+        self.assertTrue(((holds["Duration (s)"] > 13) & (holds["Duration (s)"] <= 15)).all())
+        np.testing.assert_allclose(holds["Drift (mm)"], 0.05 * holds["Duration (s)"], atol=0.15)
+        
+        sessions, summary = summarize_breath_holds(holds)
+        self.assertEqual(summary["breath_holds"], 6)
+        self.assertEqual(sessions["Breath Holds"].tolist(), [3, 3])
+        self.assertAlmostEqual(summary["inter_session_sd"], 0.5 / np.sqrt(2), places=1)
+        self.assertEqual(summary["within_tolerance"], 100.0)
+
+
+def _sbrt_motion_script():
+    """Streamlit script that renders the SBRT form and keeps its data."""
+    import streamlit as st
+    from modules.sbrt import SBRTModule
+    from modules.templates import ConfigManager
+
+    st.session_state.sbrt_data = SBRTModule(ConfigManager()).render_specialized_fields("A", "B", 60, "male", "")
+
+
+class TestMotionUtils(unittest.TestCase):
+    """Test cases for the 4DCT ITV builder."""
+    
+    def test_itv_and_motion_from_memory_mapped_phases(self):
+        """A sphere moving 6 mm superior-inferiorly gives the union ITV and its peak-to-peak motion."""
+        grid = np.indices((40, 50, 50))
+        shifts = [0, 1, 2, 3, 2, 1]
+        phases = np.stack([
+            (grid[0] - 15 - shift) ** 2 + (grid[1] - 25) ** 2 + (grid[2] - 25) ** 2 <= 25 for shift in shifts
+        ])
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "phases.npy")
+            np.save(path, phases)
+            result = build_itv(iter_phase_masks([path]), (2.0, 1.0, 1.0))
+        
+        np.testing.assert_array_equal(result["itv"], phases.any(axis=0))
+        np.testing.assert_allclose(result["motion"], [6.0, 0.0, 0.0])
+        self.assertAlmostEqual(result["itv_volume"], phases.any(axis=0).sum() * 0.002)
+        
+        summary = summarize_motion(result)
+        self.assertEqual(summary["phases"], 6)
+        self.assertEqual(summary["motion"], {"SI": 6.0, "AP": 0.0, "LR": 0.0})
+        self.assertGreater(summary["itv_gtv_ratio"], 1.0)
+    
+    def test_sbrt_motion_text_describes_one_itv_method(self):
+        """An ITV built from phase GTVs replaces the MIP sentence instead of following it."""
+        at = AppTest.from_function(_sbrt_motion_script, default_timeout=30)
+        for key, value in {"sbrt_site": "lung", "sbrt_dose": 50.0, "sbrt_fractions": 5,
+                           "sbrt_target_volume": 12.0, "sbrt_4dct": "Yes"}.items():
+            at.session_state[key] = value
+        at.run()
+        self.assertIn("Maximum Intensity Projection", at.session_state["sbrt_data"]["motion_text"])
+        self.assertEqual(set(at.session_state["sbrt_data"]["conformity_grades"]), {"pitv", "r50"})
+        
+        at.session_state["sbrt_motion_stats"] = {"phases": 10, "motion": {"SI": 8.1, "AP": 3.0, "LR": 1.2},
+                                                 "itv_volume": 14.2, "itv_gtv_ratio": 1.8, "motion_3d": 8.7}
+        at.run()
+        motion_text = at.session_state["sbrt_data"]["motion_text"]
+        self.assertNotIn("Maximum Intensity Projection", motion_text)
+        self.assertIn("contoured on all 10 respiratory phases", motion_text)
+
+
+class TestRegistrationUtils(unittest.TestCase):
+    """Test cases for rigid-registration QA metrics."""
+    
+    def test_correct_transform_scores_best(self):
+        """The true shift beats the identity on NCC and MI, and maps landmarks exactly."""
+        z, y, x = np.ogrid[:40, :64, :64]
+        primary = (100.0 * (((y - 32) / 20) ** 2 + ((x - 30) / 24) ** 2 < 1)
+                   + 50.0 * ((z - 20) ** 2 + (y - 28) ** 2 + (x - 36) ** 2 < 64))
+        # The secondary sees the same anatomy shifted by (2, 3, -4) voxels of 1 mm
+        secondary = np.roll(primary, (2, 3, -4), axis=(0, 1, 2))
+        shift = rigid_transform(translation_mm=(2.0, 3.0, -4.0))
+        
+        aligned = registration_metrics(primary, secondary, shift, (1.0, 1.0, 1.0), (1.0, 1.0, 1.0), levels=(4, 2))
+        identity = registration_metrics(primary, secondary, np.eye(4), (1.0, 1.0, 1.0), (1.0, 1.0, 1.0), levels=(4, 2))
+        self.assertEqual([level["factor"] for level in aligned["levels"]], [4, 2])
+        self.assertGreater(aligned["ncc"], 0.99)
+        self.assertGreater(aligned["ncc"], identity["ncc"])
+        self.assertGreater(aligned["mutual_information"], identity["mutual_information"])
+        
+        # A coarse sampling cap stops before the finer level
+        capped = registration_metrics(primary, secondary, shift, (1.0, 1.0, 1.0), (1.0, 1.0, 1.0),
+                                      levels=(4, 2), max_samples=5000)
+        self.assertEqual(capped["factor"], 4)
+        
+        errors = landmark_errors([[10, 20, 30], [5, 5, 5]], [[12, 23, 26], [7, 8, 2]], shift)
+        np.testing.assert_allclose(errors, [0.0, 1.0])
+    
+    def test_dvf_statistics_in_slabs_match_whole_field(self):
+        """Slab-wise Jacobians equal the whole-field computation, and a compressing field folds."""
+        z, y, x = np.meshgrid(np.arange(30), np.arange(40), np.arange(36), indexing="ij")
+        dvf = np.stack([2 * np.sin(y / 10), 1.5 * np.cos(z / 8), 0.05 * (x - 18)], axis=0)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "dvf.npy")
+            np.save(path, dvf)
+            field = load_dvf(path)
+            stats = analyze_dvf(field, (2.5, 1.0, 1.0), chunk_slices=7)
+            whole = jacobian_determinant(np.asarray(field), (2.5, 1.0, 1.0))
+        
+        self.assertEqual(stats["voxels"], whole.size)
+        self.assertAlmostEqual(stats["jacobian_min"], whole.min())
+        self.assertAlmostEqual(stats["jacobian_mean"], whole.mean())
+        self.assertEqual(stats["folding_percent"], 0.0)
+        magnitude = np.linalg.norm(np.moveaxis(dvf, 0, -1), axis=-1)
+        self.assertAlmostEqual(stats["magnitude_p95"], np.percentile(magnitude, 95), delta=0.02)
+        
+        # Displacing x by -1.5x maps it to -0.5x, reversing orientation everywhere
+        dvf[2] = -1.5 * (x - 18)
+        self.assertEqual(analyze_dvf(np.moveaxis(dvf, 0, -1), (2.5, 1.0, 1.0))["folding_percent"], 100.0)
+    
+    def test_dvf_outliers_and_nan_voxels(self):
+        """A huge outlier lands in the overflow bin and NaN voxels are counted, not analyzed."""
+        dvf = np.zeros((20, 30, 30, 3))
+        dvf[..., 0] = 1.0
+        dvf[10, 15, 15] = [1e5, 0.0, 0.0]
+        dvf[2, 2, 2] = np.nan
+        stats = analyze_dvf(dvf, (2.5, 1.0, 1.0))
+        
+        # The NaN voxel and its six neighbours have no finite Jacobian
+        self.assertEqual(stats["nonfinite_voxels"], 7)
+        self.assertEqual(stats["voxels"], dvf[..., 0].size - 7)
+        self.assertEqual(stats["magnitude_max"], 1e5)
+        self.assertAlmostEqual(stats["magnitude_p99"], 1.0, delta=0.02)
+        self.assertLess(stats["jacobian_min"], 0.0)
+        self.assertAlmostEqual(stats["jacobian_p1"], 1.0, delta=0.002)
+
+
+@unittest.skipIf(dicom_utils.pydicom is None, "pydicom is not installed")
+class TestDicomUtils(unittest.TestCase):
+    """Test cases for DICOM directory indexing and lazy pixel access."""
+    
+    def _write(self, path, pixels=None, **attributes):
+        import pydicom
+        dataset = pydicom.Dataset()
+        dataset.file_meta = pydicom.dataset.FileMetaDataset()
+        dataset.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        dataset.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.2"
+        dataset.SOPInstanceUID = dataset.file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+        for name, value in attributes.items():
+            setattr(dataset, name, value)
+        if pixels is not None:
+            dataset.Rows, dataset.Columns = pixels.shape[-2:]
+            dataset.SamplesPerPixel, dataset.PhotometricInterpretation = 1, "MONOCHROME2"
+            dataset.BitsAllocated = dataset.BitsStored = pixels.dtype.itemsize * 8
+            dataset.HighBit = dataset.BitsAllocated - 1
+            dataset.PixelRepresentation = int(pixels.dtype.kind == "i")
+            if pixels.ndim == 3:
+                dataset.NumberOfFrames = pixels.shape[0]
+            dataset.PixelData = pixels.tobytes()
+        dataset.save_as(path, enforce_file_format=True)
+    
+    def test_index_and_memory_mapped_volumes(self):
+        """Series are grouped from headers, slices ordered by position, and rescans reuse the cache."""
+        ct = np.random.default_rng(3).integers(-1000, 2000, (4, 6, 5)).astype(np.int16)
+        dose = np.arange(2 * 6 * 5, dtype=np.uint32).reshape(2, 6, 5)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            export_dir = os.path.join(temp_dir, "export")
+            os.makedirs(os.path.join(export_dir, "CT"))
+            for i in (2, 0, 3, 1):
+                self._write(os.path.join(export_dir, "CT", f"slice{i}.dcm"), ct[i], PatientID="P1", Modality="CT",
+                            StudyInstanceUID="1.2.3", SeriesInstanceUID="1.2.3.1", SeriesNumber=1,
+                            ImagePositionPatient=[0, 0, 10 - 3 * i], ImageOrientationPatient=[1, 0, 0, 0, 1, 0],
+                            PixelSpacing=[0.9, 0.8], RescaleSlope=1, RescaleIntercept=-1024)
+            self._write(os.path.join(export_dir, "dose.dcm"), dose, PatientID="P1", Modality="RTDOSE",
+                        StudyInstanceUID="1.2.3", SeriesInstanceUID="1.2.3.2", SeriesNumber=2,
+                        GridFrameOffsetVector=[0, 2.5], PixelSpacing=[2, 2], DoseGridScaling=0.01)
+            with open(os.path.join(export_dir, "notes.txt"), "w") as f:
+                f.write("not DICOM")
+            
+            cache_dir = os.path.join(temp_dir, "cache")
+            with patch("dicom_utils.INDEX_CACHE_DIR", cache_dir):
+                index = index_directory(export_dir)
+            # The index holds patient identifiers, so it stays out of the export
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            self.assertEqual(sorted(os.listdir(export_dir)), ["CT", "dose.dcm", "notes.txt"])
+            series = summarize_series(index)
+            self.assertEqual(series["Files"].tolist(), [4, 1])
+            
+            volume = open_series(index, "1.2.3.1")
+            self.assertEqual(volume.spacing_mm, (3.0, 0.9, 0.8))
+            np.testing.assert_array_equal(volume.to_array(), ct[::-1] - 1024.0)
+            np.testing.assert_allclose(open_series(index, "1.2.3.2")[1], dose[1] * 0.01, rtol=1e-6)
+            
+            # A new in-memory cache reloads the disk index without reading any header
+            dicom_utils._build_index.cache_clear()
+            with patch("dicom_utils.INDEX_CACHE_DIR", cache_dir), patch("dicom_utils.read_header") as read_header:
+                self.assertEqual(len(index_directory(export_dir)), 5)
+            read_header.assert_not_called()
+    
+    def test_dose_grid_is_converted_outside_the_export_folder(self):
+        """An RT Dose is converted to Gy in the cache directory, never beside the DICOM file."""
+        dose = np.arange(2 * 6 * 5, dtype=np.uint32).reshape(2, 6, 5)
+        with tempfile.TemporaryDirectory() as export_dir, tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(export_dir, "dose.dcm")
+            self._write(path, dose, PatientID="P1", Modality="RTDOSE", GridFrameOffsetVector=[0, 2.5],
+                        PixelSpacing=[2, 2], DoseGridScaling=0.01)
+            grid = load_dose_grid(path, cache_dir=cache_dir)
+            np.testing.assert_allclose(grid, dose * 0.01, rtol=1e-6)
+            self.assertEqual(os.listdir(export_dir), ["dose.dcm"])
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            del grid
+
+
+
+class TestStructureUtils(unittest.TestCase):
+    """Test cases for contour rasterization and the mask cache."""
+    
+    def test_partial_volume_fractions_and_holes(self):
+        """Boundary voxels get their covered fraction and an inner contour is cut out."""
+        square = np.array([[0.25, 0.25, 0.0], [2.75, 0.25, 0.0], [2.75, 1.5, 0.0], [0.25, 1.5, 0.0]])
+        mask = rasterize_contours([square], (0.0, 0.0, 0.0), (1.0, 1.0, 1.0), (1, 3, 4))
+        np.testing.assert_allclose(mask[0], [[0.0625, 0.25, 0.25, 0.0625],
+                                             [0.25, 1.0, 1.0, 0.25],
+                                             [0.0, 0.0, 0.0, 0.0]])
+        
+        angles = np.linspace(0, 2 * np.pi, 360, endpoint=False)
+        def circle(radius, z):
+            return np.column_stack([radius * np.cos(angles), radius * np.sin(angles), np.full(angles.size, z)])
+        contours = [circle(10.0, z) for z in (-2.0, 0.0, 2.0)] + [circle(4.0, 0.0)]
+        mask = rasterize_contours(contours, (-15.0, -15.0, -4.0), (2.0, 1.0, 1.0), (5, 31, 31))
+        areas = mask.sum(axis=(1, 2))
+        # Slices at -4 and 4 mm are more than half a contour spacing beyond the last contours
+        self.assertEqual(areas[0], 0.0)
+        self.assertEqual(areas[4], 0.0)
+        self.assertAlmostEqual(areas[1], np.pi * 100, delta=0.5)
+        self.assertAlmostEqual(areas[2], np.pi * (100 - 16), delta=0.5)
+    
+    def test_flipped_grids_mirror_the_mask(self):
+        """Prone and feet-first grids and descending slices give mirrored masks; oblique grids are refused."""
+        angles = np.linspace(0, 2 * np.pi, 50, endpoint=False)
+        contours = [np.column_stack([5 + 8 * np.cos(angles), -4 + 6 * np.sin(angles), np.full(angles.size, z)])
+                    for z in (-4.0, -2.0, 0.0, 2.0)]
+        mask = rasterize_contours(contours, (-16.0, -16.0, -7.0), (2.0, 1.0, 1.0), (8, 32, 32))
+        # Head-first prone with slices running from +7 mm down to -7 mm
+        prone = rasterize_contours(contours, (15.0, 15.0, 7.0), (-2.0, 1.0, 1.0), (8, 32, 32),
+                                   orientation=(-1, 0, 0, 0, -1, 0))
+        np.testing.assert_array_equal(prone, mask[::-1, ::-1, ::-1])
+        # Feet-first supine: the slice normal points towards the feet
+        feet_first = rasterize_contours(contours, (15.0, -16.0, 7.0), (2.0, 1.0, 1.0), (8, 32, 32),
+                                        orientation=(-1, 0, 0, 0, 1, 0))
+        np.testing.assert_array_equal(feet_first, mask[::-1, :, ::-1])
+        with self.assertRaises(ValueError):
+            rasterize_contours(contours, (0.0, 0.0, 0.0), (2.0, 1.0, 1.0), (8, 32, 32), orientation=(1, 0, 0, 0, 0, -1))
+    
+    def test_uneven_contour_spacing_leaves_no_gaps(self):
+        """Every slice between the first and last contour is filled, whatever the plane spacing."""
+        square = np.array([[2.5, 2.5], [22.5, 2.5], [22.5, 22.5], [2.5, 22.5]])
+        def planes(z_values):
+            return [np.column_stack([square, np.full(4, z)]) for z in z_values]
+        grid = ((0.0, 0.0, 0.0), (2.5, 1.0, 1.0), (16, 25, 25))
+        
+        # 3 mm planes with a 1 mm run at the top, and a near-duplicate plane
+        for z_values in (list(np.arange(0.0, 30.1, 3.0)) + [31.0, 32.0, 33.0], [0.0, 0.1, 3.0, 6.0, 9.0]):
+            areas = rasterize_contours(planes(z_values), *grid).sum(axis=(1, 2))
+            inside = np.arange(16) * 2.5 <= max(z_values) + 1.0
+            np.testing.assert_allclose(areas[inside], 400.0)
+            np.testing.assert_allclose(areas[~inside], 0.0)
+    
+    @unittest.skipIf(structure_utils.pydicom is None, "pydicom is not installed")
+    def test_structure_set_masks_are_cached(self):
+        """Structures are read from an RTSTRUCT and rasterized once per grid."""
+        import pydicom
+        dataset = pydicom.Dataset()
+        dataset.file_meta = pydicom.dataset.FileMetaDataset()
+        dataset.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        dataset.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.481.3"
+        dataset.SOPInstanceUID = dataset.file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+        dataset.Modality = "RTSTRUCT"
+        roi = pydicom.Dataset()
+        roi.ROINumber, roi.ROIName = 7, "PTV"
+        dataset.StructureSetROISequence = [roi]
+        contours = []
+        for z in (0.0, 3.0):
+            contour = pydicom.Dataset()
+            contour.ContourGeometricType = "CLOSED_PLANAR"
+            contour.ContourData = [2.5, 2.5, z, 7.5, 2.5, z, 7.5, 6.5, z, 2.5, 6.5, z]
+            contours.append(contour)
+        roi_contour = pydicom.Dataset()
+        roi_contour.ReferencedROINumber, roi_contour.ContourSequence = 7, contours
+        dataset.ROIContourSequence = [roi_contour]
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "RS.dcm")
+            dataset.save_as(path, enforce_file_format=True)
+            grid = ((0.0, 0.0, 0.0), (3.0, 1.0, 1.0), (3, 10, 10))
+            masks = rasterize_structure_set(path, *grid, cache_dir=temp_dir)
+            self.assertEqual(list(masks), ["PTV"])
+            np.testing.assert_allclose(masks["PTV"].sum(axis=(1, 2)), [20.0, 20.0, 0.0], atol=1e-3)
+            
+            with patch("structure_utils.rasterize_contours") as rasterize:
+                cached = rasterize_structure_set(path, *grid, cache_dir=temp_dir)
+            rasterize.assert_not_called()
+            np.testing.assert_array_equal(cached["PTV"], masks["PTV"])
+
+class TestPrefillUtils(unittest.TestCase):
+    """Test cases for prefilling write-up forms from a treatment plan."""
+    
+    def test_prefill_module_data(self):
+        """The plan's prescription and targets map onto SBRT, SRS and Prior Dose."""
+        plan = {"prescription_dose": 27.0, "fractions": 3, "targets": [
+            {"name": "PTV_1", "dose": 27.0, "volume_cc": 4.8},
+            {"name": "PTV_2", "dose": 24.0, "volume_cc": 1.9},
+        ]}
+        prefill = prefill_module_data(plan)
+        self.assertEqual(prefill["prior_dose"], {"current_dose": 27.0, "current_fractions": 3})
+        self.assertEqual(prefill["sbrt"], {"dose": 27.0, "fractions": 3, "target_volume": 4.8})
+        self.assertEqual([lesion["volume"] for lesion in prefill["srs"]["lesions"]], [4.8, 1.9])
+        self.assertEqual(prefill_module_data({"prescription_dose": None, "fractions": None, "targets": []}), {})
+    
+    def test_fallback_targets_use_one_structure_type(self):
+        """Without target dose references, PTVs are the targets and their GTVs are not counted again."""
+        structures = {name: [] for name in ("GTV1", "PTV1", "GTV2", "PTV2", "Brainstem")}
+        grid = MagicMock(origin_mm=(0.0, 0.0, 0.0), spacing_mm=(1.0, 1.0, 1.0), shape=(10, 10, 10))
+        masks = {"PTV1": np.full((10, 10, 10), 0.5), "PTV2": np.ones((10, 10, 10))}
+        with patch("prefill_utils.read_structures", return_value=structures), \
+                patch("prefill_utils.open_dicom_file", return_value=grid), \
+                patch("prefill_utils.rasterize_structure_set", return_value=masks) as rasterize:
+            targets = prefill_utils._target_volumes([], "RS.dcm", "RD.dcm")
+        self.assertEqual(rasterize.call_args[0][4], ["PTV1", "PTV2"])
+        self.assertEqual([(target["name"], target["volume_cc"]) for target in targets], [("PTV1", 0.5), ("PTV2", 1.0)])
+    
+    @unittest.skipIf(prefill_utils.pydicom is None, "pydicom is not installed")
+    def test_extract_plan_is_cached_on_disk(self):
+        """A plan is parsed once; later sessions read the cached extraction."""
+        import pydicom
+        dataset = pydicom.Dataset()
+        dataset.file_meta = pydicom.dataset.FileMetaDataset()
+        dataset.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        dataset.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.481.5"
+        dataset.SOPInstanceUID = dataset.file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+        dataset.Modality, dataset.RTPlanLabel = "RTPLAN", "LUNG SBRT"
+        fraction_group = pydicom.Dataset()
+        fraction_group.NumberOfFractionsPlanned = 5
+        dataset.FractionGroupSequence = [fraction_group]
+        reference = pydicom.Dataset()
+        reference.DoseReferenceNumber, reference.DoseReferenceType = 1, "TARGET"
+        reference.DoseReferenceDescription, reference.TargetPrescriptionDose = "PTV", 50.0
+        dataset.DoseReferenceSequence = [reference]
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "RP.dcm")
+            dataset.save_as(path, enforce_file_format=True)
+            plan = extract_plan(path, cache_dir=temp_dir)
+            self.assertEqual((plan["label"], plan["fractions"], plan["prescription_dose"]), ("LUNG SBRT", 5, 50.0))
+            self.assertEqual(plan["targets"], [{"name": "PTV", "dose": 50.0, "volume_cc": None}])
+            
+            prefill_utils._extract_plan.cache_clear()
+            with patch("prefill_utils.read_plan") as read_plan:
+                self.assertEqual(extract_plan(path, cache_dir=temp_dir), plan)
+            read_plan.assert_not_called()
+
+class TestPlanQualityUtils(unittest.TestCase):
+    """Test cases for dose-grid plan-quality metrics."""
+    
+    def test_srs_metrics_per_lesion(self):
+        """Each lesion is scored inside its own box, unaffected by its neighbour."""
+        dose = np.zeros((30, 30, 60))
+        labels = np.zeros(dose.shape, dtype=np.uint8)
+        
+        # Lesion 1: 4x4x4 target, prescription dose over a 6x6x6 cube, 50% dose over 8x8x8
+        dose[9:17, 9:17, 9:17] = 10.0
+        dose[10:16, 10:16, 10:16] = 20.0
+        dose[12, 12, 12] = 25.0
+        labels[11:15, 11:15, 11:15] = 1
+        
+        # Lesion 2: target only partly covered
+        dose[10:14, 10:14, 40:44] = 20.0
+        labels[10:14, 10:14, 40:46] = 2
+        
+        metrics = srs_lesion_metrics(dose, labels, {1: 20.0, 2: 20.0}, spacing_mm=(1.0, 1.0, 1.0), margin_mm=5)
+        
+        self.assertAlmostEqual(metrics[1]["target_volume"], 0.064)
+        self.assertAlmostEqual(metrics[1]["coverage"], 100.0)
+        self.assertAlmostEqual(metrics[1]["rtog_ci"], 216 / 64)
+        self.assertAlmostEqual(metrics[1]["paddick_ci"], 64 / 216)
+        self.assertAlmostEqual(metrics[1]["gradient_index"], 512 / 216)
+        self.assertAlmostEqual(metrics[1]["max_dose_percent"], 125.0)
+        self.assertAlmostEqual(metrics[1]["prescription_isodose"], 80.0)
+        
+        self.assertAlmostEqual(metrics[2]["coverage"], 100.0 * 64 / 96)
+    
+    def test_srs_metrics_split_isodose_between_close_lesions(self):
+        """Lesions closer than the margin each keep only the isodose voxels nearest to them."""
+        dose = np.zeros((30, 30, 50))
+        labels = np.zeros(dose.shape, dtype=np.uint8)
+        for label, shift in ((1, 0), (2, 12)):
+            dose[9:17, 9:17, 9 + shift:17 + shift] = 10.0
+            dose[10:16, 10:16, 10 + shift:16 + shift] = 20.0
+            labels[11:15, 11:15, 11 + shift:15 + shift] = label
+        
+        metrics = srs_lesion_metrics(dose, labels, 20.0, spacing_mm=(1.0, 1.0, 1.0), margin_mm=20)
+        for label in (1, 2):
+            self.assertAlmostEqual(metrics[label]["rtog_ci"], 216 / 64)
+            self.assertAlmostEqual(metrics[label]["gradient_index"], 512 / 216)
+    
+    def test_sbrt_metrics_and_protocol_grading(self):
+        """D2cm uses true distance from the PTV and grades interpolate on PTV volume."""
+        mask = np.zeros((5, 5, 40), dtype=bool)
+        mask[2, 2, 5] = True
+        distance = distance_from_mask(mask, (1.0, 2.0, 3.0))
+        self.assertAlmostEqual(distance[2, 2, 15], 30.0)
+        self.assertAlmostEqual(distance[0, 4, 5], np.sqrt(2 ** 2 + 4 ** 2))
+        
+        # Dose falls 1 Gy per voxel (3 mm) away from the PTV along the last axis
+        dose = np.maximum(40.0 - np.abs(np.arange(40) - 5.0), 0.0) * np.ones((5, 5, 1))
+        metrics = sbrt_plan_metrics(dose, mask, prescription=40.0, spacing_mm=(1.0, 2.0, 3.0))
+        self.assertAlmostEqual(metrics["coverage"], 100.0)
+        self.assertAlmostEqual(metrics["pitv"], 25.0)
+        # The nearest voxels at least 20 mm away are 7 columns (21 mm) out
+        self.assertAlmostEqual(metrics["d2cm"], 33.0)
+        
+        tables = load_sbrt_tables()
+        grades = grade_sbrt_metrics(5.6, {"pitv": 1.3, "r50": 5.2, "d2cm": None}, tables)
+        self.assertEqual(grades["pitv"]["verdict"], "minor")
+        self.assertAlmostEqual(grades["r50"]["none"], 5.3)
+        self.assertEqual(grades["r50"]["verdict"], "none")
+        self.assertNotIn("d2cm", grades)
+        
+        # The RTOG 0813/0915 tables are for lung SBRT only
+        self.assertEqual(set(grade_sbrt_metrics(5.6, {"pitv": 1.3}, tables, "lung")), {"pitv"})
+        self.assertEqual(grade_sbrt_metrics(5.6, {"pitv": 1.3}, tables, "liver"), {})
+        
+        # The write-up reports the grades computed with the form rather than re-grading
+        sbrt = SBRTModule(MagicMock())
+        data = {"treatment_site": "lung", "dose": 50.0, "fractions": 5, "target_volume": 5.6, "pitv": 1.3, "r50": 5.2,
+                "conformity_grades": grade_sbrt_metrics(5.6, {"pitv": 1.3, "r50": 5.2}, tables, "lung")}
+        with patch("modules.sbrt.grade_sbrt_metrics") as grade:
+            write_up = sbrt.generate_write_up({"physician": "Smith", "physicist": "Brown"}, data)
+        grade.assert_not_called()
+        self.assertIn("Compared with the RTOG 0813/0915 conformality criteria for a 5.6 cc PTV, the PITV", write_up)
+        self.assertNotIn("RTOG", sbrt.generate_write_up({"physician": "Smith"}, {**data, "conformity_grades": {}}))
+
+
+class TestUploadUtils(unittest.TestCase):
+    """Test cases for saving uploaded files to disk."""
+    
+    def test_same_named_uploads_do_not_overwrite(self):
+        """Two uploads called dose.npy keep their own contents."""
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                patch("utils.get_session_upload_dir", return_value=temp_dir):
+            paths = []
+            for value in (10.0, 30.0):
+                buffer = io.BytesIO()
+                np.save(buffer, np.full((2, 2, 2), value, dtype=np.float32))
+                upload = MagicMock()
+                upload.name = "dose.npy"
+                upload.getbuffer.return_value = buffer.getbuffer()
+                paths.append(save_uploaded_file(upload))
+            
+            self.assertNotEqual(paths[0], paths[1])
+            self.assertTrue(all(path.endswith(".npy") for path in paths))
+            self.assertEqual([float(np.load(path).max()) for path in paths], [10.0, 30.0])
+    
+    def test_local_paths_are_read_in_place(self):
+        """A local path is used as-is, and missing or mistyped files are refused."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "dvf.npy")
+            np.save(path, np.zeros(3))
+            self.assertEqual(file_source_path(path, ["npy"]), path)
+            with self.assertRaises(FileNotFoundError):
+                file_source_path(os.path.join(temp_dir, "missing.npy"), ["npy"])
+            with self.assertRaises(ValueError):
+                file_source_path(path, ["dcm"])
+
+
+def _draft_checkpoint_script():
+    """Streamlit script used by the draft store tests."""
+    import os
+    import streamlit as st
+    from draft_utils import DraftStore
+
+    store = DraftStore(base_dir=os.environ["QUICKWRITE_DRAFT_DIR"])
+    store.restore()
+    st.session_state.setdefault("module_data", {})
+    if "new_dibh" in st.session_state:
+        st.session_state.module_data["dibh"] = st.session_state.new_dibh
+    store.checkpoint("dibh", "sbrt")
+
+
+class TestDraftStore(unittest.TestCase):
+    """Test cases for the QuickWrite draft checkpoint store."""
+    
+    def setUp(self):
+        """Point the draft store at a temporary directory."""
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.env_patch = patch.dict(os.environ, {"QUICKWRITE_DRAFT_DIR": self.temp_dir.name})
+        self.env_patch.start()
+    
+    def tearDown(self):
+        self.env_patch.stop()
+        self.temp_dir.cleanup()
+    
+    def test_checkpoint_only_rewrites_changed_sections(self):
+        """Unchanged sections are skipped and a new session resumes the draft."""
+        at = AppTest.from_function(_draft_checkpoint_script)
+        at.session_state["new_dibh"] = {"dose": 40.0, "fractions": 15}
+        at.run()
+        
+        draft_id = at.query_params["draft"]
+        if isinstance(draft_id, list):
+            draft_id = draft_id[0]
+        module_path = os.path.join(self.temp_dir.name, draft_id, "module_dibh.json")
+        self.assertTrue(os.path.exists(module_path))
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir.name, draft_id, "module_sbrt.json")))
+        
+        # Rerunning with the same data must not touch the file
+        os.utime(module_path, (0, 0))
+        at.run()
+        self.assertEqual(os.path.getmtime(module_path), 0)
+        
+        # A reconnecting session picks the saved data back up
+        resumed = AppTest.from_function(_draft_checkpoint_script)
+        resumed.query_params["draft"] = draft_id
+        resumed.run()
+        self.assertEqual(resumed.session_state["module_data"]["dibh"], {"dose": 40.0, "fractions": 15})
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -1,112 +1,187 @@
 import streamlit as st
+import streamlit.components.v1 as components
+import glob
+import hashlib
+import json
+import os
+import re
 
-def inject_theme_responsive_css():
-    """
-    Inject CSS that forces dark mode regardless of system theme settings.
+# Dark mode variables and Streamlit overrides shared by every page
+THEME_CSS = """
+/* Apply dark mode variables to all possible theme states */
+:root, [data-theme="light"], [data-theme="dark"], [data-theme="None"] {
+    /* Dark mode variables */
+    --background-color: #1a1a1a;
+    --text-color: #f8fafc;
+    --subtitle-color: #cbd5e1;
+    --card-background: #2d3748;
+    --card-border: #4a5568;
+    --card-shadow: rgba(0, 0, 0, 0.3);
+    --primary-color: #60a5fa;
+    --primary-color-rgb: 96, 165, 250;
+    --primary-color-hover: #93c5fd;
+    --secondary-background: #374151;
+    --secondary-background-hover: #4b5563;
+    --feature-background: #374151;
+    --feature-text: #93c5fd;
+    --feature-hover: #4b5563;
+    --feature-shadow: rgba(147, 197, 253, 0.3);
+    --button-shadow: rgba(147, 197, 253, 0.4);
+    --timeline-background: #2a4365;
+    --timeline-text: #93c5fd;
+
+    /* Success/warning/error colors */
+    --success-color: #2ecc71;
+    --warning-color: #f1c40f;
+    --error-color: #e74c3c;
+}
+
+/* Force dark styles on Streamlit elements */
+.stApp {
+    background-color: var(--background-color) !important;
+}
+
+.stMarkdown p, .stMarkdown li {
+    color: var(--text-color) !important;
+}
+
+h1, h2, h3, h4, h5, h6 {
+    color: var(--text-color) !important;
+}
+
+/* Success/info/warning/error message styling */
+[data-baseweb="message-container"] [kind="info"] {
+    background-color: var(--feature-background) !important;
+}
+
+[data-baseweb="message-container"] [kind="success"] {
+    background-color: rgba(46, 204, 113, 0.2) !important;
+}
+
+[data-baseweb="message-container"] [kind="warning"] {
+    background-color: rgba(241, 196, 15, 0.2) !important;
+}
+
+[data-baseweb="message-container"] [kind="error"] {
+    background-color: rgba(231, 76, 60, 0.2) !important;
+}
+"""
+
+# Stylesheet bundles: the theme variables are always prepended to "base"
+CSS_DIR = "assets/css"
+CSS_BUNDLES = {
+    "base": ["main.css"],
+    "landing": ["landing.css"],
+}
+
+
+def minify_css(css):
+    """Strip comments and redundant whitespace from a stylesheet."""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    return css.replace(";}", "}").strip()
+
+
+def _css_sources_signature(css_dir=CSS_DIR):
+    """Return (path, mtime) pairs for every stylesheet, used as the cache key."""
+    paths = sorted(glob.glob(os.path.join(css_dir, "*.css")))
+    return tuple((path, os.path.getmtime(path)) for path in paths)
+
+
+@st.cache_resource(show_spinner=False)
+def build_css_bundles(sources_signature=None, css_dir=CSS_DIR):
+    """Minify and concatenate the stylesheets into content-hashed bundles.
+
+    Built once per server process (and again only if a stylesheet changes
+    on disk), then shared by every session.
+
+    Args:
+        sources_signature: (path, mtime) pairs of the stylesheets, so edits
+            invalidate the cache
+        css_dir: Directory holding the stylesheets
+
+    Returns:
+        dict: Bundle name mapped to {"css": minified text, "hash": content hash}
     """
-    # Define dark mode CSS variables
-    css = """
-    <style>
-    /* Apply dark mode variables to all possible theme states */
-    :root, [data-theme="light"], [data-theme="dark"], [data-theme="None"] {
-        /* Dark mode variables */
-        --background-color: #1a1a1a;
-        --text-color: #f8fafc;
-        --subtitle-color: #cbd5e1;
-        --card-background: #2d3748;
-        --card-border: #4a5568;
-        --card-shadow: rgba(0, 0, 0, 0.3);
-        --primary-color: #60a5fa;
-        --primary-color-rgb: 96, 165, 250;
-        --primary-color-hover: #93c5fd;
-        --secondary-background: #374151;
-        --secondary-background-hover: #4b5563;
-        --feature-background: #374151;
-        --feature-text: #93c5fd;
-        --feature-hover: #4b5563;
-        --feature-shadow: rgba(147, 197, 253, 0.3);
-        --button-shadow: rgba(147, 197, 253, 0.4);
-        --timeline-background: #2a4365;
-        --timeline-text: #93c5fd;
-        
-        /* Success/warning/error colors */
-        --success-color: #2ecc71;
-        --warning-color: #f1c40f;
-        --error-color: #e74c3c;
-    }
-    
-    /* Force dark styles on Streamlit elements */
-    .stApp {
-        background-color: var(--background-color) !important;
-    }
-    
-    .stMarkdown p, .stMarkdown li {
-        color: var(--text-color) !important;
-    }
-    
-    h1, h2, h3, h4, h5, h6 {
-        color: var(--text-color) !important;
-    }
-    
-    /* Success/info/warning/error message styling */
-    [data-baseweb="message-container"] [kind="info"] {
-        background-color: var(--feature-background) !important;
-    }
-    
-    [data-baseweb="message-container"] [kind="success"] {
-        background-color: rgba(46, 204, 113, 0.2) !important;
-    }
-    
-    [data-baseweb="message-container"] [kind="warning"] {
-        background-color: rgba(241, 196, 15, 0.2) !important;
-    }
-    
-    [data-baseweb="message-container"] [kind="error"] {
-        background-color: rgba(231, 76, 60, 0.2) !important;
-    }
-    </style>
+    minified = {}
+    for path in sorted(glob.glob(os.path.join(css_dir, "*.css"))):
+        with open(path, "r") as f:
+            minified[os.path.basename(path)] = minify_css(f.read())
+
+    bundles = {}
+    for name, files in CSS_BUNDLES.items():
+        parts = [minify_css(THEME_CSS)] if name == "base" else []
+        parts.extend(minified[filename] for filename in files if filename in minified)
+        css = "".join(parts)
+        bundles[name] = {
+            "css": css,
+            "hash": hashlib.sha256(css.encode("utf-8")).hexdigest()[:12],
+        }
+    return bundles
+
+
+def apply_theme_bundles(active=("base",)):
+    """Inject the theme bundles into the page head, once per session.
+
+    The stylesheets are added to the parent document's <head> (keyed by their
+    content hash) rather than re-sent through st.markdown on every rerun, so
+    they survive reruns without being part of the script output. Nothing is
+    emitted at all unless the set of active bundles changed since the last
+    rerun; switching pages only sends a small script that enables or
+    disables the already-loaded bundles.
+
+    Args:
+        active: Names of the bundles that should apply to the current page
     """
-    
-    # Apply the CSS
-    st.markdown(css, unsafe_allow_html=True)
-    
-    # Add separate JavaScript to set the data-theme attribute
+    active = sorted(active)
+    bundles = build_css_bundles(_css_sources_signature())
+    state = {name: bundle["hash"] for name, bundle in bundles.items()}
+
+    if st.session_state.get("_theme_bundles") == (state, active):
+        return
+
+    # Only send stylesheet text the first time a bundle's hash is seen this session
+    injected = st.session_state.get("_theme_bundles", ({}, []))[0]
+    payload = [
+        {"name": name, "hash": bundle["hash"], "css": bundle["css"] if injected.get(name) != bundle["hash"] else None}
+        for name, bundle in bundles.items()
+    ]
+
     js = """
     <script>
-        // Always set dark theme
-        document.body.setAttribute('data-theme', 'dark');
-        
-        // Use a mutation observer to ensure theme consistency
-        const observer = new MutationObserver(() => {
-            document.body.setAttribute('data-theme', 'dark');
-        });
+        const doc = window.parent.document;
+        const bundles = %s;
+        const active = %s;
+        for (const bundle of bundles) {
+            const id = "qw-css-" + bundle.name + "-" + bundle.hash;
+            let style = doc.getElementById(id);
+            if (!style && bundle.css !== null) {
+                doc.querySelectorAll('style[data-bundle="' + bundle.name + '"]').forEach(el => el.remove());
+                style = doc.createElement("style");
+                style.id = id;
+                style.dataset.bundle = bundle.name;
+                style.textContent = bundle.css;
+                doc.head.appendChild(style);
+            }
+            if (style) {
+                style.disabled = !active.includes(bundle.name);
+            }
+        }
         
-        observer.observe(document.body, { childList: true, subtree: true });
+        // Always set dark theme and keep it set
+        doc.body.setAttribute('data-theme', 'dark');
+        if (!window.parent.qwThemeObserver) {
+            window.parent.qwThemeObserver = new MutationObserver(() => {
+                if (doc.body.getAttribute('data-theme') !== 'dark') {
+                    doc.body.setAttribute('data-theme', 'dark');
+                }
+            });
+            window.parent.qwThemeObserver.observe(doc.body, { attributes: true, attributeFilter: ['data-theme'] });
+        }
     </script>
-    """
+    """ % (json.dumps(payload), json.dumps(active))
     
-    # Apply the JavaScript
-    st.markdown(js, unsafe_allow_html=True)
+    components.html(js, height=0)
+    st.session_state._theme_bundles = (state, active)
 
-def load_theme_aware_css(css_file):
-    """
-    Load CSS file with forced dark theme.
-    """
-    try:
-        with open(css_file, "r") as f:
-            css = f.read()
-            
-            # Just load the CSS without theme handling
-            st.markdown(f"<style>{css}</style>", unsafe_allow_html=True)
-            
-            # Then add a script to enforce dark mode
-            js = """
-            <script>
-                document.body.setAttribute('data-theme', 'dark');
-            </script>
-            """
-            st.markdown(js, unsafe_allow_html=True)
-        return True
-    except FileNotFoundError:
-        st.warning(f"CSS file not found: {css_file}")
-        return False
\ No newline at end of file
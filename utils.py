@@ -1,5 +1,6 @@
 import streamlit as st
 import os
+import tempfile
 
 # In utils.py, add this function for debugging
 def debug_css_loading(css_file):
@@ -12,12 +13,51 @@ def debug_css_loading(css_file):
     except Exception as e:
         st.error(f"Error loading CSS: {str(e)}")
 
-def load_css(css_file):
-    """Load and inject CSS from a file"""
-    try:
-        with open(css_file, "r") as f:
-            st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
-    except FileNotFoundError:
-        st.warning(f"CSS file not found: {css_file}")
-        return False
-    return True
+def get_session_upload_dir():
+    """Return a temporary directory for this session's uploaded files, creating it if needed"""
+    if "upload_dir" not in st.session_state or not os.path.isdir(st.session_state.upload_dir):
+        st.session_state.upload_dir = tempfile.mkdtemp(prefix="quickwrite_")
+    return st.session_state.upload_dir
+
+def save_uploaded_file(uploaded_file):
+    """Write an uploaded file to the session upload directory so it can be memory-mapped.
+
+    Every upload gets its own file (the original name plus a unique suffix), so
+    two uploads with the same filename never overwrite each other.
+    """
+    stem, ext = os.path.splitext(os.path.basename(uploaded_file.name))
+    fd, path = tempfile.mkstemp(dir=get_session_upload_dir(), prefix=f"{stem}_", suffix=ext)
+    with os.fdopen(fd, "wb") as f:
+        f.write(uploaded_file.getbuffer())
+    return path
+
+def file_source_input(label, extensions, key):
+    """File uploader with a local path alternative for files too large to upload.
+
+    Uploads are limited by Streamlit's upload size and held in memory, so large
+    volumes can instead be given as a path on the machine running the app and
+    are then read (or memory-mapped) in place.
+
+    Args:
+        label: Widget label
+        extensions: Accepted file extensions without the dot, e.g. ["npy"]
+        key: Widget key; the path input uses f"{key}_path"
+
+    Returns:
+        The uploaded file, the local path (str), or None if neither was given
+    """
+    uploaded = st.file_uploader(label, type=extensions, key=key)
+    local_path = st.text_input(f"{label} (or Local Path)", key=f"{key}_path",
+                               help="Path to the file on the machine running QuickWrite, for files too large to upload")
+    return uploaded if uploaded is not None else (local_path.strip() or None)
+
+def file_source_path(source, extensions):
+    """Path to read a file_source_input selection from, saving an upload to the session directory first"""
+    if not isinstance(source, str):
+        return save_uploaded_file(source)
+    path = os.path.expanduser(source)
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"No such file: {source}")
+    if not path.lower().endswith(tuple(f".{extension}" for extension in extensions)):
+        raise ValueError(f"{os.path.basename(path)} is not a {' or '.join(extensions)} file")
+    return path
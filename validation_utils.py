@@ -1,4 +1,25 @@
+import json
+import operator
+import re
+from bisect import bisect_left
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
 import streamlit as st
+from constraint_utils import get_constraint_library
+
+PRESCRIPTION_RULES_FILE = "data/prescription_rules.json"
+
+# Quantities and operators used in rule conditions
+PRESCRIPTION_QUANTITIES = ("dose", "fractions", "dose_per_fraction")
+RULE_OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+}
 
 class FormValidator:
     """Utility class for form validation with improved error handling."""
@@ -127,6 +148,216 @@ class FormValidator:
         return True
 
 
+class PrescriptionRuleSet:
+    """Declarative dose/fractionation rules compiled for fast evaluation.
+
+    Rules come from data/prescription_rules.json. Conditions are compiled to
+    (quantity, operator, value) tuples and each group's site keywords to one
+    regular expression when the rule set is built. For single prescriptions
+    the checks that apply to a site are selected once per site string; whole
+    arrays of prescriptions (validate_many) are evaluated from the same
+    compiled rules.
+    """
+    
+    def __init__(self, spec):
+        """Compile a rule set.
+        
+        Args:
+            spec: One entry of "rule_sets" in the rules file
+        """
+        self.prechecks = [self._compile_check(check) for check in spec.get("prechecks", [])]
+        self.groups = []
+        for group in spec["groups"]:
+            self.groups.append({
+                "name": group["name"],
+                "matcher": re.compile("|".join(re.escape(keyword) for keyword in group["keywords"])),
+                "exclusive": group.get("exclusive", True),
+                "bands": [
+                    (self._compile_conditions(band["when"]), [self._compile_check(check) for check in band["checks"]])
+                    for band in group["bands"]
+                ]
+            })
+        
+        default = spec["default"]
+        self.default_valid = default["valid"]
+        self.default_edges = default.get("edges", [])
+        self.default_messages = default.get("messages", [default.get("message", "")])
+        
+        self._groups_for_site = lru_cache(maxsize=1024)(self._match_groups)
+        self._checks_for_site = lru_cache(maxsize=1024)(self._select_checks)
+    
+    @staticmethod
+    def _compile_conditions(conditions):
+        return tuple((PRESCRIPTION_QUANTITIES.index(quantity), RULE_OPERATORS[op], float(value))
+                     for quantity, op, value in conditions)
+    
+    @classmethod
+    def _compile_check(cls, check):
+        return (cls._compile_conditions(check["when"]), check.get("site_keyword"), check["valid"], check["message"])
+    
+    def _match_groups(self, site):
+        groups = []
+        for group in self.groups:
+            if site and group["matcher"].search(site):
+                groups.append(group)
+                if group["exclusive"]:
+                    break
+        return tuple(groups)
+    
+    def _select_checks(self, site):
+        """The checks that can decide a prescription for a site, in evaluation order.
+        
+        Returns the prechecks, then for each of the site's groups its bands with
+        only the checks whose site keyword the site contains, each check as
+        (conditions, valid, message).
+        """
+        def checks(compiled):
+            return tuple((conditions, valid, message) for conditions, keyword, valid, message in compiled
+                         if keyword is None or keyword in site)
+        
+        bands = tuple(
+            tuple((band_conditions, checks(band_checks)) for band_conditions, band_checks in group["bands"])
+            for group in self._groups_for_site(site)
+        )
+        return checks(self.prechecks), bands
+    
+    def validate(self, dose, fractions, site=""):
+        """Validate one prescription.
+        
+        Args:
+            dose: Total dose in Gy
+            fractions: Number of fractions
+            site: Lowercased treatment site ("" for none)
+            
+        Returns:
+            tuple: (is_valid, message)
+        """
+        dose_per_fraction = dose / fractions if fractions > 0 else 0
+        values = (dose, fractions, dose_per_fraction)
+        prechecks, groups = self._checks_for_site(site)
+        
+        decision = self._first_hit(prechecks, values)
+        for bands in groups:
+            if decision is not None:
+                break
+            # Only the first band that matches is checked
+            for band_conditions, checks in bands:
+                for q, op, value in band_conditions:
+                    if not op(values[q], value):
+                        break
+                else:
+                    decision = self._first_hit(checks, values)
+                    break
+        if decision is None:
+            index = bisect_left(self.default_edges, dose_per_fraction)
+            decision = self.default_valid, self.default_messages[index]
+        
+        is_valid, message = decision
+        if "{" in message:
+            message = message.format(dose=dose, fractions=fractions, dose_per_fraction=dose_per_fraction, site=site)
+        return is_valid, message
+    
+    @staticmethod
+    def _first_hit(checks, values):
+        """(valid, message) of the first check whose conditions all hold, or None."""
+        for conditions, valid, message in checks:
+            for q, op, value in conditions:
+                if not op(values[q], value):
+                    break
+            else:
+                return valid, message
+        return None
+    
+    def validate_many(self, doses, fractions, sites):
+        """Validate many prescriptions with array operations.
+        
+        Gives the same result as calling validate on every prescription.
+        
+        Args:
+            doses: Total doses in Gy (sequence or array)
+            fractions: Numbers of fractions (sequence or array)
+            sites: Lowercased treatment sites ("" for none)
+            
+        Returns:
+            tuple: (numpy bool array of is_valid, list of messages)
+        """
+        dose_values = doses.tolist() if hasattr(doses, "tolist") else list(doses)
+        fraction_values = fractions.tolist() if hasattr(fractions, "tolist") else list(fractions)
+        dose_array = np.asarray(dose_values, dtype=float)
+        fraction_array = np.asarray(fraction_values, dtype=float)
+        dose_per_fraction = np.divide(dose_array, fraction_array, out=np.zeros_like(dose_array),
+                                      where=fraction_array > 0)
+        values = (dose_array, fraction_array, dose_per_fraction)
+        count = dose_array.size
+        
+        def evaluate(conditions):
+            mask = np.ones(count, dtype=bool)
+            for q, op, value in conditions:
+                mask &= op(values[q], value)
+            return mask
+        
+        # Site matching runs once per distinct site
+        inverse, unique_sites = pd.factorize(np.asarray(sites, dtype=object))
+        unique_sites = list(unique_sites)
+        site_groups = [self._groups_for_site(site) for site in unique_sites]
+        
+        valid = np.full(count, self.default_valid, dtype=bool)
+        templates = np.empty(count, dtype=object)
+        pending = np.ones(count, dtype=bool)
+        
+        def decide(hit, is_valid, message):
+            valid[hit] = is_valid
+            templates[hit] = message
+            pending[hit] = False
+        
+        for conditions, _, is_valid, message in self.prechecks:
+            decide(pending & evaluate(conditions), is_valid, message)
+        
+        for group in self.groups:
+            applies = np.array([any(g is group for g in groups) for groups in site_groups], dtype=bool)
+            rows = pending & applies[inverse]
+            for band_conditions, checks in group["bands"]:
+                in_band = rows & evaluate(band_conditions)
+                rows &= ~in_band
+                for conditions, keyword, is_valid, message in checks:
+                    hit = in_band & pending & evaluate(conditions)
+                    if keyword is not None:
+                        hit &= np.array([keyword in site for site in unique_sites], dtype=bool)[inverse]
+                    decide(hit, is_valid, message)
+        
+        default_rows = np.flatnonzero(pending)
+        messages = np.asarray(self.default_messages, dtype=object)
+        templates[default_rows] = messages[np.searchsorted(self.default_edges, dose_per_fraction[default_rows])]
+        
+        # Only messages with placeholders need formatting per prescription
+        needs_format = np.array(["{" in template for template in templates.tolist()], dtype=bool)
+        for i in np.flatnonzero(needs_format).tolist():
+            templates[i] = templates[i].format(
+                dose=dose_values[i], fractions=fraction_values[i],
+                dose_per_fraction=float(dose_per_fraction[i]), site=unique_sites[inverse[i]]
+            )
+        return valid, templates.tolist()
+
+
+@lru_cache(maxsize=None)
+def get_prescription_rules(name, path=PRESCRIPTION_RULES_FILE):
+    """Return a compiled rule set from the prescription rules file, loading it once."""
+    with open(path, "r") as file:
+        return PrescriptionRuleSet(json.load(file)["rule_sets"][name])
+
+
+@lru_cache(maxsize=4096, typed=True)
+def _validate(name, dose, fractions, site):
+    """Decision of a rule set for one prescription, with the site as entered.
+    
+    Forms re-validate the same prescription on every rerun, so decisions are
+    cached per (dose, fractions, site); typed so 50 and 50.0 Gy keep their
+    own message text.
+    """
+    site = site.lower() if isinstance(site, str) else ""
+    return get_prescription_rules(name).validate(dose, fractions, site)
+
+
 def validate_dose_fractionation(dose, fractions, site=None):
     """Validate dose and fractionation combinations based on clinical guidelines.
     
@@ -138,81 +369,7 @@ def validate_dose_fractionation(dose, fractions, site=None):
     Returns:
         tuple: (is_valid, message) indicating if the combination is valid and why
     """
-    if dose <= 0 or fractions <= 0:
-        return False, "Dose and fractions must be greater than 0"
-    
-    dose_per_fraction = dose / fractions
-    
-    # General safety limits
-    if dose_per_fraction > 20:
-        return False, f"Dose per fraction ({dose_per_fraction:.2f} Gy) exceeds 20 Gy/fraction safety limit"
-    
-    # Site-specific validation
-    if site:
-        site = site.lower()
-        
-        # Brain/SRS specific validation
-        if "brain" in site or any(region in site for region in ["frontal", "parietal", "temporal", "occipital", "cerebellum", "brainstem"]):
-            if fractions == 1:  # Single fraction SRS
-                if dose < 12:
-                    return True, f"Dose ({dose} Gy) is below typical single-fraction SRS range (12-24 Gy)"
-                if dose > 24:
-                    return False, f"Single fraction SRS dose ({dose} Gy) exceeds typical maximum of 24 Gy"
-                if dose > 15 and "brainstem" in site:
-                    return False, f"Single fraction SRS dose ({dose} Gy) exceeds typical maximum of 15 Gy for brainstem"
-            elif 2 <= fractions <= 5:  # Fractionated SRT
-                if dose < 18:
-                    return True, f"Dose ({dose} Gy) is below typical SRT range for {fractions} fractions"
-                if dose > 35:
-                    return False, f"SRT dose ({dose} Gy) exceeds typical maximum for {fractions} fractions"
-        
-        # Lung SBRT validation
-        elif "lung" in site:
-            if fractions <= 5:  # SBRT fractionation
-                if dose < 30:
-                    return True, f"Dose ({dose} Gy) is below typical lung SBRT range"
-                if dose > 60:
-                    return False, f"Lung SBRT dose ({dose} Gy) exceeds typical maximum of 60 Gy"
-        
-        # Breast validation
-        elif "breast" in site:
-            if fractions >= 15:  # Conventional or hypofractionated
-                if dose_per_fraction > 2.75:
-                    return False, f"Breast dose/fraction ({dose_per_fraction:.2f} Gy) exceeds typical maximum of 2.75 Gy/fraction"
-            elif 5 <= fractions < 15:  # Hypofractionated
-                if dose_per_fraction > 6.0:
-                    return False, f"Hypofractionated breast dose/fraction ({dose_per_fraction:.2f} Gy) exceeds typical maximum of 6.0 Gy/fraction"
-        
-        # Prostate validation
-        elif "prostate" in site:
-            if fractions <= 5:  # SBRT
-                if dose < 35:
-                    return True, f"Prostate SBRT dose ({dose} Gy) is below typical range"
-                if dose > 40:
-                    return False, f"Prostate SBRT dose ({dose} Gy) exceeds typical maximum of 40 Gy for {fractions} fractions"
-            elif fractions > 20:  # Conventional
-                if dose < 70:
-                    return True, f"Conventional prostate dose ({dose} Gy) is below typical range"
-                if dose > 80:
-                    return False, f"Conventional prostate dose ({dose} Gy) exceeds typical maximum of 80 Gy"
-        
-        # Liver SBRT validation  
-        elif "liver" in site:
-            if fractions <= 5:  # SBRT
-                if dose < 30:
-                    return True, f"Liver SBRT dose ({dose} Gy) is below typical range"
-                if dose > 60:
-                    return False, f"Liver SBRT dose ({dose} Gy) exceeds typical maximum of 60 Gy for {fractions} fractions"
-    
-    # Provide fractionation schema description based on dose per fraction
-    if dose_per_fraction <= 2.0:
-        return True, "Conventional fractionation"
-    elif 2.0 < dose_per_fraction <= 5.0:
-        return True, "Moderate hypofractionation"
-    elif 5.0 < dose_per_fraction <= 10.0:
-        return True, "Hypofractionation (SBRT range)"
-    else:
-        return True, "Extreme hypofractionation (SRS/SBRT range)"
+    return _validate("dose_fractionation", dose, fractions, site)
 
 
 def validate_treatment_site_consistency(treatment_site, dose, fractions):
@@ -226,30 +383,35 @@ def validate_treatment_site_consistency(treatment_site, dose, fractions):
     Returns:
         tuple: (is_valid, message) indicating if the combination is valid and why
     """
-    treatment_site = treatment_site.lower() if isinstance(treatment_site, str) else ""
-    
-    # Calculate dose per fraction
-    dose_per_fraction = dose / fractions if fractions > 0 else 0
-    
-    # SRS/SRT (brain) validation
-    if any(site in treatment_site for site in ["brain", "frontal", "parietal", "temporal", "occipital", "cerebellum"]):
-        if fractions == 1 and dose < 12:
-            return False, f"Single fraction brain treatment with {dose} Gy is below typical SRS range (12-24 Gy)"
-            
-        if fractions > 5 and dose_per_fraction > 3:
-            return False, f"Brain treatments with >5 fractions typically use ≤3 Gy/fraction (got {dose_per_fraction:.2f} Gy)"
-    
-    # SBRT validation for non-brain sites
-    elif fractions <= 5 and dose_per_fraction >= 6:
-        if any(site in treatment_site for site in ["breast", "head and neck", "pelvis"]):
-            return False, f"SBRT with {dose_per_fraction:.2f} Gy/fraction is not typically used for {treatment_site}"
+    return _validate("site_consistency", dose, fractions, treatment_site)
+
+
+def validate_prescriptions(doses, fractions, sites):
+    """Validate many prescriptions at once, e.g. for auditing historical prescriptions.
     
-    # Conventional validation
-    elif fractions >= 25 and dose_per_fraction < 1.8:
-        if any(site in treatment_site for site in ["lung nodule", "liver metastasis", "bone metastasis"]):
-            return True, f"Consider hypofractionation for {treatment_site} instead of conventional fractionation"
+    Applies both validate_dose_fractionation and validate_treatment_site_consistency
+    to every (dose, fractions, site), with the same results, using array operations.
     
-    return True, ""
+    Args:
+        doses: Total doses in Gy (sequence or array)
+        fractions: Numbers of fractions (sequence or array)
+        sites: Treatment sites; anything that isn't a string counts as no site
+        
+    Returns:
+        pandas.DataFrame: Columns "Valid", "Message", "Site Consistent" and "Site Message"
+    """
+    # Lowercase each distinct site once
+    codes, unique_sites = pd.factorize(np.asarray(sites, dtype=object))
+    lowered = np.array([site.lower() if isinstance(site, str) else "" for site in unique_sites] + [""], dtype=object)
+    sites = lowered[codes]
+    valid, messages = get_prescription_rules("dose_fractionation").validate_many(doses, fractions, sites)
+    consistent, site_messages = get_prescription_rules("site_consistency").validate_many(doses, fractions, sites)
+    return pd.DataFrame({
+        "Valid": valid,
+        "Message": messages,
+        "Site Consistent": consistent,
+        "Site Message": site_messages
+    })
 
 
 class ClinicalValidationRules:
@@ -270,79 +432,4 @@ class ClinicalValidationRules:
         organ = organ.lower()
         treatment_type = treatment_type.lower()
         
-        # Base constraints dictionary
-        constraints = {
-            # Brain/head & neck constraints
-            "brain": {
-                "conventional": {"mean": 45, "max": 60, "unit": "Gy"},
-                "srs": {"max": 12, "unit": "Gy"},
-            },
-            "brainstem": {
-                "conventional": {"max": 54, "unit": "Gy"},
-                "sbrt": {"max": 23, "unit": "Gy"},
-                "srs": {"max": 15, "unit": "Gy"},
-            },
-            "optic chiasm": {
-                "conventional": {"max": 54, "unit": "Gy"},
-                "srs": {"max": 10, "unit": "Gy"},
-            },
-            "optic nerve": {
-                "conventional": {"max": 54, "unit": "Gy"},
-                "srs": {"max": 10, "unit": "Gy"},
-            },
-            "cochlea": {
-                "conventional": {"mean": 45, "unit": "Gy"},
-            },
-            "parotid": {
-                "conventional": {"mean": 26, "unit": "Gy"},
-            },
-            
-            # Thoracic constraints
-            "heart": {
-                "conventional": {"mean": 26, "unit": "Gy"},
-                "sbrt": {"max": 30, "unit": "Gy"},
-            },
-            "lung": {
-                "conventional": {"v20": 30, "unit": "%"},
-                "sbrt": {"v20": 10, "unit": "%"},
-            },
-            "esophagus": {
-                "conventional": {"mean": 34, "unit": "Gy"},
-                "sbrt": {"max": 27, "unit": "Gy"},
-            },
-            "spinal cord": {
-                "conventional": {"max": 50, "unit": "Gy"},
-                "sbrt": {"max": 18, "unit": "Gy"},
-                "srs": {"max": 14, "unit": "Gy"},
-            },
-            
-            # Abdominal constraints
-            "liver": {
-                "conventional": {"mean": 30, "unit": "Gy"},
-                "sbrt": {"v15": 700, "unit": "cc"},
-            },
-            "kidney": {
-                "conventional": {"mean": 18, "unit": "Gy"},
-                "sbrt": {"v12": 25, "unit": "%"},
-            },
-            "bowel": {
-                "conventional": {"max": 50, "unit": "Gy"},
-                "sbrt": {"max": 27, "unit": "Gy"},
-            },
-            
-            # Pelvic constraints
-            "rectum": {
-                "conventional": {"v70": 20, "unit": "%"},
-                "sbrt": {"v36": 1, "unit": "cc"},
-            },
-            "bladder": {
-                "conventional": {"v70": 35, "unit": "%"},
-                "sbrt": {"v37": 10, "unit": "cc"},
-            },
-        }
-        
-        # Return the constraints if found
-        if organ in constraints and treatment_type in constraints[organ]:
-            return constraints[organ][treatment_type]
-        
-        return None
\ No newline at end of file
+        return get_constraint_library().get_organ_limits(organ, treatment_type)
\ No newline at end of file